@@ -0,0 +1,75 @@
+import struct
+
+# Motion JPEG in AVI (RIFF) files generated on the fly, e.g. clips of instant
+# replay and timelapse movies. The headers only need the number of frames
+# and their sizes, so they are built before any frame is read, the frames
+# are written as "00dc" chunks one by one, and the index "idx1" follows in
+# blocks, so a file of any length is written in constant memory.
+
+CONTENT_TYPE = "video/x-msvideo"
+INDEX_BLOCK = 1024 # entries of the index written at once
+AVIF_HASINDEX = 0x10
+AVIIF_KEYFRAME = 0x10
+
+# width and height of a JPEG image (the SOF marker), None if not found
+def jpeg_size(data):
+    pos = 2
+    while pos + 9 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        length = (data[pos + 2] << 8) | data[pos + 3]
+        if marker in (0xC0, 0xC1, 0xC2):
+            height, width = struct.unpack(">HH", data[pos + 5:pos + 9])
+            return width, height
+        pos += 2 + length
+    return None
+
+def chunk(fourcc, size):
+    return fourcc + struct.pack("<I", size)
+
+# bytes of a frame chunk, padded to even size
+def chunk_size(size):
+    return 8 + size + size % 2
+
+# size of "movi" list of the frames of the sizes
+def movi_size(sizes):
+    return 4 + sum(chunk_size(size) for size in sizes)
+
+# headers until "movi" of the frames, "frame_us" is the duration of a frame
+def header(frames, movi_size, max_size, width, height, frame_us):
+    frame_us = max(int(frame_us), 1)
+    avih = struct.pack("<IIIIIIIIII16x", frame_us, max_size * 1000000 // frame_us, 0,
+                       AVIF_HASINDEX, frames, 0, 1, max_size, width, height)
+    strh = struct.pack("<4s4sIHHIIIIIIIIhhhh", b"vids", b"MJPG", 0, 0, 0, 0,
+                       frame_us, 1000000, 0, frames, max_size, 0xFFFFFFFF, 0,
+                       0, 0, width, height)
+    strf = struct.pack("<IiiHH4sIiiII", 40, width, height, 1, 24, b"MJPG", width * height * 3, 0, 0, 0, 0)
+    strl = b"strl" + chunk(b"strh", len(strh)) + strh + chunk(b"strf", len(strf)) + strf
+    hdrl = b"hdrl" + chunk(b"avih", len(avih)) + avih + chunk(b"LIST", len(strl)) + strl
+    riff_size = 4 + 8 + len(hdrl) + 8 + movi_size + 8 + 16 * frames
+    return chunk(b"RIFF", riff_size) + b"AVI " + chunk(b"LIST", len(hdrl)) + hdrl + chunk(b"LIST", movi_size) + b"movi"
+
+# bytes of the file with the header
+def length(header, movi_size, frames):
+    return len(header) + movi_size - 4 + 8 + 16 * frames
+
+# buffers of a frame chunk, none is empty (for sendmsg_all)
+def frame_buffers(data):
+    size = len(data)
+    return [chunk(b"00dc", size), data] + ([b"\0"] if size % 2 else [])
+
+# blocks of the index of the frames of the sizes (an iterable of "frames"
+# sizes), with offsets from "movi"
+def index_blocks(frames, sizes):
+    yield chunk(b"idx1", 16 * frames)
+    offset = 4
+    entries = []
+    for size in sizes:
+        entries.append(struct.pack("<4sIII", b"00dc", AVIIF_KEYFRAME, offset, size))
+        offset += chunk_size(size)
+        if len(entries) >= INDEX_BLOCK:
+            yield b"".join(entries)
+            entries = []
+    if entries:
+        yield b"".join(entries)
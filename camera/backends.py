@@ -0,0 +1,771 @@
+import io
+import re
+import mmap
+import time
+import socket
+import shutil
+import threading
+import http.client
+import urllib.parse
+import subprocess
+import contextlib
+from collections import deque
+from PIL import Image, ImageDraw, ImageFont
+from metrics import registry
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Camera backends of VideoServer. A backend is opened with the settings of
+# VideoConfig (transform, frame rate, resolution of "lores" stream and of
+# "main" stream), streams JPEG frames of "lores" stream to a stream buffer
+# and optionally H.264 frames to an HLS stream, and captures images of
+# "main" stream for snapshots.
+# "frame_callback" is called for each frame with two functions, which return
+# a context of the BGR array of "main" stream, e.g. for ROI streaming, and
+# of the Y plane of "lores" stream, e.g. for motion detection.
+# A stopped backend is reconfigured for new settings without being closed,
+# and the frame rate may be changed while it is running.
+class CameraBackend(object):
+    name = "none"
+
+    def __init__(self):
+        self.controls = {}
+        self.frame_callback = None
+        self._transform = {"hflip": False, "vflip": False}
+        self._frame_rate = 30
+        self._resolution = (640, 480)
+        self._snapshot_resolution = (1920, 1080)
+
+    def open(self, transform, frame_rate, resolution, snapshot_resolution):
+        self._transform = transform
+        self._frame_rate = frame_rate
+        self._resolution = tuple(resolution)
+        self._snapshot_resolution = tuple(snapshot_resolution)
+
+    # the settings of the backend, compared with video config for changes
+    @property
+    def settings(self):
+        return (self._transform, self._frame_rate, self._resolution, self._snapshot_resolution)
+
+    # reconfigure the stopped backend for new settings
+    def reconfigure(self, transform, frame_rate, resolution, snapshot_resolution):
+        self.close()
+        self.open(transform, frame_rate, resolution, snapshot_resolution)
+
+    # change the frame rate of the running backend, return False if the
+    # backend must be reconfigured for it
+    def set_frame_rate(self, frame_rate):
+        return False
+
+    @property
+    def properties(self):
+        return {"ScalerCropMaximum": (0, 0, *self._snapshot_resolution)}
+
+    @property
+    def camera_controls(self):
+        return {}
+
+    def set_controls(self, controls):
+        self.controls.update(controls)
+
+    def start(self, stream, hls = None, hls_bitrate = 4000000, hls_iperiod = 60):
+        raise NotImplementedError
+
+    def stop(self):
+        pass
+
+    def close(self):
+        pass
+
+    # PIL image of "main" stream
+    def capture_image(self):
+        raise NotImplementedError
+
+    # apply transform of video config and scale to the size
+    def _transform_image(self, image, size):
+        if self._transform["hflip"]:
+            image = image.transpose(Image.FLIP_LEFT_RIGHT)
+        if self._transform["vflip"]:
+            image = image.transpose(Image.FLIP_TOP_BOTTOM)
+        if image.size != tuple(size):
+            image = image.resize(size, resample=Image.BILINEAR)
+        return image
+
+# Real camera with Picamera2, "main" stream (RGB888) for snapshots, and
+# "lores" stream encoded by the MJPEG (and H.264) hardware encoder.
+# picamera2 and libcamera are imported when the camera is opened.
+# The timestamps of encoder output are microseconds since the first frame
+# (by "SensorTimestamp" of the request), the capture time of a frame is the
+# time of the first frame (seen by "post_callback") plus its timestamp.
+class Picamera2Backend(CameraBackend):
+    name = "picamera2"
+
+    # "camera_num" is the index of the camera, e.g. of the two cameras of Pi 5
+    def __init__(self, camera_num = 0):
+        super().__init__()
+        self._camera_num = camera_num
+        self.picam2 = None
+        self._first_capture_t = None
+        self._h264_running = False
+
+    def open(self, transform, frame_rate, resolution, snapshot_resolution):
+        super().open(transform, frame_rate, resolution, snapshot_resolution)
+        from picamera2 import Picamera2
+        self.picam2 = Picamera2(self._camera_num)
+        self._configure()
+        self.picam2.post_callback = self._on_request
+
+    # the camera is configured again without being closed
+    def reconfigure(self, transform, frame_rate, resolution, snapshot_resolution):
+        CameraBackend.open(self, transform, frame_rate, resolution, snapshot_resolution)
+        self._configure()
+
+    # the frame rate is a control of the running camera, but the key frame
+    # interval of H.264 encoder depends on it
+    def set_frame_rate(self, frame_rate):
+        if self._h264_running:
+            return False
+        self.picam2.set_controls({"FrameRate": frame_rate})
+        self._frame_rate = frame_rate
+        return True
+
+    def _configure(self):
+        from libcamera import Transform
+        transform = self._transform
+        video_config = self.picam2.create_video_configuration(
+            main = {"size": self._snapshot_resolution, "format": "RGB888"},
+            lores = {"size": self._resolution},
+            encode = "lores",
+            buffer_count = 2,
+            display = None,
+            transform = Transform(hflip=transform["hflip"], vflip=transform["vflip"]),
+            controls = {"FrameRate": self._frame_rate}
+        )
+        logger.info(f"{video_config=}")
+        self.picam2.configure(video_config)
+
+    @property
+    def properties(self):
+        return self.picam2.camera_properties
+
+    @property
+    def camera_controls(self):
+        return self.picam2.camera_controls
+
+    def set_controls(self, controls):
+        self.picam2.set_controls(controls)
+        self.controls = self.picam2.controls
+
+    # capture time (seconds since epoch) of the request, by its sensor timestamp
+    # (nanoseconds of CLOCK_BOOTTIME)
+    def _capture_time(self, request):
+        try:
+            sensor_ns = request.get_metadata()["SensorTimestamp"]
+            return time.time() - (time.clock_gettime_ns(time.CLOCK_BOOTTIME) - sensor_ns) / 1e9
+        except Exception as e:
+            logger.warning(f"No sensor timestamp: {e}")
+            return time.time()
+
+    # capture time of a frame of encoder output, None if unknown
+    def _frame_time(self, timestamp):
+        if self._first_capture_t is None or timestamp is None:
+            return None
+        return self._first_capture_t + timestamp / 1e6
+
+    def _on_request(self, request):
+        if self._first_capture_t is None:
+            self._first_capture_t = self._capture_time(request)
+        callback = self.frame_callback
+        if callback is not None:
+            from picamera2 import MappedArray
+            @contextlib.contextmanager
+            def main():
+                with MappedArray(request, "main", write=False) as m:
+                    yield m.array
+            # "lores" stream is YUV420, the Y plane is the first rows
+            @contextlib.contextmanager
+            def lores():
+                width, height = self._resolution
+                with MappedArray(request, "lores", write=False) as m:
+                    yield m.array[:height, :width]
+            callback(main, lores)
+
+    def start(self, stream, hls = None, hls_bitrate = 4000000, hls_iperiod = 60):
+        from picamera2.encoders import MJPEGEncoder, H264Encoder
+        from picamera2.outputs import Output
+        backend = self
+        # output of MJPEG encoder to stream buffer, with the capture time
+        class MjpegOutput(Output):
+            def outputframe(self, frame, keyframe = True, timestamp = None, packet = None, audio = False):
+                stream.write_frame(frame, backend._frame_time(timestamp), time.time())
+        self._first_capture_t = None
+        self.picam2.start_recording(MJPEGEncoder(bitrate=32000000), MjpegOutput())
+        if hls is not None:
+            # output of H.264 encoder to HLS stream
+            class HlsOutput(Output):
+                def outputframe(self, frame, keyframe = True, timestamp = None, packet = None, audio = False):
+                    hls.write_frame(frame, keyframe, timestamp)
+            # a key frame with SPS and PPS at each segment boundary
+            encoder = H264Encoder(bitrate=hls_bitrate, repeat=True, iperiod=hls_iperiod)
+            self.picam2.start_encoder(encoder, HlsOutput(), name="lores")
+            self._h264_running = True
+
+    def stop(self):
+        self.picam2.stop_recording()
+        self.picam2.stop()
+        self._h264_running = False
+
+    def close(self):
+        self.picam2.close()
+        self.picam2 = None
+
+    def capture_image(self):
+        return self.picam2.capture_image("main")
+
+# Software H.264 encoder (ffmpeg with libx264) for the backends without a
+# hardware encoder. Frames are written to ffmpeg by the caller, and access
+# units (delimited by AUD) are read from its output in a reader thread.
+H264_AUD_PREFIX = b"\x00\x00\x00\x01\x09"
+H264_START_CODE = re.compile(b"\x00\x00\x01(.)", re.DOTALL)
+
+class FfmpegH264Encoder(object):
+    def __init__(self, hls, size, fps, bitrate, iperiod):
+        ffmpeg = shutil.which("ffmpeg")
+        if ffmpeg is None:
+            raise Exception("ffmpeg is not found for H.264 encoding")
+        self._hls = hls
+        self._size = tuple(size)
+        self._timestamps = deque()
+        args = [ffmpeg, "-loglevel", "error",
+                "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{size[0]}x{size[1]}", "-r", str(fps), "-i", "-",
+                "-c:v", "libx264", "-preset", "ultrafast", "-tune", "zerolatency", "-pix_fmt", "yuv420p",
+                "-bf", "0", "-g", str(iperiod), "-keyint_min", str(iperiod), "-sc_threshold", "0",
+                "-b:v", str(bitrate), "-x264-params", "aud=1:repeat-headers=1", "-f", "h264", "-"]
+        self._process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self._thread = threading.Thread(target=self._read, name="h264", daemon=True)
+        self._thread.start()
+
+    # RGB image of the size, timestamp in microseconds
+    def encode(self, image, timestamp):
+        self._timestamps.append(timestamp)
+        self._process.stdin.write(image.convert("RGB").tobytes())
+
+    def _read(self):
+        buf = bytearray()
+        while True:
+            chunk = self._process.stdout.read1(65536)
+            if not chunk:
+                break
+            buf += chunk
+            while True:
+                end = buf.find(H264_AUD_PREFIX, 1)
+                if end < 0:
+                    break
+                self._output(bytes(buf[:end]))
+                del buf[:end]
+        if buf:
+            self._output(bytes(buf))
+
+    def _output(self, unit):
+        if unit.startswith(H264_AUD_PREFIX):
+            unit = unit[len(H264_AUD_PREFIX) + 1:] # the muxer adds its own AUD
+        keyframe = any(m.group(1)[0] & 0x1F == 5 for m in H264_START_CODE.finditer(unit))
+        timestamp = self._timestamps.popleft() if self._timestamps else None
+        self._hls.write_frame(unit, keyframe, timestamp)
+
+    def close(self):
+        try:
+            self._process.stdin.close()
+            self._process.wait(5)
+        except Exception as e:
+            logger.warning(f"Error to close H.264 encoder: {e}")
+            self._process.kill()
+        self._thread.join()
+
+# Base of the backends streaming from a thread at the frame rate of video
+# config, with JPEG (PIL) and optional H.264 (ffmpeg) software encoders.
+class SoftwareBackend(CameraBackend):
+    def __init__(self):
+        super().__init__()
+        self._thread = None
+        self._running = False
+        self._stream = None
+        self._h264 = None
+
+    def start(self, stream, hls = None, hls_bitrate = 4000000, hls_iperiod = 60):
+        self._stream = stream
+        if hls is not None:
+            try:
+                self._h264 = FfmpegH264Encoder(hls, self._resolution, self._frame_rate, hls_bitrate, hls_iperiod)
+            except Exception as e:
+                logger.warning(f"No HLS for {self.name} camera: {e}")
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._h264 is not None:
+            self._h264.close()
+            self._h264 = None
+
+    # the frame rate of ffmpeg input is fixed
+    def set_frame_rate(self, frame_rate):
+        if self._h264 is not None:
+            return False
+        self._frame_rate = frame_rate
+        return True
+
+    # JPEG data and PIL image (for H.264, None if not decoded) of the next
+    # frame, and its time relative to the previous one, None at the end
+    def next_frame(self):
+        raise NotImplementedError
+
+    # frames are prepared ahead of their time, a frame is taken as captured
+    # at its time minus the time spent to render and encode it
+    def _run(self):
+        next_t = time.monotonic()
+        while self._running:
+            interval = 1.0 / self._frame_rate
+            start_t = time.monotonic()
+            frame = self.next_frame()
+            if frame is None:
+                break
+            data, image, delay = frame
+            encode_time = time.monotonic() - start_t
+            next_t = max(next_t + max(delay, interval), time.monotonic() - interval)
+            time.sleep(max(0, next_t - time.monotonic()))
+            now = time.time()
+            self._output(data, image, now - encode_time, now)
+        logger.info(f"End of {self.name} camera")
+
+    # publish the frame to the stream, the H.264 encoder and the callback
+    def _output(self, data, image, timestamp, encoded_t):
+        self._stream.write_frame(data, timestamp, encoded_t)
+        if self._h264 is not None:
+            if image is None:
+                image = self._transform_image(Image.open(io.BytesIO(data)), self._resolution)
+            self._h264.encode(image, int(time.monotonic() * 1e6))
+        callback = self.frame_callback
+        if callback is not None:
+            callback(lambda: contextlib.nullcontext(self._main_array()),
+                     lambda: contextlib.nullcontext(self._lores_array(data, image)))
+
+    # BGR array of "main" stream
+    def _main_array(self):
+        import numpy
+        return numpy.asarray(self.capture_image().convert("RGB"))[:, :, ::-1]
+
+    # luminance (Y plane) of the frame, of the rendered image if any, the
+    # JPEG frame is only decoded for its luminance (in draft mode) otherwise
+    def _lores_array(self, data, image):
+        import numpy
+        if image is None:
+            image = Image.open(io.BytesIO(data))
+            image.draft("L", image.size)
+        return numpy.asarray(image.convert("L"))
+
+# Synthetic camera generates a moving test pattern (color bars, a moving box,
+# frame number and time) at the resolution and frame rate of video config,
+# encoded by a real JPEG encoder, for development and benchmarks without a
+# camera.
+class SyntheticBackend(SoftwareBackend):
+    name = "synthetic"
+    COLORS = [(192, 192, 192), (192, 192, 0), (0, 192, 192), (0, 192, 0), (192, 0, 192), (192, 0, 0), (0, 0, 192)]
+
+    def __init__(self, quality = 85):
+        super().__init__()
+        self._quality = quality
+        self._backgrounds = {}
+        self._seq = 0
+
+    def _background(self, size):
+        background = self._backgrounds.get(size)
+        if background is None:
+            width, height = size
+            background = Image.new("RGB", size)
+            draw = ImageDraw.Draw(background)
+            for i, color in enumerate(self.COLORS):
+                draw.rectangle([i * width // len(self.COLORS), 0, (i + 1) * width // len(self.COLORS), height * 2 // 3], fill=color)
+            for i in range(16):
+                gray = i * 255 // 15
+                draw.rectangle([i * width // 16, height * 2 // 3, (i + 1) * width // 16, height], fill=(gray, gray, gray))
+            self._backgrounds[size] = background
+        return background
+
+    def _font(self, height):
+        try:
+            return ImageFont.load_default(size=max(height // 20, 10))
+        except TypeError: # Pillow < 10.1
+            return ImageFont.load_default()
+
+    # test pattern of the frame at the size, transformed
+    def render(self, size, seq, timestamp):
+        width, height = size
+        image = self._background(size).copy()
+        draw = ImageDraw.Draw(image)
+        box = height // 4
+        x = int(seq * width / (4 * self._frame_rate)) % (width - box)
+        y = (height * 2 // 3 - box) // 2
+        draw.rectangle([x, y, x + box, y + box], fill=(255, 255, 255), outline=(0, 0, 0), width=max(box // 20, 1))
+        text = f"#{seq} {time.strftime('%H:%M:%S', time.localtime(timestamp))}.{int(timestamp * 1000) % 1000:03d} {width}x{height}"
+        draw.text((box // 4, box // 4), text, fill=(255, 255, 255), font=self._font(height), stroke_width=2, stroke_fill=(0, 0, 0))
+        return self._transform_image(image, size)
+
+    def next_frame(self):
+        self._seq += 1
+        image = self.render(self._resolution, self._seq, time.time())
+        buf = io.BytesIO()
+        image.save(buf, format="JPEG", quality=self._quality)
+        return buf.getvalue(), image, 0
+
+    def capture_image(self):
+        return self.render(self._snapshot_resolution, self._seq, time.time())
+
+# Replay camera plays a recorded MJPEG file at its original timing, either a
+# multipart stream saved from "/stream.mjpg" (with "X-Timestamp" of each
+# part), or concatenated JPEG images (at the frame rate of video config).
+# Frames faster than the frame rate of video config are dropped, and frames
+# are only decoded and encoded again if transformed or resized.
+class ReplayBackend(SoftwareBackend):
+    name = "replay"
+
+    def __init__(self, file = None, loop = True, quality = 85):
+        super().__init__()
+        if not file:
+            raise Exception("No file to replay")
+        self._file = file
+        self._loop = loop
+        self._quality = quality
+        self._frames = []
+        self._index = 0
+        self._latest = None
+        self._mmap = None
+
+    def open(self, transform, frame_rate, resolution, snapshot_resolution):
+        super().open(transform, frame_rate, resolution, snapshot_resolution)
+        with open(self._file, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._frames = self._index_frames(self._mmap)
+        if not self._frames:
+            raise Exception(f"No frame in {self._file}")
+        with Image.open(io.BytesIO(self._frame_data(0))) as image:
+            self._source_size = image.size
+        self._index = 0
+        logger.info(f"Replay {self._file}: {len(self._frames)} frames of {self._source_size}")
+
+    # list of (offset, length, timestamp or None)
+    def _index_frames(self, data):
+        frames = []
+        if data[:2] == b"--":
+            pos = 0
+            while True:
+                start = data.find(b"\r\n\r\n", pos)
+                if start < 0:
+                    break
+                headers = data[pos:start].decode("latin-1").lower()
+                length = re.search(r"content-length:\s*(\d+)", headers)
+                timestamp = re.search(r"x-timestamp:\s*([\d.]+)", headers)
+                if length is None:
+                    break
+                start += 4
+                frames.append((start, int(length.group(1)), float(timestamp.group(1)) if timestamp else None))
+                pos = data.find(b"--", start + int(length.group(1)))
+                if pos < 0:
+                    break
+        else:
+            pos = data.find(b"\xff\xd8")
+            while pos >= 0:
+                end = data.find(b"\xff\xd9", pos)
+                if end < 0:
+                    break
+                frames.append((pos, end + 2 - pos, None))
+                pos = data.find(b"\xff\xd8", end + 2)
+        return frames
+
+    def _frame_data(self, index):
+        offset, length, _ = self._frames[index]
+        return self._mmap[offset:offset + length]
+
+    def next_frame(self):
+        interval = 1.0 / self._frame_rate
+        delay = 0
+        while True:
+            if self._index >= len(self._frames):
+                if not self._loop:
+                    return None
+                self._index = 0
+            _, _, timestamp = self._frames[self._index]
+            previous = self._frames[self._index - 1][2] if self._index > 0 else None
+            self._index += 1
+            if timestamp is not None and previous is not None:
+                delay += max(timestamp - previous, 0)
+                if delay < interval * 0.9 and self._index < len(self._frames):
+                    continue # faster than the frame rate
+            break
+        data = self._frame_data(self._index - 1)
+        image = None
+        if self._transform["hflip"] or self._transform["vflip"] or self._source_size != self._resolution:
+            image = self._transform_image(Image.open(io.BytesIO(data)), self._resolution)
+            buf = io.BytesIO()
+            image.save(buf, format="JPEG", quality=self._quality)
+            data = buf.getvalue()
+        self._latest = data
+        return data, image, delay
+
+    def capture_image(self):
+        data = self._latest or self._frame_data(0)
+        image = Image.open(io.BytesIO(data))
+        if image.size != self._snapshot_resolution:
+            image = image.resize(self._snapshot_resolution, resample=Image.BILINEAR)
+        return image.convert("RGB")
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+# Incremental reader of a multipart MJPEG stream, e.g. "/stream.mjpg" of
+# another camera server, from a buffered binary file (the HTTP response).
+# Parts are read one at a time, by their "Content-Length" or up to the next
+# boundary for parts without it, so only the frame being read is in memory.
+class MultipartReader(object):
+    def __init__(self, file, boundary, max_part_bytes = 16 * 1024 * 1024):
+        self._file = file
+        # some servers put the dashes of the delimiter in the boundary
+        self._delimiter = (boundary if boundary.startswith("--") else "--" + boundary).encode("latin-1")
+        self._max_part_bytes = max_part_bytes
+        self._next = None # delimiter line read at the end of a part without length
+
+    def _readline(self):
+        line = self._file.readline(65536)
+        if not line:
+            raise EOFError("End of multipart stream")
+        return line
+
+    # data and headers (lower case names) of the next part
+    def read(self):
+        line, self._next = self._next, None
+        while line is None or not line.startswith(self._delimiter):
+            line = self._readline() # preamble, or CRLF after the previous part
+        if line.rstrip().endswith(b"--") and line.rstrip() != self._delimiter:
+            raise EOFError("End of multipart stream")
+        headers = {}
+        while True:
+            line = self._readline().strip()
+            if not line:
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = headers.get("content-length")
+        if length is not None:
+            length = int(length)
+            if length > self._max_part_bytes:
+                raise Exception(f"Part of {length} bytes is too large")
+            data = self._file.read(length)
+            if len(data) < length:
+                raise EOFError("End of multipart stream")
+            return data, headers
+        data = bytearray()
+        while True:
+            line = self._readline()
+            if line.startswith(self._delimiter):
+                self._next = line
+                break
+            data += line
+            if len(data) > self._max_part_bytes:
+                raise Exception(f"Part of more than {self._max_part_bytes} bytes")
+        return bytes(data[:-2] if data.endswith(b"\r\n") else data), headers
+
+RELAY_CONNECTED = registry.gauge("camera_relay_connected", "Relay camera is receiving the upstream stream", ("stream",))
+RELAY_CONNECTS = registry.counter("camera_relay_connects_total", "Connections of relay camera to the upstream stream",
+    ("stream",))
+RELAY_FAILURES = registry.counter("camera_relay_failures_total", "Failed or lost connections of relay camera",
+    ("stream",))
+
+# Relay camera re-serves the stream of another camera server, e.g. a camera
+# behind a weak link, so it sends one stream for any number of viewers of
+# the relay. "url" is the base URL of the upstream server, e.g.
+# "http://camera:8080", or "http://camera:8080/cam/1" for a camera of a
+# server of several cameras. Its "/stream.mjpg" is read part by part, and
+# each frame is published as it is received (not decoded or encoded again)
+# with the capture time of the upstream ("X-Timestamp"), so relays chain and
+# the latency metrics of the last relay are from the capture on the camera.
+# A lost or failed upstream is connected again after a delay, which doubles
+# up to "max_reconnect_delay" while it keeps failing, and viewers get the
+# logo meanwhile. Snapshots are "/snapshot.jpg" of the upstream, or the
+# latest frame if it fails. Transform and resolution of video config only
+# apply to HLS, the frames are the frames of the upstream.
+class RelayBackend(SoftwareBackend):
+    name = "relay"
+
+    def __init__(self, url = None, timeout = 10, reconnect_delay = 1.0, max_reconnect_delay = 30.0):
+        super().__init__()
+        if not url:
+            raise Exception("No upstream URL to relay")
+        url = urllib.parse.urlsplit(url)
+        if url.scheme not in ("http", "https") or not url.hostname:
+            raise Exception(f"Unsupported upstream URL: {url.geturl()}")
+        self._url = url
+        self._timeout = timeout
+        self._reconnect_delay = reconnect_delay
+        self._max_reconnect_delay = max_reconnect_delay
+        self._wakeup = threading.Event()
+        self._sock = None
+        self._latest = None
+
+    def _connect(self, path):
+        url = self._url
+        connection_class = http.client.HTTPSConnection if url.scheme == "https" else http.client.HTTPConnection
+        connection = connection_class(url.hostname, url.port, timeout=self._timeout)
+        connection.request("GET", url.path.rstrip("/") + path, headers={"User-Agent": "LiveCamera relay"})
+        return connection
+
+    def start(self, stream, hls = None, hls_bitrate = 4000000, hls_iperiod = 60):
+        self._wakeup.clear()
+        self._connected = RELAY_CONNECTED.labels(stream.name)
+        self._connects = RELAY_CONNECTS.labels(stream.name)
+        self._failures = RELAY_FAILURES.labels(stream.name)
+        super().start(stream, hls, hls_bitrate, hls_iperiod)
+
+    # the blocked read of the upstream is woken up by shutting down its socket
+    def stop(self):
+        self._running = False
+        self._wakeup.set()
+        sock = self._sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        super().stop()
+
+    def _run(self):
+        upstream = self._url.geturl()
+        delay = self._reconnect_delay
+        while self._running:
+            try:
+                if self._relay():
+                    delay = self._reconnect_delay
+            except Exception as e:
+                if self._running:
+                    logger.warning(f"Error to relay {upstream}: {e}")
+            self._connected.set(0)
+            if not self._running:
+                break
+            self._failures.inc()
+            logger.info(f"Connect to {upstream} again in {delay:.1f}s")
+            self._wakeup.wait(delay)
+            delay = min(delay * 2, self._max_reconnect_delay)
+        logger.info(f"End of {self.name} camera")
+
+    # relay the upstream stream until it ends, return the frames relayed
+    def _relay(self):
+        connection = self._connect("/stream.mjpg")
+        self._sock = connection.sock
+        frames = 0
+        try:
+            if not self._running:
+                return 0
+            response = connection.getresponse()
+            if response.status != 200:
+                raise Exception(f"{response.status} {response.reason}")
+            content_type = response.getheader("Content-Type", "")
+            boundary = re.search(r'boundary="?([^";]+)', content_type)
+            if not content_type.startswith("multipart/") or boundary is None:
+                raise Exception(f"Not a multipart stream: {content_type}")
+            reader = MultipartReader(response, boundary.group(1).strip())
+            self._connects.inc()
+            logger.info(f"Relay {self._url.geturl()}")
+            while self._running:
+                data, headers = reader.read()
+                if not data.startswith(b"\xff\xd8"):
+                    continue # not a JPEG image
+                now = time.time()
+                try:
+                    timestamp = float(headers["x-timestamp"])
+                except (KeyError, ValueError):
+                    timestamp = now
+                if frames == 0:
+                    self._connected.set(1)
+                    logger.info(f"Frames of {Image.open(io.BytesIO(data)).size} from {self._url.geturl()}")
+                self._latest = data
+                frames += 1
+                self._output(data, None, timestamp, now)
+            return frames
+        except EOFError:
+            if self._running:
+                logger.warning(f"End of stream of {self._url.geturl()}")
+            return frames
+        finally:
+            self._sock = None
+            connection.close()
+
+    # BGR array of the latest frame
+    def _main_array(self):
+        import numpy
+        return numpy.asarray(Image.open(io.BytesIO(self._latest)).convert("RGB"))[:, :, ::-1]
+
+    def capture_image(self):
+        try:
+            connection = self._connect("/snapshot.jpg")
+            try:
+                response = connection.getresponse()
+                if response.status != 200:
+                    raise Exception(f"{response.status} {response.reason}")
+                image = Image.open(io.BytesIO(response.read()))
+                image.load()
+            finally:
+                connection.close()
+        except Exception as e:
+            latest = self._latest
+            if latest is None:
+                raise Exception(f"No snapshot of {self._url.geturl()}: {e}")
+            logger.warning(f"Snapshot of the latest frame, failed snapshot of {self._url.geturl()}: {e}")
+            image = Image.open(io.BytesIO(latest))
+        return image.convert("RGB")
+
+# Camera of a worker process in multi-process mode (see supervisor.py), the
+# frames are encoded by the capture process and read from its ring in shared
+# memory by the feeder of the worker, and snapshot images are captured by the
+# capture process through the snapshot client (see shared_ring.py).
+class RingBackend(CameraBackend):
+    name = "ring"
+
+    def __init__(self, camera_id = 0, ring = None, feeder = None, snapshots = None):
+        super().__init__()
+        self._camera_id = camera_id
+        self._ring = ring
+        self._feeder = feeder
+        self._snapshots = snapshots
+        self._stream = None
+
+    def start(self, stream, hls = None, hls_bitrate = 4000000, hls_iperiod = 60):
+        self._stream = stream
+        self._feeder.add(self._ring, stream)
+
+    def stop(self):
+        if self._stream is not None:
+            self._feeder.remove(self._stream)
+            self._stream = None
+
+    def capture_image(self):
+        _, image = self._snapshots.capture(self._camera_id)
+        return image
+
+BACKENDS = {
+    "picamera2": Picamera2Backend,
+    "synthetic": SyntheticBackend,
+    "replay": ReplayBackend,
+    "ring": RingBackend,
+    "relay": RelayBackend,
+}
+
+def create_backend(name, **options):
+    if name not in BACKENDS:
+        raise Exception(f"Unsupported camera backend: {name}")
+    return BACKENDS[name](**options)
@@ -0,0 +1,567 @@
+#!/usr/bin/env python
+
+# Benchmark tools for the camera servers, run on another machine (or on the
+# camera itself for a quick check) against a running camera server.
+#
+# "viewers" opens N concurrent viewers of the MJPEG stream and reports the
+# frame rate each viewer receives, which is used to find the viewer-count
+# ceiling of the "threading" and "asyncio" http modes (see README.md), and
+# with "--stalled" that fast viewers are not slowed down by stalled ones.
+#
+# "framing" runs locally without a camera server, and compares the CPU time
+# spent per viewer to frame and write the MJPEG parts, with the legacy
+# per-viewer headers (send_header/end_headers and four writes) and with the
+# shared part header written by one sendmsg.
+#
+# "hls" follows the HLS playlist of a running camera server (e.g. with the
+# synthetic camera), and validates the playlist, the TS packets and the
+# timing of each segment (PTS against EXTINF and target duration), and
+# reports the wait of blocking playlist reloads.
+#
+# "motion" runs locally without a camera server, and streams the synthetic
+# camera with and without motion detection, to compare the frame rate of
+# the stream and the CPU time of the process, and reports the frames taken
+# by the detector under its CPU budget and the time to process one.
+#
+# "workers" runs locally, starts the camera server with the synthetic camera
+# in one process and then with each number of worker processes (see
+# "http_workers" in README.md), and reports the frames delivered per second
+# to all viewers, the frame rate of the slowest viewer and the CPU usage of
+# all processes of the server, optionally while PNG snapshots are requested.
+#
+# "relay" runs locally, starts the camera server with the synthetic camera as
+# the upstream and a chain of relays of it (see "relay" camera in README.md),
+# and reports the frame rate and the latency (from the capture time of the
+# upstream) the viewers of the last relay get, optionally with an outage of
+# the upstream, to check that the relays connect to it again.
+
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import asyncio
+import tempfile
+import threading
+import subprocess
+
+import logging
+logger = logging.getLogger(__name__)
+
+# CPU time (seconds) and thread count of a local process, from /proc
+def process_stat(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    ticks = os.sysconf("SC_CLK_TCK")
+    cpu_time = (int(fields[11]) + int(fields[12])) / ticks
+    threads = int(fields[17])
+    return cpu_time, threads
+
+# pids of a local process and all of its descendants, from /proc
+def process_tree(pid):
+    children = {}
+    for name in os.listdir("/proc"):
+        if name.isdigit():
+            try:
+                with open(f"/proc/{name}/stat") as f:
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(name))
+    pids, pending = [], [pid]
+    while pending:
+        p = pending.pop()
+        pids.append(p)
+        pending += children.get(p, [])
+    return pids
+
+# CPU time (seconds) of the processes, 0 for processes which exited
+def processes_cpu_time(pids):
+    cpu_time = 0
+    for pid in pids:
+        try:
+            cpu_time += process_stat(pid)[0]
+        except OSError:
+            pass
+    return cpu_time
+
+# one viewer of the MJPEG stream, count received frames
+async def stream_viewer(host, port, path, duration, result):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(f"GET {path} HTTP/1.0\r\nHost: {host}\r\n\r\n".encode())
+        head = await reader.readuntil(b"\r\n\r\n")
+        if b" 200 " not in head.split(b"\r\n", 1)[0]:
+            result["error"] = head.split(b"\r\n", 1)[0].decode()
+            return
+        start_t = time.time()
+        while time.time() - start_t < duration:
+            await reader.readuntil(b"--FRAME\r\n")
+            headers = await reader.readuntil(b"\r\n\r\n")
+            length = 0
+            timestamp = None
+            for line in headers.decode("latin-1").split("\r\n"):
+                if line.lower().startswith("content-length:"):
+                    length = int(line.split(":", 1)[1])
+                elif line.lower().startswith("x-timestamp:"):
+                    timestamp = float(line.split(":", 1)[1])
+            await reader.readexactly(length)
+            result["frames"] += 1
+            result["bytes"] += length
+            # frames of the camera have their capture time, the logo has not
+            if timestamp is not None:
+                result["live"] += 1
+                result["latency"] += time.time() - timestamp
+        result["duration"] = time.time() - start_t
+    finally:
+        writer.close()
+
+# a viewer which never reads, e.g. a client behind a dead link
+async def stalled_viewer(host, port, path, duration):
+    reader, writer = await asyncio.open_connection(host, port, limit=1024)
+    writer.transport.pause_reading()
+    try:
+        writer.write(f"GET {path} HTTP/1.0\r\nHost: {host}\r\n\r\n".encode())
+        await asyncio.sleep(duration)
+    finally:
+        writer.close()
+
+async def run_viewers(host, port, path, viewers, duration, stalled = 0):
+    results = [{"frames": 0, "bytes": 0, "live": 0, "latency": 0, "duration": duration, "error": None}
+               for _ in range(viewers)]
+    stalled_tasks = [asyncio.create_task(stalled_viewer(host, port, path, duration)) for _ in range(stalled)]
+    tasks = [stream_viewer(host, port, path, duration, result) for result in results]
+    outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+    await asyncio.gather(*stalled_tasks, return_exceptions=True)
+    for result, outcome in zip(results, outcomes):
+        if isinstance(outcome, Exception):
+            result["error"] = repr(outcome)
+    return results
+
+def benchmark_viewers(host, port, path, viewers, duration, pid = None, stalled = 0):
+    stat = process_stat(pid) if pid else None
+    results = asyncio.run(run_viewers(host, port, path, viewers, duration, stalled))
+    errors = [r["error"] for r in results if r["error"]]
+    fps = sorted(r["frames"] / r["duration"] for r in results if not r["error"])
+    mbps = sum(r["bytes"] for r in results) * 8 / duration / 1e6
+    print(f"viewers: {viewers}, stalled: {stalled}, failed: {len(errors)}")
+    if fps:
+        print(f"fps per viewer: min {fps[0]:.1f}, median {fps[len(fps) // 2]:.1f}, max {fps[-1]:.1f}")
+    print(f"total throughput: {mbps:.1f} Mbit/s")
+    if stat:
+        cpu_time, _ = stat
+        end_cpu_time, threads = process_stat(pid)
+        print(f"server cpu: {(end_cpu_time - cpu_time) / duration * 100:.1f}%, threads: {threads}")
+    for error in sorted(set(errors)):
+        print(f"error: {error}")
+
+# legacy framing of BaseHTTPRequestHandler, headers are built for each viewer
+def legacy_part(wfile, frame):
+    wfile.write(b"--FRAME\r\n")
+    headers = []
+    headers.append(("%s: %s\r\n" % ("Content-Type", "image/jpeg")).encode("latin-1", "strict"))
+    headers.append(("%s: %s\r\n" % ("Content-Length", len(frame))).encode("latin-1", "strict"))
+    headers.append(b"\r\n")
+    wfile.write(b"".join(headers))
+    wfile.write(frame)
+    wfile.write(b"\r\n")
+
+# same as sendmsg_all() in camera.py
+def sendmsg_all(sock, buffers):
+    buffers = [memoryview(buf) for buf in buffers]
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        while sent > 0:
+            if sent >= len(buffers[0]):
+                sent -= len(buffers[0])
+                buffers.pop(0)
+            else:
+                buffers[0] = buffers[0][sent:]
+                sent = 0
+
+def drain_socket(sock):
+    buf = bytearray(1 << 20)
+    try:
+        while sock.recv_into(buf):
+            pass
+    except OSError:
+        pass
+
+# CPU time of the sending thread to send frames to viewers
+def framing_cpu_time(shared, viewers, frames, frame):
+    pairs = [socket.socketpair() for _ in range(viewers)]
+    drains = [threading.Thread(target=drain_socket, args=(b,), daemon=True) for _, b in pairs]
+    for t in drains:
+        t.start()
+    wfiles = [a.makefile("wb", buffering=0) for a, _ in pairs]
+    start_t = time.thread_time()
+    for _ in range(frames):
+        if shared:
+            header = f"--FRAME\r\nContent-Type: image/jpeg\r\nContent-Length: {len(frame)}\r\n\r\n".encode()
+            for a, _ in pairs:
+                sendmsg_all(a, [header, memoryview(frame), b"\r\n"])
+        else:
+            for wfile in wfiles:
+                legacy_part(wfile, frame)
+    cpu_time = time.thread_time() - start_t
+    for wfile in wfiles:
+        wfile.close()
+    for a, _ in pairs:
+        a.close()
+    for t in drains:
+        t.join()
+    for _, b in pairs:
+        b.close()
+    return cpu_time
+
+def benchmark_framing(viewers, duration, fps, frame_size):
+    frames = int(duration * fps)
+    frame = os.urandom(frame_size)
+    print(f"viewers: {viewers}, frames: {frames}, frame size: {frame_size}, fps: {fps}")
+    for shared in (False, True):
+        cpu_time = framing_cpu_time(shared, viewers, frames, frame)
+        per_part = cpu_time / (frames * viewers)
+        print(f"{'shared header + sendmsg' if shared else 'legacy per-viewer headers'}: "
+              f"{per_part * 1e6:.1f} us per part, {per_part * fps * 100:.2f}% cpu per viewer at {fps} fps")
+
+# TS packets of a segment, check sync bytes and continuity counters, return
+# the PTS (seconds) of each PES of the video PID, the random access points
+# and errors
+def parse_ts(data, video_pid = 0x100):
+    pts, keyframes, errors, counters = [], 0, [], {}
+    if len(data) % 188:
+        errors.append(f"size {len(data)} is not a multiple of 188")
+    for offset in range(0, len(data) - 187, 188):
+        packet = data[offset:offset + 188]
+        if packet[0] != 0x47:
+            errors.append(f"no sync byte at {offset}")
+            continue
+        pid = ((packet[1] & 0x1F) << 8) | packet[2]
+        adaptation, cc = (packet[3] >> 4) & 0x03, packet[3] & 0x0F
+        if adaptation & 0x01:
+            if pid in counters and cc != (counters[pid] + 1) & 0x0F:
+                errors.append(f"continuity error of pid {pid} at {offset}")
+            counters[pid] = cc
+        pos = 4
+        if adaptation & 0x02:
+            if packet[4] > 0 and packet[5] & 0x40:
+                keyframes += 1
+            pos += 1 + packet[4]
+        if pid == video_pid and packet[1] & 0x40:
+            pes = packet[pos:]
+            if pes[:3] != b"\x00\x00\x01" or not pes[7] & 0x80:
+                errors.append(f"bad PES header at {offset}")
+                continue
+            b = pes[9:14]
+            value = ((b[0] >> 1) & 0x07) << 30 | b[1] << 22 | (b[2] >> 1) << 15 | b[3] << 7 | b[4] >> 1
+            pts.append(value / 90000)
+    return pts, keyframes, errors
+
+def parse_playlist(text):
+    tags, segments, parts = {}, [], []
+    lines = text.splitlines()
+    extinf = None
+    for line in lines:
+        if line.startswith("#EXTINF:"):
+            extinf = float(line[8:].split(",")[0])
+        elif line.startswith("#EXT-X-PART:"):
+            parts.append(line)
+        elif line.startswith("#EXT-X-") and ":" in line:
+            key, value = line[1:].split(":", 1)
+            tags[key] = value
+        elif line and not line.startswith("#"):
+            segments.append((line, extinf))
+    return lines[0] if lines else "", tags, segments, parts
+
+def http_get(url):
+    import urllib.request
+    with urllib.request.urlopen(url, timeout=30) as response:
+        return response.read(), response.headers
+
+def benchmark_hls(host, port, duration):
+    base = f"http://{host}:{port}/hls/"
+    errors, waits, checked = [], [], {}
+    start_t = time.time()
+    msn = None
+    while time.time() - start_t < duration:
+        url = base + "live.m3u8"
+        if msn is not None:
+            url += f"?_HLS_msn={msn + 1}"
+        request_t = time.time()
+        body, headers = http_get(url)
+        if msn is not None:
+            waits.append(time.time() - request_t)
+        first, tags, segments, parts = parse_playlist(body.decode())
+        if first != "#EXTM3U":
+            errors.append("playlist does not start with #EXTM3U")
+        if "Cache-Control" not in headers:
+            errors.append("no Cache-Control for playlist")
+        target = int(tags.get("EXT-X-TARGETDURATION", 0))
+        sequence = int(tags.get("EXT-X-MEDIA-SEQUENCE", 0))
+        for i, (uri, extinf) in enumerate(segments):
+            if round(extinf) > target:
+                errors.append(f"{uri}: EXTINF {extinf} over target duration {target}")
+            seg_msn = sequence + i
+            if seg_msn in checked:
+                continue
+            data, seg_headers = http_get(base + uri)
+            pts, keyframes, ts_errors = parse_ts(data)
+            errors += [f"{uri}: {e}" for e in ts_errors]
+            if not keyframes:
+                errors.append(f"{uri}: no random access point")
+            if "immutable" not in seg_headers.get("Cache-Control", ""):
+                errors.append(f"{uri}: segment is not cacheable")
+            checked[seg_msn] = (extinf, pts[0] if pts else None, len(data))
+        if "CAN-BLOCK-RELOAD=YES" not in tags.get("EXT-X-SERVER-CONTROL", ""):
+            time.sleep(target / 2)
+        msn = sequence + len(segments) - 1
+    # segment duration is the PTS distance to the next segment
+    deviations = []
+    for seg_msn in sorted(checked)[:-1]:
+        extinf, pts, _ = checked[seg_msn]
+        next_entry = checked.get(seg_msn + 1)
+        if next_entry is None or pts is None or next_entry[1] is None:
+            continue
+        deviation = (next_entry[1] - pts) - extinf
+        deviations.append(abs(deviation))
+        if abs(deviation) > 0.05:
+            errors.append(f"segment {seg_msn}: EXTINF {extinf:.3f} but PTS duration {next_entry[1] - pts:.3f}")
+    sizes = [size for _, _, size in checked.values()]
+    print(f"segments: {len(checked)}, mean size: {sum(sizes) / max(len(sizes), 1) / 1024:.0f} kB")
+    if deviations:
+        print(f"EXTINF vs PTS duration: max deviation {max(deviations) * 1000:.1f} ms")
+    if waits:
+        print(f"blocking reload wait: mean {sum(waits) / len(waits):.3f}s, max {max(waits):.3f}s")
+    print(f"errors: {len(errors)}")
+    for error in errors[:20]:
+        print(f"error: {error}")
+
+# stream of the synthetic camera, frames are counted and dropped
+class CountingStream(object):
+    def __init__(self):
+        self.frames = 0
+
+    def write_frame(self, data, timestamp = None, encoded_t = None):
+        self.frames += 1
+
+def stream_synthetic(resolution, fps, duration, detector = None):
+    from backends import SyntheticBackend
+    camera = SyntheticBackend()
+    camera.open({"hflip": False, "vflip": False}, fps, resolution, resolution)
+    stream = CountingStream()
+    if detector is not None:
+        camera.frame_callback = lambda main, lores: detector.on_frame(lores)
+        detector.start()
+    cpu_time = time.process_time()
+    camera.start(stream)
+    time.sleep(duration)
+    camera.stop()
+    cpu_time = time.process_time() - cpu_time
+    if detector is not None:
+        detector.stop()
+    return stream.frames / duration, cpu_time / duration
+
+def benchmark_motion(duration, resolution, fps, width, budget, motion_fps):
+    from motion import MotionDetector
+    print(f"synthetic camera: {resolution[0]}x{resolution[1]} at {fps} fps")
+    # time to process one frame, with the moving test pattern
+    from backends import SyntheticBackend
+    camera = SyntheticBackend()
+    camera.open({"hflip": False, "vflip": False}, fps, resolution, resolution)
+    import numpy
+    planes = [numpy.asarray(camera.render(resolution, seq, time.time()).convert("L")) for seq in range(int(fps))]
+    detector = MotionDetector(width, fps, budget)
+    start_t = time.perf_counter()
+    for i, plane in enumerate(planes * 4):
+        detector.process(plane, i / fps)
+    per_frame = (time.perf_counter() - start_t) / (len(planes) * 4)
+    print(f"process: {per_frame * 1000:.2f} ms per frame at width {width}, events: {detector.stats()['events']}")
+    stream_fps, cpu = stream_synthetic(resolution, fps, duration)
+    print(f"without motion detection: {stream_fps:.1f} fps, cpu {cpu * 100:.1f}%")
+    detector = MotionDetector(width, motion_fps, budget)
+    stream_fps, cpu = stream_synthetic(resolution, fps, duration, detector)
+    stats = detector.stats()
+    print(f"with motion detection: {stream_fps:.1f} fps, cpu {cpu * 100:.1f}%")
+    print(f"detector: {stats['processed'] / duration:.1f} frames/s taken, {stats['skipped']} skipped, "
+          f"{stats['cost_ms']:.2f} ms per frame, budget {budget * 100:g}% of a core, events: {stats['events']}")
+
+# request snapshots at the rate (per second), e.g. to load the server with
+# PNG encoding while the viewers are streaming
+async def snapshot_requests(host, port, path, rate, duration, result):
+    start_t = time.time()
+    while time.time() - start_t < duration:
+        request_t = time.time()
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+            writer.write(f"GET {path} HTTP/1.0\r\nHost: {host}\r\n\r\n".encode())
+            await reader.read()
+            writer.close()
+            result["snapshots"] += 1
+            result["snapshot_time"] += time.time() - request_t
+        except OSError:
+            result["snapshot_errors"] += 1
+        await asyncio.sleep(max(1 / rate - (time.time() - request_t), 0))
+
+async def run_load(port, viewers, duration, snapshot_rate):
+    result = {"snapshots": 0, "snapshot_time": 0, "snapshot_errors": 0}
+    tasks = [run_viewers("127.0.0.1", port, "/stream.mjpg", viewers, duration)]
+    if snapshot_rate > 0:
+        tasks.append(snapshot_requests("127.0.0.1", port, "/snapshot.png", snapshot_rate, duration, result))
+    results = await asyncio.gather(*tasks)
+    return results[0], result
+
+def wait_port(port, timeout = 30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.5)
+    return False
+
+# camera server of the synthetic camera with the workers (0 for one process),
+# the options override the config, e.g. of another camera backend
+def start_server(directory, port, http_mode, workers = 0, **options):
+    video_config = os.path.join(directory, f"video_config-{port}.json")
+    with open(video_config, "w") as f:
+        json.dump({}, f)
+    config = {"http_port": port, "ws_port": port + 1, "http_mode": http_mode, "http_workers": workers,
+              "camera_backend": "synthetic", "video_config": video_config}
+    config.update(options)
+    config_file = os.path.join(directory, f"camera-{port}.json")
+    with open(config_file, "w") as f:
+        json.dump(config, f)
+    return subprocess.Popen([sys.executable, "camera.py", "-c", config_file, "--log_level", "WARNING"],
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+
+def stop_server(server):
+    server.send_signal(signal.SIGINT)
+    try:
+        server.wait(30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+def benchmark_workers(port, http_mode, workers_list, viewers, duration, snapshot_rate):
+    print(f"viewers: {viewers}, http mode: {http_mode}, snapshots: {snapshot_rate}/s, cpus: {os.cpu_count()}")
+    for workers in workers_list:
+        with tempfile.TemporaryDirectory() as directory:
+            server = start_server(directory, port, http_mode, workers)
+            try:
+                if not wait_port(port):
+                    print(f"workers: {workers}, server did not start")
+                    continue
+                time.sleep(2) # workers ready, frames flowing
+                pids = process_tree(server.pid)
+                cpu_time = processes_cpu_time(pids)
+                results, snapshots = asyncio.run(run_load(port, viewers, duration, snapshot_rate))
+                cpu = (processes_cpu_time(pids) - cpu_time) / duration
+            finally:
+                stop_server(server)
+        fps = sorted(r["frames"] / r["duration"] for r in results if not r["error"])
+        failed = sum(1 for r in results if r["error"])
+        mbps = sum(r["bytes"] for r in results) * 8 / duration / 1e6
+        line = (f"workers: {workers}, frames: {sum(fps):.0f}/s, slowest viewer: {fps[0] if fps else 0:.1f} fps, "
+                f"throughput: {mbps:.1f} Mbit/s, cpu: {cpu * 100:.0f}%, failed: {failed}")
+        if snapshots["snapshots"]:
+            line += f", snapshot: {snapshots['snapshot_time'] / snapshots['snapshots']:.3f}s"
+        print(line)
+
+# stop the upstream after a third of the duration, and start it again after
+# the outage
+def upstream_outage(servers, directory, port, http_mode, duration, outage):
+    time.sleep(duration / 3)
+    print(f"upstream stopped for {outage:.1f}s")
+    stop_server(servers[0])
+    time.sleep(outage)
+    servers[0] = start_server(directory, port, http_mode)
+
+def benchmark_relay(port, http_mode, hops_list, viewers, duration, outage):
+    print(f"viewers: {viewers}, http mode: {http_mode}, outage: {outage}s")
+    for hops in hops_list:
+        with tempfile.TemporaryDirectory() as directory:
+            # the upstream at the port, the relays at the next ports (with
+            # their websocket servers), each relays the previous one
+            servers = [start_server(directory, port, http_mode)]
+            try:
+                for hop in range(1, hops + 1):
+                    servers.append(start_server(directory, port + hop * 2, http_mode, camera_backend = "relay",
+                                                relay_url = f"http://127.0.0.1:{port + (hop - 1) * 2}",
+                                                relay_timeout = 5, relay_max_reconnect_delay = 5))
+                if not all(wait_port(port + hop * 2) for hop in range(hops + 1)):
+                    print(f"hops: {hops}, server did not start")
+                    continue
+                time.sleep(2) # relays connected, frames flowing
+                thread = None
+                if outage > 0 and hops > 0:
+                    thread = threading.Thread(target=upstream_outage,
+                                              args=(servers, directory, port, http_mode, duration, outage))
+                    thread.start()
+                results = asyncio.run(run_viewers("127.0.0.1", port + hops * 2, "/stream.mjpg", viewers, duration))
+                if thread is not None:
+                    thread.join()
+            finally:
+                for server in reversed(servers):
+                    stop_server(server)
+        fps = sorted(r["frames"] / r["duration"] for r in results if not r["error"])
+        failed = sum(1 for r in results if r["error"])
+        live = sum(r["live"] for r in results)
+        latency = sum(r["latency"] for r in results) / live if live else 0
+        idle = sum(r["frames"] - r["live"] for r in results)
+        print(f"hops: {hops}, slowest viewer: {fps[0] if fps else 0:.1f} fps, latency: {latency * 1000:.1f} ms, "
+              f"live frames: {live}, logo frames: {idle}, failed: {failed}")
+
+import argparse
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Live Camera Benchmark")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=80)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--pid", type=int, default=None, help="server pid for cpu usage (local only)")
+    parser.add_argument("--log_level", type=str, default="INFO")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    viewers_parser = subparsers.add_parser("viewers", help="concurrent viewers of video stream")
+    viewers_parser.add_argument("--path", type=str, default="/stream.mjpg")
+    viewers_parser.add_argument("--viewers", "-n", type=int, default=10)
+    viewers_parser.add_argument("--stalled", type=int, default=0, help="extra viewers which never read")
+    framing_parser = subparsers.add_parser("framing", help="cpu time of multipart framing (local)")
+    framing_parser.add_argument("--viewers", "-n", type=int, default=10)
+    framing_parser.add_argument("--fps", type=float, default=30)
+    # 32 Mbit/s MJPEG of 1280x720 at 30 fps
+    framing_parser.add_argument("--frame_size", type=int, default=133333)
+    subparsers.add_parser("hls", help="validate HLS playlist and segment timing")
+    motion_parser = subparsers.add_parser("motion", help="motion detection on the synthetic camera (local)")
+    motion_parser.add_argument("--resolution", type=int, nargs=2, default=[640, 480])
+    motion_parser.add_argument("--fps", type=float, default=30)
+    motion_parser.add_argument("--width", type=int, default=160, help="width of downsampled frames")
+    motion_parser.add_argument("--budget", type=float, default=0.05, help="share of a core")
+    motion_parser.add_argument("--motion_fps", type=float, default=10)
+    workers_parser = subparsers.add_parser("workers", help="scaling of viewers with worker processes (local)")
+    workers_parser.add_argument("--workers", type=int, nargs="+", default=[0, 1, 2, 4], help="0 for one process")
+    workers_parser.add_argument("--viewers", "-n", type=int, default=50)
+    workers_parser.add_argument("--http_mode", type=str, default="threading")
+    workers_parser.add_argument("--snapshots", type=float, default=0, help="PNG snapshots requested per second")
+    relay_parser = subparsers.add_parser("relay", help="frame rate and latency through a chain of relays (local)")
+    relay_parser.add_argument("--hops", type=int, nargs="+", default=[0, 1, 2], help="0 for the upstream itself")
+    relay_parser.add_argument("--viewers", "-n", type=int, default=10)
+    relay_parser.add_argument("--http_mode", type=str, default="asyncio")
+    relay_parser.add_argument("--outage", type=float, default=0, help="seconds the upstream of relays is stopped")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format="%(asctime)s - %(levelname)s - %(message)s")
+    logger.info(vars(args))
+
+    if args.command == "viewers":
+        benchmark_viewers(args.host, args.port, args.path, args.viewers, args.duration, args.pid, args.stalled)
+    elif args.command == "framing":
+        benchmark_framing(args.viewers, args.duration, args.fps, args.frame_size)
+    elif args.command == "hls":
+        benchmark_hls(args.host, args.port, args.duration)
+    elif args.command == "motion":
+        benchmark_motion(args.duration, tuple(args.resolution), args.fps, args.width, args.budget, args.motion_fps)
+    elif args.command == "workers":
+        benchmark_workers(args.port, args.http_mode, args.workers, args.viewers, args.duration, args.snapshots)
+    elif args.command == "relay":
+        benchmark_relay(args.port, args.http_mode, args.hops, args.viewers, args.duration, args.outage)
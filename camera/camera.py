@@ -5,7 +5,6 @@ import json
 import time 
 import asyncio
 import threading
-import subprocess
 
 import logging
 logger = logging.getLogger(__name__)
@@ -22,12 +21,50 @@ def singleton(cls):
 
 # There are three types of images will be send to client side, including 
 # frames of video stream, snapshot image, and a static image showing when  
-# video stream and snapshot is not ready or in error state. We use three 
-# buffers to manage the images, which have same interface. 
+# video stream and snapshot is not ready or in error state. The frames of 
+# video stream and the logo image are managed with buffers, and snapshot 
+# images are managed by snapshot engine (see snapshot.py). 
  
 import io
 from PIL import Image
 
+# Frames of video stream are sent to client as parts of a multipart response. 
+# The part header is built once per frame and shared by all viewers, and the 
+# part (header, JPEG data, and trailing CRLF) is written with one vectored 
+# write, so the JPEG data is never joined or copied for each viewer. 
+
+from frame_hub import Frame, FrameHub, FrameCursor 
+
+MULTIPART_BOUNDARY = "FRAME" 
+
+# the capture timestamp of the frame (if any) allows a saved stream to be 
+# replayed at its original timing (replay camera) 
+def multipart_header(data, timestamp = None): 
+    return (f"--{MULTIPART_BOUNDARY}\r\n" 
+            f"Content-Type: image/jpeg\r\n" 
+            f"Content-Length: {len(data)}\r\n" 
+            + (f"X-Timestamp: {timestamp:.6f}\r\n" if timestamp is not None else "") 
+            + "\r\n").encode() 
+
+def multipart_parts(frame): 
+    return [frame.header, memoryview(frame.data), b"\r\n"] 
+
+# drop the sent bytes from the front of the buffers (memoryviews) 
+def skip_sent(buffers, sent): 
+    while sent > 0: 
+        if sent >= len(buffers[0]): 
+            sent -= len(buffers[0]) 
+            buffers.pop(0) 
+        else: 
+            buffers[0] = buffers[0][sent:] 
+            sent = 0 
+
+# send all buffers with sendmsg (scatter/gather), resume after partial send 
+def sendmsg_all(sock, buffers): 
+    buffers = [memoryview(buf) for buf in buffers] 
+    while buffers: 
+        skip_sent(buffers, sock.sendmsg(buffers)) 
+
 # When camera is not ready or in error state, we will show a "logo" image.  
 class LogoBuffer(io.BufferedIOBase): 
     def __init__(self, logo_file = None): 
@@ -43,69 +80,238 @@ class LogoBuffer(io.BufferedIOBase):
             image.save(buf, format='jpeg') 
             self._frame = buf.getvalue() 
         logger.debug(f"Logo image size: {len(self._frame)}")
+        self._stream_frame = Frame(0, time.time(), self._frame, multipart_header(self._frame)) 
 
     def read(self): 
         return self._frame 
 
-# Snapshot "write" image which is read by web server. 
-class FrameBuffer(io.BufferedIOBase): 
-    def __init__(self): 
-        self._frame = None 
+    # logo as a frame of video stream 
+    @property 
+    def frame(self): 
+        return self._stream_frame 
 
-    def write(self, buf): 
-        self._frame = buf 
+# Latency of each frame is measured from its capture timestamp to the encoder 
+# output ("encode"), to the stream buffer ("publish"), and to the completed 
+# write to each viewer ("send"), see metrics.py for "/metrics". 
+
+from metrics import registry 
+
+FRAME_LATENCY = registry.histogram("camera_frame_latency_seconds", 
+    "Latency of frames from capture to each stage", ("stream", "stage")) 
+FRAME_INTERVAL = registry.histogram("camera_frame_interval_seconds", 
+    "Interval between frames published to a stream", ("stream",)) 
+FRAMES = registry.counter("camera_frames_total", "Frames published to a stream", ("stream",)) 
 
-    def read(self): 
-        return self._frame 
-        
 # video stream is supposed to "write" and "read" in a loop. 
-class StreamBuffer(io.BufferedIOBase):
-    def __init__(self):
-        self._condition = threading.Condition()
-        self._frame = None 
-        self._last_write_t = time.time()
-        self._last_read_t = time.time()
+# Frames are published to a broadcast hub with sequence numbers and capture 
+# timestamps, each consumer reads with its own cursor (see frame_hub.py). 
+# Listeners are called in the writer (encoder) thread for each frame, which 
+# allows a consumer, e.g. the asyncio web server, to hand over the frame to 
+# its own thread or event loop instead of blocking a thread in read(). 
+# The name of a stream is the "stream" label of its metrics. 
+
+class StreamBuffer(FrameHub, io.BufferedIOBase):
+    def __init__(self, ring_size = 8, name = "stream"):
+        super().__init__(ring_size) 
+        self._name = name 
+        self._encode_latency = FRAME_LATENCY.labels(name, "encode") 
+        self._publish_latency = FRAME_LATENCY.labels(name, "publish") 
+        self._interval = FRAME_INTERVAL.labels(name) 
+        self._frames = FRAMES.labels(name) 
+        self._last_published_t = None 
+        self._bytes_published = 0 
 
-    def write(self, buf):
-        with self._condition:
-            if time.time() - self._last_write_t > 0.2: # lower than 5 fps 
-                logger.warning(f"write after: {time.time() - self._last_write_t}")
-            self._last_write_t = time.time()
-            self._frame = buf
-            self._condition.notify_all()
+    @property 
+    def name(self): 
+        return self._name 
 
+    # bytes of all frames published, e.g. for bitrate of the stream 
+    @property 
+    def bytes_published(self): 
+        return self._bytes_published 
+
+    def write(self, buf):
+        self.write_frame(buf) 
+        return len(buf) 
+
+    # publish a JPEG frame with its capture timestamp, e.g. of derived streams, 
+    # and the time of encoder output if known 
+    def write_frame(self, data, timestamp = None, encoded_t = None): 
+        timestamp = timestamp if timestamp is not None else time.time() 
+        frame = self.publish(data, timestamp, multipart_header(data, timestamp), encoded_t) 
+        if encoded_t is not None: 
+            self._encode_latency.observe(encoded_t - timestamp) 
+        self._publish_latency.observe(frame.published_t - timestamp) 
+        if self._last_published_t is not None: 
+            self._interval.observe(frame.published_t - self._last_published_t) 
+        self._last_published_t = frame.published_t 
+        self._bytes_published += len(data) 
+        self._frames.inc() 
+        return frame 
+
+    # data of the newest frame after the latest one, None if timeout 
     def read(self): 
-        with self._condition:
-            if time.time() - self._last_read_t > 0.2: # lower than 5 fps 
-                logger.warning(f"read after: {time.time() - self._last_read_t}")
-            self._last_read_t = time.time()
-            return self._frame if self._condition.wait(1) else None 
+        frame = self.latest_after(self.seq, 1) 
+        return frame.data if frame is not None else None 
+
+# A viewer of video stream always gets the newest frame (the cursor skips), 
+# on top of the cursor it accounts the frames and bytes sent to the client, 
+# the frames skipped for backpressure, and the latency of the last frame. 
+# A client is stalled if no frame was sent out in "stall_timeout" seconds. 
+class StreamClient(FrameCursor): 
+    def __init__(self, hub, name, max_inflight_bytes = 0, stall_timeout = 0): 
+        super().__init__(hub, name, skip = True) 
+        self._send_latency = FRAME_LATENCY.labels(hub.name, "send") 
+        self.max_inflight_bytes = max_inflight_bytes # 0 for no limit 
+        self.stall_timeout = stall_timeout # 0 for no limit 
+        self.frames_sent = 0 
+        self.bytes_sent = 0 
+        self.skipped = 0 
+        self.inflight_bytes = 0 
+        self.latency = 0.0 
+        self.last_sent_t = time.time() 
+
+    # frame was written out (to socket or transport buffer) 
+    def sent(self, frame, size, inflight_bytes = 0): 
+        self.last_sent_t = time.time() 
+        self.frames_sent += 1 
+        self.bytes_sent += size 
+        self.inflight_bytes = inflight_bytes 
+        self.latency = self.last_sent_t - frame.timestamp 
+        self._send_latency.observe(self.latency) 
+
+    # frame was not sent for too many bytes in flight 
+    def skip(self, inflight_bytes = 0): 
+        self.skipped += 1 
+        self.inflight_bytes = inflight_bytes 
+
+    @property 
+    def stalled(self): 
+        return self.stall_timeout > 0 and time.time() - self.last_sent_t > self.stall_timeout 
+
+    def stats(self): 
+        stats = super().stats() 
+        stats.update({ 
+            "frames_sent": self.frames_sent, 
+            "bytes_sent": self.bytes_sent, 
+            "skipped": self.skipped, 
+            "inflight_bytes": self.inflight_bytes, 
+            "latency": self.latency, 
+            "stalled": time.time() - self.last_sent_t, 
+        }) 
+        return stats 
 
 # VideoServer works with one camera sensor, 
 # to manage the video streaming and snapshot. 
-
-from picamera2 import Picamera2
-from picamera2.encoders import MJPEGEncoder
-from picamera2.outputs import FileOutput
-from libcamera import Transform
-
+# The camera is a backend selected in camera.json, the real camera (Picamera2), 
+# a synthetic or replay camera which runs without camera hardware, or a relay 
+# of the stream of another camera server. 
+# Several cameras are served by their own video servers (see VideoServers), 
+# each with its own video config, buffers, encoders and threads, so nothing 
+# is shared by the pipelines of the cameras. The streams of camera 0 are 
+# named as before, the streams of camera <n> are prefixed by "cam<n>_". 
+
+from backends import create_backend 
 from video_config import VideoConfig 
-
-@singleton 
+from snapshot import SnapshotEngine, SNAPSHOT_FORMATS 
+from tiles import TileCache 
+from roi import RoiArbiter, RoiStream, fit_rect 
+from variants import StreamVariants 
+from hls import HlsStream 
+from speedtest import SpeedTests 
+from recorder import Recorder 
+from motion import MotionDetector 
+from instant_replay import InstantReplay, is_clip_path, clip_response 
+from timelapse import Timelapse, is_timelapse_path, timelapse_response 
+from thumbnail import Thumbnails, is_thumbnail_path, thumbnail_response 
+
+# video settings applied as camera controls, others reconfigure the camera 
+CONTROLS = {"af_mode": "AfMode", "awb_mode": "AwbMode", "brightness": "Brightness"} 
+
+# The parts of a video server are configured by a mapping of the parameters 
+# of each part (see VIDEO_SERVER_SETTINGS), the defaults of the parts apply 
+# to missing parameters, and an optional part (HLS, recording, motion, 
+# instant replay and timelapse) is disabled by None. 
 class VideoServer(object): 
-    def __init__(self, config_file = "video_config.json"):
+    def __init__(self, camera_id = 0, config_file = "video_config.json", 
+                 camera_backend = "picamera2", camera_options = {}, 
+                 snapshot = {}, tiles = {}, thumbnail = {}, roi = {}, variants = {}, 
+                 hls = None, record = None, motion = None, instant_replay = None, timelapse = None): 
+        self._id = camera_id 
+        prefix = f"cam{camera_id}_" if camera_id else "" 
+
         # config manager 
         self._config = VideoConfig(config_file) 
 
+        # camera backend, created when the camera is opened 
+        self._camera_backend = camera_backend 
+        self._camera_options = camera_options 
+
         # logo  
         logo_file = "logo.jpg" 
         logger.debug(f"{logo_file=}")
         self._logo_buffer = LogoBuffer(logo_file) 
 
         # stream and snapshot 
-        self._stream_buffer = StreamBuffer()
-        self._snapshot_buffer = FrameBuffer() 
-        self.picam2 = None 
+        self._stream_buffer = StreamBuffer(name = f"{prefix}stream") 
+        self._stream_variants = StreamVariants(self._stream_buffer, lambda label: StreamBuffer(name = f"{prefix}{label}"), 
+                                               **variants) 
+        self._snapshot_engine = SnapshotEngine(self.capture_snapshot, **snapshot) 
+        self._tile_cache = TileCache(self._snapshot_engine, **tiles) 
+        # thumbnails are downscaled from stream frames, not captured 
+        self._thumbnails = Thumbnails(self._stream_buffer, **thumbnail) 
+
+        # region of interest, "crop" mode crops the ROI from "main" stream into 
+        # its own stream, "sensor" mode crops the sensor (ScalerCrop) for all 
+        # viewers, "off" to disable 
+        roi = dict(roi) 
+        roi_mode = roi.pop("mode", "crop") 
+        if roi_mode not in ("crop", "sensor", "off"): 
+            raise Exception(f"Unsupported ROI mode: {roi_mode}") 
+        self._roi_mode = roi_mode 
+        self._roi_arbiter = RoiArbiter(roi.pop("policy", "latest"), roi.pop("lease", 10)) 
+        self._roi_stream = RoiStream(StreamBuffer(name = f"{prefix}roi"), **roi) 
+        self._roi_aspect = 1.0 
+        self._roi_applied = None 
+        self._roi_check_t = 0 
+
+        # HLS (H.264) stream from "lores" stream, next to MJPEG stream 
+        self._hls = None 
+        self._hls_bitrate = 4000000 
+        if hls is not None: 
+            hls = dict(hls) 
+            self._hls_bitrate = hls.pop("bitrate", self._hls_bitrate) 
+            self._hls = HlsStream(**hls) 
+
+        # continuous recording of MJPEG stream into a ring of segments, only 
+        # while there is motion if "on_motion" 
+        self._recorder = None 
+        if record is not None: 
+            record = dict(record) 
+            triggered = record.pop("on_motion", False) and motion is not None 
+            self._recorder = Recorder(self._stream_buffer, triggered = triggered, **record) 
+
+        # recent frames of MJPEG stream in memory, exported as clips 
+        self._instant_replay = InstantReplay(self._stream_buffer, **instant_replay) if instant_replay is not None else None 
+
+        # timelapse of downscaled captures of "main" stream, taken by snapshot 
+        # engine, assembled into movies on demand 
+        self._timelapse = Timelapse(self.capture_timelapse, **timelapse) if timelapse is not None else None 
+
+        # motion detection on "lores" stream, an event may capture a snapshot 
+        # and trigger recording 
+        self._motion = None 
+        self._motion_snapshot = None 
+        self._motion_snapshot_enabled = False 
+        if motion is not None: 
+            motion = dict(motion) 
+            self._motion_snapshot_enabled = motion.pop("snapshot", False) 
+            self._motion = MotionDetector(**motion) 
+            self._motion.add_listener(self._on_motion) 
+        self._camera = None 
+        self._reconfiguring = False 
+        self._reconfigure_lock = threading.Lock() 
+        self._settings_lock = threading.Lock() 
 
     def open_camera(self): 
         logger.info("Open camera with initial setup") 
@@ -118,91 +324,83 @@ class VideoServer(object):
         snapshot_resolution = self._config.snapshot_resolution() 
         logger.info(f"{snapshot_resolution=}")
 
-        self.picam2 = Picamera2() 
-        video_config = self.picam2.create_video_configuration(
-            main = {"size": snapshot_resolution, "format": "RGB888"},
-            lores = {"size": resolution},  
-            encode = "lores",
-            buffer_count = 2, 
-            display = None, 
-            transform = Transform(hflip=transform["hflip"], vflip=transform["vflip"]), 
-            controls = {"FrameRate": frame_rate}
-        )
-        logger.info(f"{video_config=}")
-        self.picam2.configure(video_config)
-
-        # apply controls 
+        camera = create_backend(self._camera_backend, **self._camera_options) 
+        logger.info(f"camera backend: {camera.name}") 
+        camera.open(transform, frame_rate, resolution, snapshot_resolution) 
+        self._camera = camera 
+        self.configure_streams() 
+        camera.frame_callback = self._on_frame 
+        self.apply_config_controls() 
+        logger.info(f"{camera.camera_controls=}")
+
+    # controls of video config, the configuration of the camera resets them 
+    def apply_config_controls(self): 
         logger.info("Apply camera controls")
-        self.apply_controls("AfMode", self._config.af_mode()) 
-        self.apply_controls("AwbMode", self._config.awb_mode())
-        self.apply_controls("Brightness", self._config.brightness())
-        logger.info(f"{self.picam2.camera_controls=}")
+        self.set_controls({CONTROLS[name]: value for name, value in self._config.settings().items() if name in CONTROLS}) 
+
+    # derived streams follow the settings of the camera 
+    def configure_streams(self): 
+        _, frame_rate, resolution, snapshot_resolution = self._camera.settings 
+        # ROI is expanded to the aspect ratio of the stream 
+        if self._roi_mode == "sensor": 
+            _, _, crop_width, crop_height = self._camera.properties["ScalerCropMaximum"] 
+            self._roi_aspect = (resolution[0] / resolution[1]) / (crop_width / crop_height) 
+        else: 
+            self._roi_aspect = (resolution[0] / resolution[1]) / (snapshot_resolution[0] / snapshot_resolution[1]) 
+        self._roi_stream.set_size(resolution) 
+        self._stream_variants.set_primary(resolution, frame_rate) 
+        self._roi_applied = None 
 
     def apply_controls(self, name, value): 
-        logger.info(f"apply_controls {name}: {value}")
+        return self.set_controls({name: value}) 
+
+    # Apply several video settings at once, {name: selected option or value}, 
+    # all are validated before any is applied, and the changed controls are 
+    # set with one call. If the camera rejects the controls, all settings are 
+    # restored and nothing is saved. Return the names of changed settings, and 
+    # if the camera needs to be reconfigured (transform, frame rate or resolution). 
+    def apply_settings(self, params): 
+        with self._settings_lock: 
+            previous = self._config.backup(params.keys()) 
+            try: 
+                changes = self._config.update(params) 
+            except Exception as e: 
+                raise Exception(f"Error to update video settings: {e}") 
+            controls = {CONTROLS[name]: value for name, value in changes.items() if name in CONTROLS} 
+            if controls and not self.set_controls(controls): 
+                self._config.restore(previous) 
+                raise Exception(f"Error to apply video settings: {', '.join(changes.keys())}") 
+        if changes: 
+            self._config.save_later() 
+        reconfigure = any(name not in CONTROLS for name in changes) 
+        return list(changes.keys()), reconfigure 
+
+    # set controls with one call 
+    def set_controls(self, controls): 
+        logger.info(f"set_controls {controls}")
         try: 
-            if self.picam2 is not None: 
-                self.picam2.set_controls({name: value})
-                logger.info(f"{self.picam2.controls=}")
+            if self._camera is not None: 
+                self._camera.set_controls(controls)
+                logger.info(f"{self._camera.controls=}")
             else: 
                 logger.warning("Camera is not opened yet") 
             return True 
         except Exception as e: 
             logger.warning(f"Error to apply controls: {e}")
             return False 
- 
-    # return True is transform changed    
-    def update_transform(self, selected): 
-        try: 
-            transform = self._config.update_transform(selected) 
-            return self._config.save() if transform is not None else False 
-        except Exception as e: 
-            raise Exception(f"Error to update transform: {e}")
-
-    # return True is frame rate changed    
-    def update_frame_rate(self, selected): 
-        try: 
-            frame_rate = self._config.update_frame_rate(selected) 
-            return self._config.save() if frame_rate is not None else False 
-        except Exception as e: 
-            raise Exception(f"Error to update frame rate: {e}")
-
-    # return False if no change     
-    def update_resolution(self, selected): 
-        try: 
-            resolution = self._config.update_resolution(selected) 
-            return self._config.save() if resolution is not None else False 
-        except Exception as e: 
-            raise Exception(f"Error to update resolution: {e}")
-
-    # return False if no change  
-    def apply_af_mode(self, selected): 
-        try: 
-            af_mode = self._config.update_af_mode(selected) 
-            return self.apply_controls("AfMode", af_mode) if af_mode is not None else False  
-        except Exception as e: 
-            raise Exception(f"Error to apply AF mode: {e}")
-
-    # return False if no change    
-    def apply_awb_mode(self, selected): 
-        try: 
-            awb_mode = self._config.update_awb_mode(selected) 
-            return self.apply_controls("AwbMode", awb_mode) if awb_mode is not None else False  
-        except Exception as e: 
-            raise Exception(f"Error to apply AWB mode: {e}")
 
-    # return False if no change    
-    def apply_brightness(self, value): 
-        try: 
-            brightness = self._config.update_brightness(value) 
-            return self.apply_controls("Brightness", brightness) if brightness is not None else False  
-        except Exception as e: 
-            raise Exception(f"Error to apply brightness: {e}")
+    # save the pending updates of video settings, e.g. at exit 
+    def save_settings(self): 
+        self._config.flush() 
 
     @property 
     def settings(self): 
         return self._config.settings(full = True)  
 
+    @property 
+    def id(self): 
+        return self._id 
+
     @property
     def logo(self): 
         return self._logo_buffer
@@ -212,119 +410,782 @@ class VideoServer(object):
         return self._stream_buffer  
     
     @property
-    def snapshot(self): 
+    def snapshots(self): 
+        return self._snapshot_engine 
+
+    @property 
+    def tiles(self): 
+        return self._tile_cache 
+
+    @property 
+    def thumbnails(self): 
+        return self._thumbnails 
+
+    @property 
+    def roi_mode(self): 
+        return self._roi_mode 
+
+    @property 
+    def roi_stream(self): 
+        return self._roi_stream.stream if self._roi_mode == "crop" else self._stream_buffer 
+
+    @property 
+    def variants(self): 
+        return self._stream_variants 
+
+    # None if HLS is disabled 
+    @property 
+    def hls(self): 
+        return self._hls 
+
+    # None if recording is disabled 
+    @property 
+    def recorder(self): 
+        return self._recorder 
+
+    # None if instant replay is disabled 
+    @property 
+    def instant_replay(self): 
+        return self._instant_replay 
+
+    # None if timelapse is disabled 
+    @property 
+    def timelapse(self): 
+        return self._timelapse 
+
+    # None if motion detection is disabled 
+    @property 
+    def motion(self): 
+        return self._motion 
+
+    # future of the snapshot of the latest motion, None if not captured 
+    @property 
+    def motion_snapshot(self): 
+        return self._motion_snapshot 
+
+    # video stream served at the path, None if the path is not a stream, e.g. 
+    # "/stream.mjpg?w=640&fps=10&q=60" for a variant of the primary stream 
+    # raise ValueError for bad parameters, or if the variant can not be created 
+    def stream_for(self, path): 
+        url = urllib.parse.urlsplit(path) 
+        if url.path == "/stream.mjpg": 
+            query = urllib.parse.parse_qs(url.query) 
+            params = {key: query[name][0] for key, name in (("width", "w"), ("fps", "fps"), ("quality", "q")) if name in query} 
+            return self._stream_variants.get(**params) 
+        if url.path == "/roi.mjpg" and self._roi_mode != "off": 
+            return self.roi_stream 
+        return None 
+
+    # request ROI for the owner (e.g. a websocket connection), None to release 
+    # return if the request is granted, and the active ROI (None for full frame) 
+    def request_roi(self, owner, rect): 
+        if self._roi_mode == "off": 
+            raise Exception("ROI streaming is disabled") 
+        granted = self._roi_arbiter.request(owner, rect) 
+        return granted, self.update_roi() 
+
+    def release_roi(self, owner): 
+        self._roi_arbiter.release(owner) 
+        self.update_roi() 
+
+    # apply the active ROI (after lease expiry or requests), return the ROI 
+    def update_roi(self): 
+        rect = self._roi_arbiter.active() 
+        if rect is not None: 
+            rect = fit_rect(rect, self._roi_aspect) 
+        if rect == self._roi_applied: 
+            return rect 
+        logger.info(f"Apply ROI: {rect}") 
+        if self._roi_mode == "crop": 
+            self._roi_stream.set_rect(rect) 
+        elif self._roi_mode == "sensor" and self._camera is not None: 
+            self.apply_controls("ScalerCrop", self.scaler_crop(rect)) 
+        self._roi_applied = rect 
+        return rect 
+
+    # ScalerCrop (in sensor pixels) of the ROI, as seen in the transformed stream 
+    def scaler_crop(self, rect): 
+        crop_x, crop_y, crop_width, crop_height = self._camera.properties["ScalerCropMaximum"] 
+        if rect is None: 
+            return (crop_x, crop_y, crop_width, crop_height) 
+        x, y, width, height = rect 
+        transform = self._config.transform() 
+        if transform["hflip"]: 
+            x = 1.0 - x - width 
+        if transform["vflip"]: 
+            y = 1.0 - y - height 
+        return (crop_x + int(x * crop_width), crop_y + int(y * crop_height), int(width * crop_width), int(height * crop_height)) 
+
+    # called in camera thread for each frame, with functions returning a 
+    # context of the array of "main" stream and of the Y plane of "lores" stream 
+    def _on_frame(self, main, lores): 
+        if time.time() - self._roi_check_t > 1: # for lease expiry 
+            self._roi_check_t = time.time() 
+            self.update_roi() 
+        if self._roi_mode == "crop" and self._roi_stream.active: 
+            self._roi_stream.on_frame(main) 
+        if self._motion is not None: 
+            self._motion.on_frame(lores) 
+
+    # called in the worker of motion detection for each event 
+    def _on_motion(self, event): 
+        if event["state"] == "start" and self._motion_snapshot_enabled: 
+            self._motion_snapshot = self._snapshot_engine.request("jpeg") 
+        if self._recorder is not None: 
+            self._recorder.trigger(bool(self._motion.active)) 
+
+    # capture a full resolution image from "main" stream, called in the 
+    # worker of snapshot engine, return the current sequence number of video 
+    # stream and the image 
+    def capture_snapshot(self): 
         logger.info("snapshot") 
-        try: 
-            _data = io.BytesIO() 
-            self.picam2.capture_file(_data, "main", format="png")
-            logger.info(f"Image data size: {len(_data.getvalue())}")
-            self._snapshot_buffer.write(_data.getvalue()) 
-        except Exception as e: 
-            logger.warning(f"Failed capture image: {e}")
-        return self._snapshot_buffer 
+        camera = self._camera 
+        if camera is None: 
+            raise Exception("Camera is not opened yet") 
+        seq = self._stream_buffer.seq 
+        return seq, camera.capture_image() 
+
+    # a capture of "main" stream for timelapse, shared with snapshots, called 
+    # in the thread of timelapse 
+    def capture_timelapse(self): 
+        return self._snapshot_engine.request_capture().result(10).image 
     
+    # frame sent to viewers when no new frame arrives in time, the last frame 
+    # of the stream while the camera is reconfigured, otherwise the logo 
+    def idle_frame(self, stream): 
+        if self._reconfiguring and stream.latest is not None: 
+            return stream.latest 
+        return self._logo_buffer.frame 
+
+    @property 
+    def reconfiguring(self): 
+        return self._reconfiguring 
+
     def restart(self): 
         logger.info("Restart video streaming") 
         self.stop() 
         self.start() 
 
+    # Apply the settings of video config (transform, frame rate, resolution) 
+    # while viewers stay connected, they get the last frame during the switch. 
+    # The frame rate is changed on the running camera if possible, otherwise 
+    # the camera is stopped and reconfigured in place (without closing it), 
+    # and reopened only if that fails. 
+    # Return the mode ("live", "in place", "reopen" or "none"), the time the 
+    # switch took, and the blackout, i.e. the time between the last frame 
+    # before the switch and the first frame after it. 
+    # Reconfigurations (e.g. of two admin pages) run one at a time, the later 
+    # one applies the settings saved by then, or nothing if already applied. 
+    def reconfigure(self, timeout = 5): 
+        with self._reconfigure_lock: 
+            return self._reconfigure_locked(timeout) 
+
+    def _reconfigure_locked(self, timeout): 
+        logger.info("Reconfigure video streaming") 
+        start_t = time.time() 
+        last = self._stream_buffer.latest 
+        self._reconfiguring = True 
+        try: 
+            mode = self._reconfigure() 
+            duration = time.time() - start_t 
+            first = None 
+            if mode != "none": 
+                first = self._stream_buffer.latest_after(last.seq if last is not None else 0, timeout) 
+        finally: 
+            self._reconfiguring = False 
+        blackout = first.published_t - last.published_t if first is not None and last is not None else None 
+        result = {"mode": mode, "duration": duration, "blackout": blackout} 
+        logger.info(f"Video reconfigured: {result}") 
+        return result 
+
+    def _reconfigure(self): 
+        camera = self._camera 
+        if camera is None: 
+            self.start() 
+            return "reopen" 
+        transform = self._config.transform() 
+        frame_rate = self._config.frame_rate() 
+        resolution = tuple(self._config.resolution()) 
+        snapshot_resolution = tuple(self._config.snapshot_resolution()) 
+        settings = (transform, frame_rate, resolution, snapshot_resolution) 
+        if settings == camera.settings: 
+            return "none" 
+        if settings[0:1] + settings[2:] == camera.settings[0:1] + camera.settings[2:] and camera.set_frame_rate(frame_rate): 
+            self.configure_streams() 
+            return "live" 
+        try: 
+            self._roi_stream.stop() 
+            camera.stop() 
+            camera.reconfigure(transform, frame_rate, resolution, snapshot_resolution) 
+            self.configure_streams() 
+            self.apply_config_controls() 
+            self.start_camera() 
+            return "in place" 
+        except Exception as e: 
+            logger.warning(f"Failed reconfigure camera in place: {e}") 
+            self.restart() 
+            return "reopen" 
+
     def start(self): 
         logger.info("Start video streaming") 
         try: 
-            if self.picam2 is None: 
+            if self._camera is None: 
                 self.open_camera() 
-                self.picam2.start_recording(MJPEGEncoder(bitrate=32000000), FileOutput(self._stream_buffer)) 
+                self.start_camera() 
             else: 
                 logger.warning("Camera was not closed before open")
         except Exception as e: 
             logger.warning(f"Failed start video streaming: {e}") 
 
+    # start streaming of the opened camera 
+    def start_camera(self): 
+        # a key frame (with SPS and PPS) at each HLS segment boundary 
+        iperiod = 0 
+        if self._hls is not None: 
+            self._hls.discontinuity() 
+            iperiod = max(1, round(self._camera.settings[1] * self._hls.segment_duration)) 
+        self._camera.start(self._stream_buffer, self._hls, self._hls_bitrate, iperiod) 
+        if self._roi_mode == "crop": 
+            self._roi_stream.start() 
+        if self._motion is not None: 
+            self._motion.start() 
+
     def stop(self):  
         logger.info("Stop video streaming")
         try:
-            if self.picam2 is not None: 
-                self.picam2.stop_recording() 
-                self.picam2.stop() 
-                self.picam2.close() 
-                self.picam2 = None 
+            if self._camera is not None: 
+                self._roi_stream.stop() 
+                if self._motion is not None: 
+                    self._motion.stop() 
+                self._camera.stop() 
+                self._camera.close() 
+                self._camera = None 
                 logger.info("Video streaming stopped") 
             else: 
                 logger.warning("Camera is not opened yet")
         except Exception as e: 
             logger.warning(f"Failed stop video streaming: {e}")
 
+# Snapshot image is requested with "/snapshot.<format>?q=<quality>", 
+# return (format, quality) or None if the path is not a snapshot request. 
+import urllib.parse 
+
+def parse_snapshot_path(path): 
+    url = urllib.parse.urlsplit(path) 
+    name, _, format = url.path.rpartition(".") 
+    if name != "/snapshot" or format not in SNAPSHOT_FORMATS: 
+        return None 
+    quality = urllib.parse.parse_qs(url.query).get("q", [None])[0] 
+    return format, int(quality) if quality and quality.isdigit() else None 
+
+# the snapshot may be cached by client, but must be validated with ETag 
+def snapshot_headers(snapshot): 
+    return { 
+        "Content-Type": snapshot.content_type, 
+        "Content-Length": len(snapshot.data), 
+        "ETag": snapshot.etag, 
+        "Cache-Control": "no-cache", 
+    } 
+
+# Video servers of all cameras, camera <n> is served at "/cam/<n>/...", e.g. 
+# "/cam/1/stream.mjpg" and "/cam/1/snapshot.png", and by the paths without 
+# prefix for camera 0, so a single camera is served as before. The web pages 
+# use relative paths, so "/cam/<n>/video.html" shows the video of camera <n>. 
+# Speed tests are about the links of viewers, shared by all cameras. 
+import re 
+CAMERA_PATH = re.compile(r"^/cam/(\d+)(/.*)$") 
+
+@singleton 
+class VideoServers(object): 
+    def __init__(self): 
+        self._servers = {} 
+        # results of the speed test page, i.e. the links of viewers 
+        self._speedtests = SpeedTests() 
+
+    def add(self, video_server): 
+        self._servers[video_server.id] = video_server 
+
+    def __iter__(self): 
+        return iter(list(self._servers.values())) 
+
+    def __len__(self): 
+        return len(self._servers) 
+
+    @property 
+    def speedtests(self): 
+        return self._speedtests 
+
+    # video server of the camera id, camera 0 if None 
+    def get(self, camera_id = None): 
+        try: 
+            return self._servers[int(camera_id or 0)] 
+        except (KeyError, ValueError, TypeError): 
+            raise Exception(f"Unknown camera: {camera_id}") 
+
+    # video server of the path and the path without camera prefix, the video 
+    # server is None for an unknown camera 
+    def route(self, path): 
+        match = CAMERA_PATH.match(path) 
+        if match is None: 
+            return self._servers.get(0), path 
+        return self._servers.get(int(match.group(1))), match.group(2) 
+
+# Tiles of snapshot image for deep zoom, the pyramid of a fresh capture is 
+# described by "tiles/snapshot.json" (and its DZI file "tiles/<id>.dzi"), 
+# and tiles are "tiles/<id>_files/<level>/<col>_<row>.jpg", relative to the 
+# path of the camera. 
+# Generating a tile is blocking, return (code, headers, body). 
+TILES_PATH = re.compile(r"^/tiles/(?:(snapshot)\.json|([\w-]+)\.dzi|([\w-]+)_files/(\d+)/(\d+)_(\d+)\.jpg)$") 
+
+def tiles_response(video_server, path): 
+    match = TILES_PATH.match(urllib.parse.urlsplit(path).path) 
+    if match is None: 
+        return 404, {}, b"" 
+    tiles = video_server.tiles 
+    if match.group(1): 
+        try: 
+            pyramid = tiles.current() 
+        except Exception as e: 
+            logger.warning(f"Failed capture tiles: {e}") 
+            return 503, {}, b"" 
+        body = json.dumps(pyramid.info()).encode() 
+        return 200, {"Content-Type": "application/json", "Cache-Control": "no-cache"}, body 
+    elif match.group(2): 
+        pyramid = tiles.pyramid(match.group(2)) 
+        if pyramid is None: 
+            return 404, {}, b"" 
+        return 200, {"Content-Type": "application/xml", "Cache-Control": "public, max-age=3600"}, pyramid.dzi().encode() 
+    else: 
+        id, level, col, row = match.group(3), *map(int, match.group(4, 5, 6)) 
+        tile = tiles.tile(id, level, col, row) 
+        if tile is None: 
+            return 404, {}, b"" 
+        # tiles of a pyramid never change 
+        return 200, {"Content-Type": "image/jpeg", "Cache-Control": "public, max-age=3600, immutable"}, tile 
+
+# HLS (H.264) live stream, the playlist is "/hls/live.m3u8", segments are 
+# "/hls/seg<msn>.ts" and parts (LL-HLS) are "/hls/part<msn>.<index>.ts". 
+# Segments and parts never change, and are cached by browsers and proxies 
+# for as long as they are kept, so viewers behind a proxy share one upstream 
+# stream. A playlist with "_HLS_msn" (and "_HLS_part") blocks until the 
+# segment (or part) is available, return (code, headers, body). 
+HLS_PATH = re.compile(r"^/hls/(?:(live)\.m3u8|seg(\d+)\.ts|part(\d+)\.(\d+)\.ts)$") 
+
+def hls_response(video_server, path): 
+    url = urllib.parse.urlsplit(path) 
+    match = HLS_PATH.match(url.path) 
+    hls = video_server.hls 
+    if match is None or hls is None: 
+        return 404, {}, b"" 
+    if match.group(1): 
+        query = urllib.parse.parse_qs(url.query) 
+        max_age = 1 
+        if "_HLS_msn" in query: 
+            try: 
+                msn = int(query["_HLS_msn"][0]) 
+                part = int(query["_HLS_part"][0]) if "_HLS_part" in query else None 
+            except ValueError: 
+                return 400, {}, b"" 
+            if not hls.wait(msn, part, hls.segment_duration * 3): 
+                return 503, {}, b"" 
+            # the response of a blocking request never changes 
+            max_age = hls.segment_duration * 6 
+        headers = {"Content-Type": "application/vnd.apple.mpegurl", "Cache-Control": f"public, max-age={max_age}"} 
+        return 200, headers, hls.playlist().encode() 
+    if match.group(2): 
+        data = hls.segment(int(match.group(2))) 
+    else: 
+        data = hls.part(int(match.group(3)), int(match.group(4))) 
+    if data is None: 
+        return 404, {}, b"" 
+    max_age = int(hls.window) 
+    return 200, {"Content-Type": "video/mp2t", "Cache-Control": f"public, max-age={max_age}, immutable"}, data 
+
+def is_hls_path(path): 
+    return path.startswith("/hls/") 
+
+# live video streams, "/stream.mjpg" (with optional variant query) and "/roi.mjpg" 
+# Motion detection, "/motion.json" is the state of the zones and the recent 
+# events, and "/motion.jpg" the snapshot captured at the start of the latest 
+# motion (with "motion_snapshot"), which blocks until it is captured, return 
+# (code, headers, body). 
+MOTION_PATHS = ("/motion.json", "/motion.jpg") 
+
+def is_motion_path(path): 
+    return urllib.parse.urlsplit(path).path in MOTION_PATHS 
+
+def motion_response(video_server, path): 
+    motion = video_server.motion 
+    if motion is None: 
+        return 404, {}, b"" 
+    if urllib.parse.urlsplit(path).path == "/motion.json": 
+        body = json.dumps(dict(motion.status(), recent=motion.events())).encode() 
+        return 200, {"Content-Type": "application/json", "Cache-Control": "no-cache"}, body 
+    future = video_server.motion_snapshot 
+    if future is None: 
+        return 404, {}, b"" 
+    try: 
+        snapshot = future.result(10) 
+    except Exception as e: 
+        logger.warning(f"Failed motion snapshot: {e}") 
+        return 503, {}, b"" 
+    return 200, snapshot_headers(snapshot), snapshot.data 
+
+def is_stream_path(path): 
+    return urllib.parse.urlsplit(path).path in ("/stream.mjpg", "/roi.mjpg") 
+
+def is_tiles_path(path): 
+    return path.startswith("/tiles/") 
+
+# request headers with lower case names 
+def lower_headers(headers): 
+    return {key.lower(): value for key, value in headers.items()} 
+
+# Speed test endpoints, see speedtest.py 
+from speedtest import is_speedtest_path, download_chunks, download_headers, RESULT_PATH, MAX_RESULT_SIZE 
+
+# Recordings, see recorder.py 
+from recorder import is_recording_path, recording_response, FileRange 
+
+# Clips of instant replay and timelapse movies of the camera, see 
+# instant_replay.py and timelapse.py 
+def clip_response_of(video_server): 
+    return lambda path: clip_response(video_server.instant_replay, path) 
+
+def timelapse_response_of(video_server): 
+    return lambda path: timelapse_response(video_server.timelapse, path) 
+
+# Prometheus metrics of the camera software are "/metrics", requests are 
+# counted by endpoint, and viewers are gauged by the web server in use. 
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE 
+
+HTTP_REQUESTS = registry.counter("camera_http_requests_total", "HTTP requests by endpoint", ("endpoint",)) 
+HTTP_VIEWERS = registry.gauge("camera_http_viewers", "Viewers of live video streams") 
+
+def metrics_response(path): 
+    return 200, {"Content-Type": METRICS_CONTENT_TYPE, "Cache-Control": "no-cache"}, registry.expose().encode() 
+
+def is_metrics_path(path): 
+    return urllib.parse.urlsplit(path).path == "/metrics" 
+
+# endpoint of the request path, the "endpoint" label of requests 
+def endpoint_of(path): 
+    url_path = urllib.parse.urlsplit(path).path 
+    if url_path in ("/stream.mjpg", "/roi.mjpg", "/metrics"): 
+        return url_path[1:].partition(".")[0] 
+    if parse_snapshot_path(path) is not None: 
+        return "snapshot" 
+    if is_tiles_path(path): 
+        return "tiles" 
+    if is_thumbnail_path(path): 
+        return "thumbnail" 
+    if is_hls_path(path): 
+        return "hls" 
+    if is_speedtest_path(path): 
+        return "speedtest" 
+    if is_recording_path(path): 
+        return "recording" 
+    if is_motion_path(path): 
+        return "motion" 
+    if is_clip_path(path): 
+        return "clip" 
+    if is_timelapse_path(path): 
+        return "timelapse" 
+    return "file" 
+
 # Web server serves web pages, including the live video page, snapshot page, and admin page. 
 # It also handle the request of video stream and snapshot image. 
+# Web pages are served from memory (see www_cache.py), and connections are 
+# kept alive (HTTP/1.1) for all requests except video streams. 
+
+from www_cache import WwwCache 
             
+import socket 
 from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler 
 
 @singleton 
 class WebServer(object): 
     class HttpRequestHandler(SimpleHTTPRequestHandler): 
+        protocol_version = "HTTP/1.1" 
+
         def __init__(self, *args, **kwargs):
+            self.timeout = WebServer().keep_alive_timeout # idle keep-alive connection 
             super().__init__(*args, **kwargs, directory="www")
+
+        # an error with headers (e.g. Content-Range of 416) is sent with them 
+        # and an empty body, instead of the error page 
+        def send_body(self, code, headers, body, head_only = False): 
+            if code >= 400 and not headers: 
+                self.send_error(code) 
+                return 
+            self.send_response(code) 
+            for key, value in headers.items(): 
+                self.send_header(key, value) 
+            if code == 200 and "Content-Length" not in headers: 
+                self.send_header("Content-Length", len(body)) 
+            elif code >= 400: 
+                self.send_header("Content-Length", 0) 
+            self.end_headers() 
+            if code == 200 and not head_only: 
+                self.wfile.write(body) 
+
+        # chunks of the random buffer, written without copy 
+        def send_download(self, chunks): 
+            speedtests = VideoServers().speedtests 
+            self.send_body(200, download_headers(chunks), b"", head_only = True) 
+            try: 
+                for _ in range(chunks): 
+                    self.wfile.write(speedtests.chunk) 
+                speedtests.count("download", chunks * len(speedtests.chunk)) 
+            except (ConnectionError, socket.timeout) as e: 
+                logger.info(f"Speed test download closed: {e!r}") 
+                self.close_connection = True 
+
+        # upload of speed test is discarded, the result of speed test is recorded 
+        def do_POST(self): 
+            logger.info(f"HTTP POST for {self.path}")
+            _, path = VideoServers().route(self.path) 
+            HTTP_REQUESTS.labels(endpoint_of(path)).inc() 
+            length = self.headers.get("Content-Length") 
+            if not is_speedtest_path(path) or "Transfer-Encoding" in self.headers: 
+                self.send_error(501) 
+                return 
+            if length is None or not length.isdigit(): 
+                self.send_error(411) 
+                return 
+            speedtests = VideoServers().speedtests 
+            length = int(length) 
+            if urllib.parse.urlsplit(path).path == RESULT_PATH: 
+                if length > MAX_RESULT_SIZE: 
+                    self.send_error(413) 
+                    return 
+                try: 
+                    result = speedtests.record(self.client_address[0], self.rfile.read(length)) 
+                except ValueError as e: 
+                    self.send_error(400, str(e)) 
+                    return 
+                self.send_body(200, {"Content-Type": "application/json"}, json.dumps(result.to_dict()).encode()) 
+                return 
+            remaining = length 
+            while remaining > 0: 
+                size = self.rfile.readinto(speedtests.sink[:min(remaining, len(speedtests.sink))]) 
+                if not size: 
+                    self.close_connection = True 
+                    return 
+                remaining -= size 
+            speedtests.count("upload", length) 
+            self.send_body(*speedtests.response(path, self.client_address[0])) 
+
+        # recordings, segments are sent from file (sendfile) 
+        def send_recording(self, video_server, path, head_only = False): 
+            code, headers, body = recording_response(video_server.recorder, path, lower_headers(self.headers)) 
+            if not isinstance(body, FileRange): 
+                self.send_body(code, headers, body, head_only) 
+                return 
+            self.send_body(code, headers, b"", head_only = True) 
+            if head_only: 
+                return 
+            try: 
+                with open(body.path, "rb") as f: 
+                    self.connection.sendfile(f, body.offset, body.length) 
+            except (OSError, socket.timeout) as e: 
+                logger.info(f"Recording download closed: {e!r}") 
+                self.close_connection = True 
+
+        # clips of instant replay and timelapse movies, generated by the 
+        # response function and written frame by frame with vectored writes 
+        def send_clip(self, response, path, head_only = False): 
+            code, headers, clip = response(path) 
+            if isinstance(clip, bytes): 
+                self.send_body(code, headers, clip, head_only) 
+                return 
+            self.send_body(code, headers, b"", head_only = True) 
+            if head_only: 
+                return 
+            try: 
+                for buffers in clip.buffers(): 
+                    sendmsg_all(self.connection, buffers) 
+            except (OSError, socket.timeout) as e: 
+                logger.info(f"Clip download closed: {e!r}") 
+                self.close_connection = True 
+
+        def do_HEAD(self): 
+            video_server, path = VideoServers().route(self.path) 
+            if video_server is None: 
+                self.send_error(404) 
+                return 
+            if is_recording_path(path): 
+                self.send_recording(video_server, path, head_only = True) 
+                return 
+            if is_clip_path(path): 
+                self.send_clip(clip_response_of(video_server), path, head_only = True) 
+                return 
+            if is_timelapse_path(path): 
+                self.send_clip(timelapse_response_of(video_server), path, head_only = True) 
+                return 
+            self.send_body(*WebServer().www.response(path, lower_headers(self.headers)), head_only = True) 
     
         def do_GET(self):
             logger.info(f"HTTP request for {self.path}")
-            if self.path == "/stream.mjpg":
-                self.send_response(200)
-                self.send_header("Age", 0)
-                self.send_header("Cache-Control", "no-cache, private")
-                self.send_header("Pragma", "no-cache")
-                self.send_header("Content-Type", "multipart/x-mixed-replace; boundary=FRAME")
-                self.end_headers()
-                try:
-                    video_server = VideoServer() 
-                    while True: 
-                        frame = video_server.stream.read()
-                        if frame is None:
-                            logger.warning("Failed capture live frame")
-                            frame = video_server.logo.read() 
-                        self.wfile.write(b"--FRAME\r\n")
-                        self.send_header("Content-Type", "image/jpeg")
-                        self.send_header("Content-Length", len(frame))
-                        self.end_headers()
-                        self.wfile.write(frame)
-                        self.wfile.write(b"\r\n")
-                except Exception as e:
-                    logger.warning(f"Error for live video: {e}") 
-                    self.send_error(404)
-            elif self.path == "/snapshot.png":
-                self.send_response(200)
-                self.send_header("Content-type", "image/png")
+            video_server, path = VideoServers().route(self.path) 
+            HTTP_REQUESTS.labels(endpoint_of(path)).inc() 
+            if video_server is None: 
+                self.send_error(404, "Unknown camera") 
+            elif is_stream_path(path):
+                web_server = WebServer() 
+                try: 
+                    stream = video_server.stream_for(path) 
+                except Exception as e: 
+                    logger.warning(f"Failed stream {self.path}: {e}") 
+                    self.send_error(400 if isinstance(e, ValueError) else 503, str(e)) 
+                    return 
+                if stream is None: 
+                    self.send_error(404) 
+                    return 
+                if not web_server.acquire_viewer(): 
+                    logger.warning(f"Too many viewers: {web_server.viewers}")
+                    self.send_error(503, "Too many viewers")
+                    return 
+                try: 
+                    self.close_connection = True 
+                    self.send_response(200)
+                    self.send_header("Age", 0)
+                    self.send_header("Connection", "close")
+                    self.send_header("Cache-Control", "no-cache, private")
+                    self.send_header("Pragma", "no-cache")
+                    self.send_header("Content-Type", f"multipart/x-mixed-replace; boundary={MULTIPART_BOUNDARY}")
+                    self.end_headers()
+                    client = web_server.stream_client(stream, self.client_address) 
+                    # a blocked write longer than stall timeout disconnects the client, 
+                    # and bytes in flight are capped by the socket send buffer 
+                    self.connection.settimeout(client.stall_timeout or None) 
+                    if client.max_inflight_bytes > 0: 
+                        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, client.max_inflight_bytes) 
+                    try:
+                        while True: 
+                            frame = client.read()
+                            if frame is not None: 
+                                sendmsg_all(self.connection, multipart_parts(frame)) 
+                                client.sent(frame, len(frame.data)) 
+                            else:
+                                if not video_server.reconfiguring: 
+                                    logger.warning("Failed capture live frame")
+                                sendmsg_all(self.connection, multipart_parts(video_server.idle_frame(stream))) 
+                    # the response has started, the connection is closed without 
+                    # an error response 
+                    except (BrokenPipeError, ConnectionResetError): 
+                        logger.info(f"Viewer disconnected: {client.name}") 
+                    except socket.timeout: 
+                        logger.warning(f"Disconnect stalled viewer: {client.stats()}") 
+                    except Exception as e:
+                        logger.warning(f"Error for live video: {e}") 
+                    finally: 
+                        client.close() 
+                finally: 
+                    web_server.release_viewer() 
+            elif is_tiles_path(path): 
+                self.send_body(*tiles_response(video_server, path)) 
+            elif is_thumbnail_path(path): 
+                self.send_body(*thumbnail_response(video_server.thumbnails, path, lower_headers(self.headers))) 
+            elif is_hls_path(path): 
+                self.send_body(*hls_response(video_server, path)) 
+            elif is_metrics_path(path): 
+                self.send_body(*metrics_response(path)) 
+            elif is_motion_path(path): 
+                self.send_body(*motion_response(video_server, path)) 
+            elif download_chunks(path) is not None: 
+                self.send_download(download_chunks(path)) 
+            elif is_speedtest_path(path): 
+                self.send_body(*VideoServers().speedtests.response(path, self.client_address[0])) 
+            elif is_recording_path(path): 
+                self.send_recording(video_server, path) 
+            elif is_clip_path(path): 
+                self.send_clip(clip_response_of(video_server), path) 
+            elif is_timelapse_path(path): 
+                self.send_clip(timelapse_response_of(video_server), path) 
+            elif parse_snapshot_path(path) is not None:
                 try: 
-                    video_server = VideoServer() 
-                    image = video_server.snapshot.read()
-                    if image is None: 
+                    snapshot = video_server.snapshots.get(*parse_snapshot_path(path))
+                    if snapshot is None: 
                         logger.warning("failed capture snapshot")
                         image = video_server.logo.read() 
-                    self.send_header("Content-Length", len(image))
-                    self.end_headers() 
-                    self.wfile.write(image)
+                        self.send_response(200)
+                        self.send_header("Content-type", "image/jpeg")
+                        self.send_header("Content-Length", len(image))
+                        self.end_headers() 
+                        self.wfile.write(image)
+                    elif self.headers.get("If-None-Match") == snapshot.etag: 
+                        self.send_body(304, {"ETag": snapshot.etag}, b"") 
+                    else: 
+                        self.send_body(200, snapshot_headers(snapshot), snapshot.data) 
                 except Exception as e:
                     logger.warning(f"Error for snapshot: {e}")
-                    self.send_error(404)
+                    self.close_connection = True 
             else:
-                if self.path == "/": 
-                    self.path = "/video.html" 
-                elif not self.path.endswith(".html"): 
-                    html_path = self.path + ".html" 
-                    if os.path.exists(self.translate_path(html_path)):
-                        self.path = html_path 
-                return super().do_GET()
-
-    def __init__(self, port = 8080): 
+                self.send_body(*WebServer().www.response(path, lower_headers(self.headers))) 
+
+    def __init__(self, port = 8080, max_viewers = 0, max_inflight_bytes = 0, stall_timeout = 0, www_max_age = 604800, 
+                 keep_alive_timeout = 30, reuse_port = False): 
         self._port = port 
-        self._httpd = ThreadingHTTPServer(("", self._port), self.HttpRequestHandler) 
+        self._max_viewers = max_viewers # 0 for no limit 
+        self._max_inflight_bytes = max_inflight_bytes 
+        self._stall_timeout = stall_timeout 
+        self._www = WwwCache("www", www_max_age) 
+        self._keep_alive_timeout = keep_alive_timeout 
+        self._viewers = 0 
+        self._viewers_lock = threading.Lock() 
+        HTTP_VIEWERS.set_function(lambda: self._viewers) 
+        # the port is shared by the web servers of worker processes 
+        self._httpd = ThreadingHTTPServer(("", self._port), self.HttpRequestHandler, bind_and_activate = False) 
+        # listen backlog of asyncio mode, instead of 5 of socketserver, so many 
+        # viewers connecting at once are not reset 
+        self._httpd.request_queue_size = 100 
+        if reuse_port: 
+            self._httpd.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1) 
+        try: 
+            self._httpd.server_bind() 
+            self._httpd.server_activate() 
+        except Exception: 
+            self._httpd.server_close() 
+            raise 
         self._thread = None 
 
     @property 
     def port(self): 
         return self._port  
 
+    @property 
+    def viewers(self): 
+        return self._viewers 
+
+    @property 
+    def www(self): 
+        return self._www 
+
+    @property 
+    def keep_alive_timeout(self): 
+        return self._keep_alive_timeout 
+
+    # each viewer of video stream occupies a thread 
+    # return False if the viewer-count ceiling is reached 
+    def acquire_viewer(self): 
+        with self._viewers_lock: 
+            if self._max_viewers > 0 and self._viewers >= self._max_viewers: 
+                return False 
+            self._viewers += 1 
+            return True 
+
+    def release_viewer(self): 
+        with self._viewers_lock: 
+            self._viewers -= 1 
+
+    def stream_client(self, stream, address): 
+        return StreamClient(stream, f"http {address[0]}:{address[1]}", self._max_inflight_bytes, self._stall_timeout) 
+
     def start(self): 
         if self._thread is None: 
             logger.info(f"Start web server at port {self.port}") 
+            self._www.load() 
             self._thread = threading.Thread(target=self._httpd.serve_forever)
             self._thread.start()
 
@@ -336,23 +1197,416 @@ class WebServer(object):
             self._thread = None 
             logger.warning("Web server stopped")
         
+# Asyncio web server serves the same web pages, video stream and snapshot image 
+# as WebServer, but all connections are handled in one event loop (the loop of 
+# websocket server) instead of one thread per connection. Frames are handed over 
+# from the encoder thread to the event loop once per frame, no matter how many 
+# viewers are connected. 
+
+from http import HTTPStatus 
+
+@singleton 
+class AsyncWebServer(object): 
+    def __init__(self, port = 8080, max_viewers = 0, max_inflight_bytes = 0, stall_timeout = 0, directory = "www", 
+                 www_max_age = 604800, keep_alive_timeout = 30, reuse_port = False): 
+        self._port = port 
+        self._reuse_port = reuse_port # the port is shared by the web servers of worker processes 
+        self._max_viewers = max_viewers # 0 for no limit 
+        self._max_inflight_bytes = max_inflight_bytes # 0 for no limit 
+        self._stall_timeout = stall_timeout # 0 for no limit 
+        self._www = WwwCache(directory, www_max_age) 
+        self._keep_alive_timeout = keep_alive_timeout 
+        self._keep_alive = {} # writer -> keep the connection after the response 
+        self._viewers = 0 
+        self._connections = set() 
+        self._server = None 
+        self._loop = None 
+        self._frame_ready = {} # stream -> future of next frame 
+        self._listeners = {} 
+        HTTP_VIEWERS.set_function(lambda: self._viewers) 
+
+    @property 
+    def port(self): 
+        return self._port  
+
+    @property 
+    def viewers(self): 
+        return self._viewers 
+
+    @property 
+    def www(self): 
+        return self._www 
+
+    # called in encoder thread 
+    def _on_frame(self, stream, frame): 
+        try: 
+            self._loop.call_soon_threadsafe(self._publish_frame, stream, frame) 
+        except RuntimeError as e: # loop is closed 
+            logger.debug(f"Drop frame for closed loop: {e}") 
+
+    # called in event loop, wake up all viewers of the stream waiting for next frame, 
+    # a frame scheduled before the stream was unwatched is dropped 
+    def _publish_frame(self, stream, frame): 
+        frame_ready = self._frame_ready.get(stream) 
+        if frame_ready is None: 
+            return 
+        self._frame_ready[stream] = self._loop.create_future() 
+        frame_ready.set_result(frame) 
+
+    # frames of a stream are handed over to the event loop since its first viewer 
+    def _watch(self, stream): 
+        if stream not in self._frame_ready: 
+            self._frame_ready[stream] = self._loop.create_future() 
+            self._listeners[stream] = lambda frame: self._on_frame(stream, frame) 
+            stream.add_listener(self._listeners[stream]) 
+
+    # frames of a stream without viewers (e.g. of a stopped variant) are no 
+    # longer handed over, so the stream is not referenced by the server 
+    def _unwatch(self, stream): 
+        listener = self._listeners.pop(stream, None) 
+        if listener is not None: 
+            stream.remove_listener(listener) 
+        self._frame_ready.pop(stream, None) 
+
+    # wait for the newest frame after the cursor, return None if timeout 
+    async def read_frame(self, cursor, timeout = 1): 
+        frame = cursor.hub.latest 
+        if frame is None or frame.seq <= cursor.seq: 
+            try: 
+                frame = await asyncio.wait_for(asyncio.shield(self._frame_ready[cursor.hub]), timeout) 
+            except asyncio.TimeoutError: 
+                return None 
+        return cursor.advance(frame) 
+
+    async def start(self): 
+        logger.info(f"Start async web server at port {self.port}") 
+        self._loop = asyncio.get_running_loop() 
+        await self._loop.run_in_executor(None, self._www.load) 
+        for video_server in VideoServers(): 
+            self._watch(video_server.stream) 
+        self._server = await asyncio.start_server(self.handle_connection, "", self._port, 
+                                                  reuse_port = self._reuse_port or None) 
+
+    async def stop(self): 
+        logger.warning("Stop async web server...") 
+        for stream, listener in self._listeners.items(): 
+            stream.remove_listener(listener) 
+        self._listeners.clear() 
+        self._frame_ready.clear() 
+        if self._server is not None: 
+            self._server.close() 
+            for task in list(self._connections): 
+                task.cancel() 
+            await asyncio.gather(*self._connections, return_exceptions=True) 
+            await self._server.wait_closed() 
+            self._server = None 
+        logger.warning("Async web server stopped") 
+
+    # HTTP/1.1 with persistent connections, except for video streams, which 
+    # take over the connection. An idle connection is closed after keep-alive 
+    # timeout, the first request must arrive within 10 seconds. 
+    async def handle_connection(self, reader, writer): 
+        task = asyncio.current_task() 
+        self._connections.add(task) 
+        self._keep_alive[writer] = True 
+        timeout = 10 
+        try: 
+            while self._keep_alive[writer]: 
+                try: 
+                    request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout) 
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError): 
+                    if timeout == self._keep_alive_timeout: 
+                        break # idle connection closed by either side 
+                    raise 
+                timeout = self._keep_alive_timeout 
+                request_line, *header_lines = request.decode("latin-1").rstrip("\r\n").split("\r\n") 
+                method, path, version = request_line.split(" ", 2) 
+                headers = {} 
+                for line in header_lines: 
+                    key, _, value = line.partition(":") 
+                    headers[key.strip().lower()] = value.strip() 
+                connection = headers.get("connection", "").lower() 
+                self._keep_alive[writer] = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close" 
+                logger.info(f"HTTP request for {path}") 
+                video_server, path = VideoServers().route(path) 
+                HTTP_REQUESTS.labels(endpoint_of(path)).inc() 
+                if method == "POST" and is_speedtest_path(path) and "transfer-encoding" not in headers: 
+                    await self.receive_speedtest(reader, writer, path, headers) 
+                elif method not in ("GET", "HEAD") or headers.get("content-length", "0") != "0" or "transfer-encoding" in headers: 
+                    self._keep_alive[writer] = False # the body is not read 
+                    await self.send_error(writer, 501) 
+                elif video_server is None: 
+                    await self.send_error(writer, 404, "Unknown camera") 
+                elif method == "HEAD" and is_recording_path(path): 
+                    await self.send_recording(writer, video_server, path, headers, head_only = True) 
+                elif method == "HEAD" and is_clip_path(path): 
+                    await self.send_clip(writer, clip_response_of(video_server), path, head_only = True) 
+                elif method == "HEAD" and is_timelapse_path(path): 
+                    await self.send_clip(writer, timelapse_response_of(video_server), path, head_only = True, blocking = True) 
+                elif method == "HEAD": 
+                    await self.send_file(writer, path, headers, head_only = True) 
+                elif is_stream_path(path): 
+                    self._keep_alive[writer] = False 
+                    await self.send_stream(writer, video_server, path) 
+                elif is_tiles_path(path): 
+                    await self.send_blocking(writer, lambda path: tiles_response(video_server, path), path) 
+                elif is_thumbnail_path(path): 
+                    await self.send_blocking(writer, lambda path: thumbnail_response(video_server.thumbnails, path, headers), path) 
+                elif is_hls_path(path): 
+                    await self.send_blocking(writer, lambda path: hls_response(video_server, path), path) 
+                elif is_metrics_path(path): 
+                    await self.send_blocking(writer, metrics_response, path) 
+                elif is_motion_path(path): 
+                    await self.send_blocking(writer, lambda path: motion_response(video_server, path), path) 
+                elif download_chunks(path) is not None: 
+                    await self.send_download(writer, download_chunks(path)) 
+                elif is_speedtest_path(path): 
+                    await self.send_response(writer, *VideoServers().speedtests.response(path, self.peer(writer))) 
+                elif is_recording_path(path): 
+                    await self.send_recording(writer, video_server, path, headers) 
+                elif is_clip_path(path): 
+                    await self.send_clip(writer, clip_response_of(video_server), path) 
+                elif is_timelapse_path(path): 
+                    await self.send_clip(writer, timelapse_response_of(video_server), path, blocking = True) 
+                elif parse_snapshot_path(path) is not None: 
+                    await self.send_snapshot(writer, video_server, headers, *parse_snapshot_path(path)) 
+                else: 
+                    await self.send_file(writer, path, headers) 
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ValueError) as e: 
+            logger.warning(f"Bad HTTP request: {e}") 
+        except (ConnectionError, asyncio.CancelledError) as e: 
+            logger.info(f"HTTP connection closed: {e!r}") 
+        except Exception as e: 
+            logger.warning(f"Error for HTTP request: {e}") 
+        finally: 
+            self._connections.discard(task) 
+            self._keep_alive.pop(writer, None) 
+            writer.close() 
+
+    def send_head(self, writer, code, headers = {}): 
+        lines = [f"HTTP/1.1 {code} {HTTPStatus(code).phrase}", "Server: LiveCamera", 
+                 f"Connection: {'keep-alive' if self._keep_alive.get(writer) else 'close'}"] 
+        lines += [f"{key}: {value}" for key, value in headers.items()] 
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")) 
+
+    async def send_error(self, writer, code, message = None): 
+        body = (message or HTTPStatus(code).phrase).encode() 
+        self.send_head(writer, code, {"Content-Type": "text/plain", "Content-Length": len(body)}) 
+        writer.write(body) 
+        await writer.drain() 
+
+    # each viewer runs in its own task, so a slow viewer never blocks others, 
+    # frames are skipped for a viewer with too many bytes in flight, and the 
+    # viewer is disconnected if no progress within stall timeout 
+    async def send_stream(self, writer, video_server, path): 
+        try: 
+            stream = video_server.stream_for(path) 
+        except Exception as e: 
+            logger.warning(f"Failed stream {path}: {e}") 
+            return await self.send_error(writer, 400 if isinstance(e, ValueError) else 503, str(e)) 
+        if stream is None: 
+            return await self.send_error(writer, 404, "File not found") 
+        if self._max_viewers > 0 and self._viewers >= self._max_viewers: 
+            logger.warning(f"Too many viewers: {self._viewers}") 
+            return await self.send_error(writer, 503, "Too many viewers") 
+        self._viewers += 1 
+        peer = writer.get_extra_info("peername") or ("", 0) 
+        self._watch(stream) 
+        client = StreamClient(stream, f"http {peer[0]}:{peer[1]}", self._max_inflight_bytes, self._stall_timeout) 
+        transport = writer.transport 
+        if client.max_inflight_bytes > 0: 
+            transport.set_write_buffer_limits(high = client.max_inflight_bytes) 
+        try: 
+            self.send_head(writer, 200, { 
+                "Age": 0, 
+                "Cache-Control": "no-cache, private", 
+                "Pragma": "no-cache", 
+                "Content-Type": f"multipart/x-mixed-replace; boundary={MULTIPART_BOUNDARY}", 
+            }) 
+            while True: 
+                frame = await self.read_frame(client) 
+                live = frame is not None 
+                if not live: 
+                    if not video_server.reconfiguring: 
+                        logger.warning("Failed capture live frame") 
+                    frame = video_server.idle_frame(stream) 
+                inflight_bytes = transport.get_write_buffer_size() 
+                if client.max_inflight_bytes > 0 and inflight_bytes > 0 \
+                        and inflight_bytes + len(frame.data) > client.max_inflight_bytes: 
+                    client.skip(inflight_bytes) 
+                    if client.stalled: 
+                        return self.disconnect_stalled(writer, client) 
+                    continue 
+                self.write_parts(writer, multipart_parts(frame)) 
+                if live: 
+                    client.sent(frame, len(frame.data), transport.get_write_buffer_size()) 
+                if not await self.drain(writer, client): 
+                    return 
+        finally: 
+            self._viewers -= 1 
+            client.close() 
+            if stream is not video_server.stream and stream.consumers == 0: 
+                self._unwatch(stream) 
+
+    # The transport joins the buffers of writelines into one (Python 3.11), 
+    # so while nothing is buffered in the transport the parts are written to 
+    # the socket with one writev (scatter/gather), and only the unsent tail is 
+    # copied into the transport, which sends it when the socket is writable. 
+    def write_parts(self, writer, parts): 
+        transport = writer.transport 
+        sock = writer.get_extra_info("socket") 
+        if sock is not None and transport.get_write_buffer_size() == 0 and not transport.is_closing(): 
+            parts = [memoryview(part) for part in parts] 
+            try: 
+                skip_sent(parts, os.writev(sock.fileno(), parts)) 
+            except (BlockingIOError, InterruptedError): 
+                pass 
+            except OSError as e: 
+                # e.g. connection reset, the transport fails on the write below 
+                logger.debug(f"Error to write parts: {e}") 
+        if parts: 
+            writer.writelines(parts) 
+
+    # return False if the client is disconnected for stall 
+    async def drain(self, writer, client): 
+        try: 
+            await asyncio.wait_for(writer.drain(), client.stall_timeout or None) 
+            return True 
+        except asyncio.TimeoutError: 
+            self.disconnect_stalled(writer, client) 
+            return False 
+
+    def disconnect_stalled(self, writer, client): 
+        logger.warning(f"Disconnect stalled viewer: {client.stats()}") 
+        writer.transport.abort() 
+
+    # an error with headers (e.g. Content-Range of 416) is sent with them 
+    async def send_response(self, writer, code, headers, body, head_only = False): 
+        if code >= 400 and not headers: 
+            return await self.send_error(writer, code) 
+        self.send_head(writer, code, dict(headers, **{"Content-Length": len(body)})) 
+        if not head_only: 
+            writer.write(body) 
+        await writer.drain() 
+
+    def peer(self, writer): 
+        return (writer.get_extra_info("peername") or ("", 0))[0] 
+
+    # chunks of the random buffer of speed test, with backpressure 
+    async def send_download(self, writer, chunks): 
+        speedtests = VideoServers().speedtests 
+        self.send_head(writer, 200, download_headers(chunks)) 
+        for _ in range(chunks): 
+            writer.write(speedtests.chunk) 
+            await writer.drain() 
+        speedtests.count("download", chunks * len(speedtests.chunk)) 
+
+    # upload of speed test is read and discarded, the result is recorded 
+    async def receive_speedtest(self, reader, writer, path, headers): 
+        length = headers.get("content-length", "") 
+        if not length.isdigit(): 
+            self._keep_alive[writer] = False 
+            return await self.send_error(writer, 411) 
+        speedtests = VideoServers().speedtests 
+        length = int(length) 
+        if urllib.parse.urlsplit(path).path == RESULT_PATH: 
+            if length > MAX_RESULT_SIZE: 
+                self._keep_alive[writer] = False 
+                return await self.send_error(writer, 413) 
+            try: 
+                result = speedtests.record(self.peer(writer), await reader.readexactly(length)) 
+            except ValueError as e: 
+                return await self.send_error(writer, 400, str(e)) 
+            return await self.send_response(writer, 200, {"Content-Type": "application/json"}, json.dumps(result.to_dict()).encode()) 
+        if headers.get("expect", "").lower() == "100-continue": 
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n") 
+        remaining = length 
+        while remaining > 0: 
+            data = await reader.read(min(remaining, 65536)) 
+            if not data: 
+                raise asyncio.IncompleteReadError(b"", remaining) 
+            remaining -= len(data) 
+        speedtests.count("upload", length) 
+        await self.send_response(writer, *speedtests.response(path, self.peer(writer))) 
+
+    # blocking responses are generated out of the event loop, e.g. tiles and 
+    # blocking playlist reloads of HLS 
+    async def send_blocking(self, writer, response, path): 
+        code, headers, body = await self._loop.run_in_executor(None, response, path) 
+        await self.send_response(writer, code, headers, body) 
+
+    # capture and encoding run in the workers of snapshot engine 
+    async def send_snapshot(self, writer, video_server, headers, format, quality = None): 
+        try: 
+            # shield the shared future from cancellation by timeout 
+            future = asyncio.wrap_future(video_server.snapshots.request(format, quality)) 
+            snapshot = await asyncio.wait_for(asyncio.shield(future), 10) 
+        except Exception as e: 
+            logger.warning(f"failed capture snapshot: {e}") 
+            image = video_server.logo.read() 
+            self.send_head(writer, 200, {"Content-type": "image/jpeg", "Content-Length": len(image)}) 
+            writer.write(image) 
+        else: 
+            if headers.get("if-none-match") == snapshot.etag: 
+                self.send_head(writer, 304, {"ETag": snapshot.etag}) 
+            else: 
+                self.send_head(writer, 200, snapshot_headers(snapshot)) 
+                writer.write(snapshot.data) 
+        await writer.drain() 
+
+    # web pages from memory, with the same path mapping as WebServer 
+    # recordings, segments are sent from file (sendfile), and the index and 
+    # frames are read in the executor 
+    async def send_recording(self, writer, video_server, path, headers = {}, head_only = False): 
+        code, response_headers, body = await self._loop.run_in_executor(None, recording_response, 
+                                                                        video_server.recorder, path, headers) 
+        if not isinstance(body, FileRange): 
+            return await self.send_response(writer, code, response_headers, body, head_only) 
+        self.send_head(writer, code, response_headers) 
+        await writer.drain() 
+        if not head_only: 
+            with open(body.path, "rb") as f: 
+                await self._loop.sendfile(writer.transport, f, body.offset, body.length) 
+
+    # clips of instant replay and timelapse movies, generated by the response 
+    # function and written frame by frame, "blocking" if the frames are read 
+    # from files, then they are read in the executor 
+    async def send_clip(self, writer, response, path, head_only = False, blocking = False): 
+        if blocking: 
+            code, headers, clip = await self._loop.run_in_executor(None, response, path) 
+        else: 
+            code, headers, clip = response(path) 
+        if isinstance(clip, bytes): 
+            return await self.send_response(writer, code, headers, clip, head_only) 
+        self.send_head(writer, code, headers) 
+        if not head_only: 
+            buffers_iter = clip.buffers() 
+            while True: 
+                if blocking: 
+                    buffers = await self._loop.run_in_executor(None, next, buffers_iter, None) 
+                else: 
+                    buffers = next(buffers_iter, None) 
+                if buffers is None: 
+                    break 
+                writer.writelines(buffers) 
+                await writer.drain() 
+        await writer.drain() 
+
+    async def send_file(self, writer, path, headers = {}, head_only = False): 
+        code, response_headers, body = self._www.response(path, headers) 
+        if code == 404: 
+            return await self.send_error(writer, 404, "File not found") 
+        self.send_head(writer, code, response_headers) 
+        if code == 200 and not head_only: 
+            writer.write(body) 
+        await writer.drain() 
+
 # Websocket server is used for bi-directional communications between camera and web pages.  
 import websockets
 import netifaces 
 
-def bash_run_d(command_args): 
-    logger.info(f"{command_args=}")
-    result = subprocess.run(command_args) 
-    logger.debug(f"returncode: {result.returncode }")
-    return result.returncode 
-
-def bash_run(command_args): 
-    logger.info(f"{command_args=}")
-    result = subprocess.run(command_args, capture_output=True, text=True) 
-    logger.debug(f"stdout---\n{result.stdout}")
-    logger.debug(f"stderr--\n{result.stderr}") 
-    logger.debug(f"returncode: {result.returncode }")
-    return result.returncode 
+from commands import CommandRunner 
+from telemetry import Telemetry 
 
 def check_network_addr(interface): 
     logger.info("Check interface addresses")
@@ -388,10 +1642,17 @@ def check_wifi_ap_id():
 
 # handle requests on websocket connection 
 # JSON-RPC 2.0 protocol 
+# Requests running commands are handled in their own tasks, so the other 
+# requests of the connection (e.g. "cancel_command") are handled meanwhile, 
+# and the output of the command is sent as "command_output" notifications 
+# with the id of the request. 
 class WebsocketConnection(object): 
+    COMMAND_METHODS = ("check_software_versions", "install_software", "setup_wifi_ap", "setup_wifi_sta") 
+
     def __init__(self, websocket): 
         # websocket 
         self._websocket = websocket 
+        self._tasks = {} # id -> task of request running a command 
 
         # supported reqeusts 
         self._handlers = {
@@ -404,8 +1665,14 @@ class WebsocketConnection(object):
             "setup_wifi_ap": self.setup_wifi_ap, 
             "check_wifi_sta_status": self.check_wifi_sta_status, 
             "setup_wifi_sta": self.setup_wifi_sta, 
+            "check_cameras": self.check_cameras, 
             "check_video_settings": self.check_video_settings, 
             "setup_video": self.setup_video, 
+            "check_stream_status": self.check_stream_status, 
+            "set_roi": self.set_roi, 
+            "cancel_command": self.cancel_command, 
+            "subscribe": self.subscribe, 
+            "unsubscribe": self.unsubscribe, 
         } 
 
         # paths 
@@ -438,6 +1705,10 @@ class WebsocketConnection(object):
         logger.info("Send result response...")
         await self.send_response({ "result": result, "id": id }) 
 
+    # notification has no id and no response 
+    async def send_notification(self, method, params = None): 
+        await self.send_response({ "method": method, "params": params }) 
+
     # handle requests 
     # only interrupted by disconnected (receive error) 
     async def handle_requests(self): 
@@ -445,11 +1716,42 @@ class WebsocketConnection(object):
             try: 
                 request = json.loads(message) 
                 logger.info(f"Request received: {request}")
-                await self.handle_request(request)
+                if isinstance(request, dict) and request.get("method") in self.COMMAND_METHODS: 
+                    self.start_request(request) 
+                else: 
+                    await self.handle_request(request)
             except Exception as e: 
                 logger.warning(f"Error to handle request: {e}")
                 await self.send_status_response(-1, f"{message}:{e}", 0)
 
+    # handle the request in a task, one at a time for each id 
+    def start_request(self, request): 
+        id = request.get("id") 
+        if id in self._tasks: 
+            raise Exception(f"Request {id} is running") 
+        task = asyncio.create_task(self.handle_request(request)) 
+        self._tasks[id] = task 
+        task.add_done_callback(lambda _: self._tasks.pop(id, None)) 
+
+    # run a command, its output is sent to the client of the request 
+    async def run_command(self, command_args, id = None, heavy = False): 
+        async def output(stream, line): 
+            await self.send_notification("command_output", {"id": id, "stream": stream, "line": line}) 
+        return await WebsocketServer().commands.run(command_args, output, heavy = heavy) 
+
+    # cancel the running request, params: {"id": <id of the request>}, 
+    # the command of the request is killed 
+    async def cancel_command(self, params = None, id = None): 
+        logger.info(f"cancel_command: {params}") 
+        request_id = params.get("id") if params else None 
+        task = self._tasks.get(request_id) 
+        if task is None: 
+            raise Exception(f"Request {request_id} is not running") 
+        task.cancel() 
+        await asyncio.wait([task]) 
+        await self.send_status_response(-1, "Command cancelled", request_id) 
+        await self.send_status_response(0, f"Request {request_id} cancelled", id) 
+
     async def handle_request(self, request): 
         assert(isinstance(request, dict))
         method = request["method"] if "method" in request else None 
@@ -467,13 +1769,37 @@ class WebsocketConnection(object):
         except Exception as e: 
             await self.send_status_response(-1, str(e), id)
 
+    # current system status, and the telemetry topics to subscribe 
     async def check_system_status(self, params = None, id = None): 
         logger.info("check_system_status") 
-        await self.send_status_response(-1, "Not implemented", id) 
+        telemetry = WebsocketServer().telemetry 
+        result = telemetry.sample(["cpu", "temperature", "memory"]) 
+        result["topics"] = telemetry.topics 
+        result["telemetry"] = telemetry.stats() 
+        await self.send_result_response(result, id) 
+
+    # subscribe to telemetry topics, params: {"topics": [...]}, the values are 
+    # sent as "telemetry" notifications {topic: value} when they change 
+    async def subscribe(self, params = None, id = None): 
+        logger.info(f"subscribe: {params}") 
+        topics = params.get("topics") if params else None 
+        if not isinstance(topics, list) or not topics: 
+            raise Exception("Telemetry topics are not set") 
+        async def notify(values): 
+            await self.send_notification("telemetry", values) 
+        subscribed = await WebsocketServer().telemetry.subscribe(self, topics, notify) 
+        await self.send_result_response({"topics": subscribed, "interval": WebsocketServer().telemetry.interval}, id) 
+
+    # unsubscribe from telemetry topics, params: {"topics": [...]}, all if not set 
+    async def unsubscribe(self, params = None, id = None): 
+        logger.info(f"unsubscribe: {params}") 
+        topics = params.get("topics") if params else None 
+        subscribed = WebsocketServer().telemetry.unsubscribe(self, topics) 
+        await self.send_result_response({"topics": subscribed}, id) 
 
     async def restart_system(self, params = None, id = None): 
         logger.warning("restart_system")
-        code = bash_run_d(["sudo", "-b", "bash", "-c", "sleep 5; reboot"]) 
+        code = await WebsocketServer().commands.run(["sudo", "-b", "bash", "-c", "sleep 5; reboot"]) 
         if code == 0: 
             logger.info("Restart system successfully")
             await self.send_status_response(-1, "System restart, please reconnect later", id) 
@@ -483,7 +1809,7 @@ class WebsocketConnection(object):
 
     async def shutdown_system(self, params = None, id = None): 
         logger.warning("shutdown_system")
-        code = bash_run_d(["sudo", "-b", "bash", "-c", "sleep 5; shutdown now"])  
+        code = await WebsocketServer().commands.run(["sudo", "-b", "bash", "-c", "sleep 5; shutdown now"])  
         if code == 0: 
             logger.info("Shutdown system successfully")
             await self.send_status_response(-1, "System shutdown in 10 seconds", id) 
@@ -494,7 +1820,7 @@ class WebsocketConnection(object):
     async def check_software_versions(self, params = None, id = None): 
         logger.info("check_software_versions")
         # first try to check software updates 
-        code = bash_run([os.path.join(self.software_dir, "updates.sh"), "check"])
+        code = await self.run_command([os.path.join(self.software_dir, "updates.sh"), "check"], id, heavy = True)
         if code == 0: 
             logger.info("Check software updates successfully")
             await self.send_status_response(0, "Check software updates successfully", id)
@@ -551,7 +1877,7 @@ class WebsocketConnection(object):
         if version:
             logger.info(f"install software {version}") 
             await self.send_status_response(-1, "Installation takes time, please wait...", id) 
-            code = bash_run([os.path.join(self.software_dir, "updates.sh"), "install", version]) 
+            code = await self.run_command([os.path.join(self.software_dir, "updates.sh"), "install", version], id, heavy = True) 
             if code == 0: 
                 logger.info(f"Software {version} installed successfully")
                 await self.send_status_response(0, f"Software {version} installed successfully", id) 
@@ -609,7 +1935,7 @@ class WebsocketConnection(object):
             if ssid == current_ssid: 
                 await self.send_status_response(0, "WiFi settings has no change", id)
             else: 
-                code = bash_run([os.path.join(self.network_dir, "setup-wifi-ap.sh"), ssid, current_password])
+                code = await self.run_command([os.path.join(self.network_dir, "setup-wifi-ap.sh"), ssid, current_password], id)
                 if code == 0: 
                     logger.info("WiFi settings changed")
                     await self.send_status_response(0, "WiFi settings changed", id) 
@@ -668,76 +1994,136 @@ class WebsocketConnection(object):
             if ssid == current_ssid and password == current_password: 
                 await self.send_status_response(-1, "WiFi settings has no change", id)
             else: 
-                code = bash_run([os.path.join(self.network_dir, "setup-wifi-sta.sh"), ssid, password])
+                code = await self.run_command([os.path.join(self.network_dir, "setup-wifi-sta.sh"), ssid, password], id)
                 if code == 0: 
                     logger.info("WiFi settings changed")
                     await self.send_status_response(0, "WiFi settings changed", id) 
                     await self.restart_system(id=id)
                 else: 
-                    logger.warning(f"Failed to change WiFi settings: {e}")
-                    await self.send_status_response(-1, f"Failed to change WiFi settings: {e}", id) 
+                    logger.warning(f"Failed to change WiFi settings: {code}")
+                    await self.send_status_response(-1, f"Failed to change WiFi settings: {code}", id) 
         else: 
             raise Exception("WiFi SSID is not set") 
 
+    # the video methods are of a camera, params: {"camera": <id>, ...}, camera 
+    # 0 if not set 
+    def video_server_of(self, params): 
+        return VideoServers().get(params.get("camera") if isinstance(params, dict) else None) 
+
+    # cameras served, and the prefix of their paths 
+    async def check_cameras(self, params = None, id = None): 
+        logger.info("check_cameras") 
+        result = [{"id": video_server.id, "path": f"/cam/{video_server.id}/", "settings": video_server.settings} 
+                  for video_server in VideoServers()] 
+        await self.send_result_response(result, id) 
+
     async def check_video_settings(self, params = None, id = None): 
         logger.info("check_video_settings") 
-        await self.send_result_response(VideoServer().settings, id)
+        await self.send_result_response(self.video_server_of(params).settings, id)
+
+    async def check_stream_status(self, params = None, id = None): 
+        logger.info("check_stream_status") 
+        video_server = self.video_server_of(params) 
+        result = { 
+            "camera": video_server.id, 
+            "seq": video_server.stream.seq, 
+            "consumers": video_server.stream.stats(), 
+            "variants": video_server.variants.stats(), 
+            "hls": video_server.hls.stats() if video_server.hls is not None else None, 
+            "snapshot": video_server.snapshots.stats(), 
+            "tiles": video_server.tiles.stats(), 
+            "thumbnail": video_server.thumbnails.stats(), 
+            "speedtest": dict(VideoServers().speedtests.stats(), results=VideoServers().speedtests.results()), 
+            "workers": WorkerProcesses().stats(), 
+            "recorder": video_server.recorder.stats() if video_server.recorder is not None else None, 
+            "motion": video_server.motion.stats() if video_server.motion is not None else None, 
+            "instant_replay": video_server.instant_replay.stats() if video_server.instant_replay is not None else None, 
+            "timelapse": video_server.timelapse.stats() if video_server.timelapse is not None else None, 
+            "roi": { 
+                "mode": video_server.roi_mode, 
+                "rect": video_server.update_roi(), 
+                "consumers": video_server.roi_stream.stats() if video_server.roi_mode == "crop" else [], 
+            }, 
+        } 
+        await self.send_result_response(result, id) 
+
+    # viewer of the web page requests the region of interest of its zoomed view, 
+    # params: {"rect": [x, y, width, height]} normalized to the full frame, or 
+    # {"rect": null} to release, the request must be renewed within the lease 
+    async def set_roi(self, params = None, id = None): 
+        logger.info(f"set_roi: {params}") 
+        video_server = self.video_server_of(params) 
+        rect = params.get("rect") if params else None 
+        granted, active = video_server.request_roi(self, rect) 
+        result = { 
+            "granted": granted, 
+            "rect": active, 
+            "mode": video_server.roi_mode, 
+            "url": "roi.mjpg", 
+        } 
+        await self.send_result_response(result, id) 
 
+    # release resources held by the connection 
+    def close(self): 
+        for video_server in VideoServers(): 
+            video_server.release_roi(self) 
+        WebsocketServer().telemetry.unsubscribe(self) 
+
+    # apply video settings at once, all are validated before any is applied, 
+    # controls are set together and the camera is reconfigured at most once, 
+    # the result is the video settings (as "check_video_settings"), with the 
+    # changed settings and the result of reconfiguration 
     async def setup_video(self, params = None, id = None): 
         logger.info(f"setup_video: {params}") 
-        video_server = VideoServer() 
-        # apply controls 
-        if ("af_mode" in params and video_server.apply_af_mode(params["af_mode"])): 
-            logger.info("Video AF mode changed")
-            await self.send_status_response(0, "Apply video AF mode successfully", id) 
-        else: 
-            pass # await self.send_status_response(0, "Video AF mode is not changed", id)
-        if ("awb_mode" in params and video_server.apply_awb_mode(params["awb_mode"])): 
-            logger.info("Video AWB mode changed")
-            await self.send_status_response(0, "Apply video AWB mode successfully", id) 
-        else: 
-            pass # await self.send_status_response(0, "Video AWB mode is not changed", id) 
-        if ("brightness" in params and video_server.apply_brightness(params["brightness"])): 
-            logger.info("Video brightness changed")
-            await self.send_status_response(0, "Apply video brightness successfully", id) 
-        else: 
-            pass # await self.send_status_response(0, "Video brightness is not changed", id) 
-        # apply configurations 
-        need_restart = False 
-        if ("transform" in params and video_server.update_transform(params["transform"])): 
-            logger.info("Video transform changed")
-            await self.send_status_response(0, "Apply video transform successfully", id) 
-            need_restart = True 
-        else: 
-            pass # await self.send_status_response(0, "Video transform is not changed", id)
-        if ("frame_rate" in params and video_server.update_frame_rate(params["frame_rate"])): 
-            logger.info("Video frame rate changed")
-            await self.send_status_response(0, "Apply video frame rate successfully", id) 
-            need_restart = True 
+        if not isinstance(params, dict): 
+            raise Exception("Video settings are not set") 
+        video_server = self.video_server_of(params) 
+        params = {name: value for name, value in params.items() if name != "camera"} 
+        changed, need_reconfigure = video_server.apply_settings(params) 
+        if changed: 
+            logger.info(f"Video settings changed: {changed}")
+            names = ", ".join(name.replace("_", " ") for name in changed) 
+            await self.send_status_response(0, f"Apply video settings successfully: {names}", id) 
         else: 
-            pass # await self.send_status_response(0, "Video frame rate is not changed", id)
-        if ("resolution" in params and video_server.update_resolution(params["resolution"])): 
-            logger.info("Video resolution changed")
-            await self.send_status_response(0, "Apply video resolution successfully", id) 
-            need_restart = True 
-        else: 
-            pass # await self.send_status_response(0, "Video resolution is not changed", id)
-        # restart for configurations 
-        if need_restart: 
-            logger.warning("Restart video to apply configurations")
-            # await self.send_status_response(-1, "Restart video, please reconnect later", id) 
-            video_server.restart() 
+            await self.send_status_response(0, "Video settings are not changed", id) 
+        # reconfigure for configurations, viewers stay connected 
+        reconfigure = None 
+        if need_reconfigure: 
+            logger.warning("Reconfigure video to apply configurations")
+            reconfigure = await asyncio.get_running_loop().run_in_executor(None, video_server.reconfigure) 
+        result = dict(video_server.settings, changed=changed, reconfigure=reconfigure) 
+        await self.send_result_response(result, id) 
 
 
+WEBSOCKET_CONNECTIONS = registry.gauge("camera_websocket_connections", "Connections of websocket server") 
+
 @singleton
 class WebsocketServer(object): 
-    def __init__(self, port = 8090): 
+    def __init__(self, port = 8090, max_heavy_commands = 1, command_timeout = 600, telemetry_interval = 1.0): 
         self.port = port 
+        self._commands = CommandRunner(max_heavy_commands, command_timeout) 
+        self._telemetry = Telemetry(telemetry_interval) 
         self._connections = set() 
+        WEBSOCKET_CONNECTIONS.set_function(lambda: len(self._connections)) 
         self._server = None
         self._stop_event = None  
         self._loop = None 
         self._thread = None 
+        self._attached = [] 
+
+    # commands of the admin page run in the loop 
+    @property 
+    def commands(self): 
+        return self._commands 
+
+    # telemetry sampled in the loop for subscribers 
+    @property 
+    def telemetry(self): 
+        return self._telemetry 
+
+    # attach another server (with async start and stop) to run in the same loop 
+    def attach(self, server): 
+        self._attached.append(server) 
 
     # connection handler 
     async def handler(self, websocket):
@@ -754,6 +2140,7 @@ class WebsocketServer(object):
         finally: 
             logger.error(f"Remove websocket connection from {websocket.remote_address[0]}")
             self._connections.remove(connection)
+            connection.close() 
 
     def run_forever(self):
         async def _run(): 
@@ -761,7 +2148,11 @@ class WebsocketServer(object):
             self._loop = asyncio.get_running_loop() 
             self._stop_event = asyncio.Event() 
             self._server = await websockets.serve(self.handler, "0.0.0.0", self.port)
+            for server in self._attached: 
+                await server.start() 
             await self._stop_event.wait()
+            for server in self._attached: 
+                await server.stop() 
             await self._server.wait_closed() 
         asyncio.run(_run())
 
@@ -786,12 +2177,304 @@ import signal
 def handle_signal(signum, frame):
     logger.warning("Kill signal received")
 
+# parameters of the parts of a video server, {part: {parameter: key of 
+# camera.json}}, an optional part is enabled by the key of its name 
+VIDEO_SERVER_SETTINGS = { 
+    "snapshot": {"workers": "snapshot_workers", "max_age": "snapshot_max_age", "quality": "snapshot_quality"}, 
+    "tiles": {"max_bytes": "tile_cache_bytes"}, 
+    "thumbnail": {"width": "thumbnail_width", "quality": "thumbnail_quality", "max_age": "thumbnail_max_age"}, 
+    "roi": {"mode": "roi_mode", "policy": "roi_policy", "lease": "roi_lease", "fps": "roi_fps", "quality": "roi_quality"}, 
+    "variants": {"max_variants": "stream_max_variants", "idle_timeout": "stream_variant_idle_timeout"}, 
+    "hls": {"bitrate": "hls_bitrate", "segment_duration": "hls_segment_duration", 
+            "part_duration": "hls_part_duration", "segments": "hls_segments"}, 
+    "record": {"directory": "record_dir", "max_bytes": "record_max_bytes", 
+               "segment_duration": "record_segment_duration", "on_motion": "record_on_motion"}, 
+    "motion": {"width": "motion_width", "fps": "motion_fps", "budget": "motion_budget", "threshold": "motion_threshold", 
+               "area": "motion_area", "zones": "motion_zones", "hold": "motion_hold", "snapshot": "motion_snapshot"}, 
+    "instant_replay": {"max_bytes": "instant_replay_max_bytes"}, 
+    "timelapse": {"directory": "timelapse_dir", "interval": "timelapse_interval", 
+                  "resolution": "timelapse_resolution", "quality": "timelapse_quality"}, 
+} 
+OPTIONAL_PARTS = ("hls", "record", "motion", "instant_replay", "timelapse") 
+
+# options of the camera backend, by the keys of camera.json 
+def camera_options_of(config): 
+    camera_backend = config["camera_backend"] 
+    if camera_backend == "picamera2": 
+        return {"camera_num": config["camera_num"]} 
+    if camera_backend == "replay": 
+        return {"file": config["replay_file"], "loop": config["replay_loop"]} 
+    if camera_backend == "relay": 
+        return {"url": config["relay_url"], "timeout": config["relay_timeout"], 
+                "reconnect_delay": config["relay_reconnect_delay"], 
+                "max_reconnect_delay": config["relay_max_reconnect_delay"]} 
+    # the frames of the capture process in shared memory, set by worker_main 
+    if camera_backend == "ring": 
+        return config["ring"] 
+    return {} 
+
+# video server of a camera, the config is camera.json with the settings of 
+# the camera (see main) 
+def create_video_server(camera_id, config): 
+    logger.info(f"{camera_id=}") 
+    video_config = config["video_config"] 
+    logger.info(f"{video_config=}") 
+    camera_backend = config["camera_backend"] 
+    logger.info(f"{camera_backend=}") 
+    camera_options = camera_options_of(config) 
+    logger.info(f"{camera_options=}") 
+    parts = {} 
+    for part, keys in VIDEO_SERVER_SETTINGS.items(): 
+        if part in OPTIONAL_PARTS and not config[part]: 
+            parts[part] = None 
+        else: 
+            parts[part] = {name: config[key] for name, key in keys.items()} 
+        logger.info(f"{part}: {parts[part]}") 
+    return VideoServer(camera_id, video_config, camera_backend, camera_options, **parts) 
+
+# web server of the "http_mode" of camera.json, the port is shared by the 
+# web servers of worker processes with "reuse_port" 
+def create_web_server(config, reuse_port = False): 
+    http_port = config["http_port"]
+    logger.info(f"{http_port=}") 
+    http_mode = config["http_mode"] 
+    max_viewers = config["max_viewers"] 
+    logger.info(f"{max_viewers=}") 
+    max_inflight_bytes = config["stream_max_inflight_bytes"] 
+    logger.info(f"{max_inflight_bytes=}") 
+    stall_timeout = config["stream_stall_timeout"] 
+    logger.info(f"{stall_timeout=}") 
+    www_max_age = config["www_max_age"] 
+    logger.info(f"{www_max_age=}") 
+    keep_alive_timeout = config["http_keep_alive_timeout"] 
+    logger.info(f"{keep_alive_timeout=}") 
+    if http_mode == "asyncio": 
+        return AsyncWebServer(http_port, max_viewers, max_inflight_bytes, stall_timeout, "www", 
+                              www_max_age, keep_alive_timeout, reuse_port) 
+    return WebServer(http_port, max_viewers, max_inflight_bytes, stall_timeout, www_max_age, keep_alive_timeout, 
+                     reuse_port) 
+
+# Multi-process mode: this process (the capture process) owns the cameras 
+# and runs the encoders, the websocket server, HLS, recording, motion 
+# detection, instant replay and timelapse, and "workers" worker processes 
+# run the web servers on the same port (SO_REUSEPORT, the kernel spreads the 
+# connections over them). The stream of each camera (and its ROI stream in 
+# "crop" mode) is exported to a ring in shared memory (see shared_ring.py), 
+# which the workers publish to their own stream buffers, so the viewers, 
+# stream variants, thumbnails and the encoding of snapshots and tiles run in 
+# the workers, each in its own interpreter, and never stall the encoders. 
+# Snapshot images are captured here and encoded by the workers. A worker 
+# which exits is started again by the supervisor (see supervisor.py). 
+
+from shared_ring import SharedFrameRing, RingExporter, RingFeeder, RequestService, RequestClient 
+from supervisor import Supervisor 
+
+@singleton 
+class WorkerProcesses(object): 
+    def __init__(self, workers = 0, ring_slots = 16, ring_slot_bytes = 2097152, args = ()): 
+        self._workers = workers 
+        self._ring_slots = ring_slots 
+        self._ring_slot_bytes = ring_slot_bytes 
+        self._args = args # passed to worker_main after the names of the rings 
+        self._rings = [] 
+        self._exporters = [] 
+        self._supervisor = None 
+        self._request_service = None 
+
+    @property 
+    def workers(self): 
+        return self._workers 
+
+    # viewers of the web servers of all workers 
+    @property 
+    def viewers(self): 
+        return self._supervisor.viewers if self._supervisor is not None else 0 
+
+    # None if the mode is not running 
+    def stats(self): 
+        if self._supervisor is None: 
+            return None 
+        return dict(self._supervisor.stats(), requests = self._request_service.stats()) 
+
+    def _doorbells(self): 
+        return self._supervisor.doorbells() if self._supervisor is not None else [] 
+
+    def _create_ring(self, name, slots, slot_bytes): 
+        ring = SharedFrameRing(f"livecamera-{os.getpid()}-{name}", slots, slot_bytes) 
+        self._rings.append(ring) 
+        return ring 
+
+    def start(self): 
+        if self._supervisor is not None: 
+            return 
+        logger.info(f"Start multi-process mode with {self._workers} workers") 
+        names = [] # camera id -> names of the rings 
+        snapshot_rings = {} 
+        for video_server in VideoServers(): 
+            streams = {"stream": video_server.stream} 
+            if video_server.roi_mode == "crop": 
+                streams["roi"] = video_server.roi_stream 
+            camera_names = {} 
+            for key, stream in streams.items(): 
+                ring = self._create_ring(stream.name, self._ring_slots, self._ring_slot_bytes) 
+                self._exporters.append(RingExporter(stream, ring, self._doorbells)) 
+                camera_names[key] = ring.name 
+            # RGB images of the largest snapshot resolution 
+            pixels = max(width * height for width, height in 
+                         (option["value"] for option in video_server.settings["snapshot_resolution"]["options"])) 
+            ring = self._create_ring(f"cam{video_server.id}_snapshot", 2, pixels * 3) 
+            snapshot_rings[video_server.id] = ring 
+            camera_names["snapshot"] = ring.name 
+            names.append(camera_names) 
+        for exporter in self._exporters: 
+            exporter.start() 
+        self._supervisor = Supervisor(self._workers, worker_main, (names,) + tuple(self._args)) 
+        self._request_service = RequestService(snapshot_rings, VideoServers().get, self._supervisor.connections) 
+        self._request_service.start() 
+        self._supervisor.start() 
+
+    def stop(self): 
+        if self._supervisor is not None: 
+            for exporter in self._exporters: 
+                exporter.stop() 
+            self._request_service.stop() 
+            self._supervisor.stop() 
+            for ring in self._rings: 
+                ring.close() 
+            self._exporters = [] 
+            self._rings = [] 
+            self._supervisor = None 
+
+# Worker process of multi-process mode, started by the supervisor in a fresh 
+# interpreter. The video servers read the frames of the capture process from 
+# shared memory (the "ring" camera backend), without HLS, recording, motion 
+# detection, instant replay and timelapse, which run in the capture process, 
+# and the web server shares the port with the other workers. 
+def worker_main(index, doorbell, requests, viewers, rings, config, camera_configs, log_level = "INFO"): 
+    logging.basicConfig(level=log_level, format=f"%(asctime)s - %(levelname)s - worker {index} - %(message)s") 
+    # SIGINT of the terminal is handled by the capture process, which stops 
+    # the workers with SIGTERM 
+    stop_event = threading.Event() 
+    signal.signal(signal.SIGINT, signal.SIG_IGN) 
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set()) 
+    feeder = RingFeeder(doorbell, on_close = stop_event.set) 
+    snapshots = RequestClient(requests, {camera_id: SharedFrameRing(names["snapshot"]) 
+                                         for camera_id, names in enumerate(rings)}) 
+    # "/metrics" of the worker has the metrics of the capture process 
+    registry.set_remote(snapshots.metrics, [("worker", index)]) 
+    video_servers = VideoServers() 
+    for camera_id, (camera_config, names) in enumerate(zip(camera_configs, rings)): 
+        ring = {"camera_id": camera_id, "ring": SharedFrameRing(names["stream"]), "feeder": feeder, "snapshots": snapshots} 
+        worker_config = dict(camera_config, camera_backend = "ring", ring = ring, hls = False, record = False, 
+                             motion = False, instant_replay = False, timelapse = False) 
+        video_servers.add(create_video_server(camera_id, worker_config)) 
+    for video_server in video_servers: 
+        video_server.start() 
+        if "roi" in rings[video_server.id]: 
+            feeder.add(SharedFrameRing(rings[video_server.id]["roi"]), video_server.roi_stream) 
+    feeder.start() 
+
+    # the viewers are counted in the shared array of the supervisor 
+    web_server = create_web_server(config, reuse_port = True) 
+    if config["http_mode"] == "asyncio": 
+        async def serve(): 
+            await web_server.start() 
+            loop = asyncio.get_running_loop() 
+            while not await loop.run_in_executor(None, stop_event.wait, 1): 
+                viewers[index] = web_server.viewers 
+            await web_server.stop() 
+        asyncio.run(serve()) 
+    else: 
+        web_server.start() 
+        while not stop_event.wait(1): 
+            viewers[index] = web_server.viewers 
+        web_server.stop() 
+    logger.info("Stop worker") 
+    feeder.stop() 
+    for video_server in video_servers: 
+        video_server.stop() 
+        video_server.variants.stop() 
+        video_server.snapshots.shutdown() 
+
+# telemetry topics of the camera, prefixed by "cam<n>_" except camera 0 
+def add_camera_topics(telemetry, video_server): 
+    prefix = f"cam{video_server.id}_" if video_server.id else "" 
+    stream = video_server.stream 
+    telemetry.add_topic(f"{prefix}fps", lambda: stream.seq, counter = True) 
+    telemetry.add_topic(f"{prefix}bitrate", lambda: stream.bytes_published * 8, counter = True) 
+    # motion events are pushed as they happen 
+    motion = video_server.motion 
+    if motion is not None: 
+        telemetry.add_topic(f"{prefix}motion", motion.status) 
+        motion.add_listener(lambda event: telemetry.publish(f"{prefix}motion")) 
+
 def main(config_file = None): 
     # default config 
     config = {
         "ws_port": 8090, 
         "http_port": 8080, 
+        "http_mode": "threading", 
+        "max_viewers": 0, 
+        "stream_max_inflight_bytes": 1048576, 
+        "stream_stall_timeout": 10, 
+        "www_max_age": 604800, 
+        "http_keep_alive_timeout": 30, 
+        "http_workers": 0, 
+        "frame_ring_slots": 16, 
+        "frame_ring_slot_bytes": 2097152, 
         "video_config": "video_config.json", 
+        "snapshot_workers": 2, 
+        "snapshot_max_age": 1.0, 
+        "snapshot_quality": 90, 
+        "tile_cache_bytes": 33554432, 
+        "thumbnail_width": 320, 
+        "thumbnail_quality": 75, 
+        "thumbnail_max_age": 1.0, 
+        "roi_mode": "crop", 
+        "roi_policy": "latest", 
+        "roi_lease": 10, 
+        "roi_fps": 15, 
+        "roi_quality": 80, 
+        "stream_max_variants": 4, 
+        "stream_variant_idle_timeout": 10, 
+        "hls": False, 
+        "hls_bitrate": 4000000, 
+        "hls_segment_duration": 2, 
+        "hls_part_duration": 0.5, 
+        "hls_segments": 6, 
+        "cameras": [], 
+        "camera_backend": "picamera2", 
+        "camera_num": 0, 
+        "replay_file": "", 
+        "replay_loop": True, 
+        "relay_url": "", 
+        "relay_timeout": 10, 
+        "relay_reconnect_delay": 1.0, 
+        "relay_max_reconnect_delay": 30.0, 
+        "max_heavy_commands": 1, 
+        "command_timeout": 600, 
+        "telemetry_interval": 1.0, 
+        "record": False, 
+        "record_dir": "recordings", 
+        "record_max_bytes": 4294967296, 
+        "record_segment_duration": 60, 
+        "record_on_motion": False, 
+        "motion": False, 
+        "motion_width": 160, 
+        "motion_fps": 10, 
+        "motion_budget": 0.05, 
+        "motion_threshold": 25, 
+        "motion_area": 0.01, 
+        "motion_zones": {}, 
+        "motion_hold": 2, 
+        "motion_snapshot": False, 
+        "instant_replay": False, 
+        "instant_replay_max_bytes": 134217728, 
+        "timelapse": False, 
+        "timelapse_dir": "timelapse", 
+        "timelapse_interval": 60, 
+        "timelapse_resolution": [640, 360], 
+        "timelapse_quality": 85, 
     }
     logger.info(f"Default camera config: {config}")
 
@@ -802,23 +2485,72 @@ def main(config_file = None):
             config.update(json.load(f))
             logger.info(f"Updated camera config: {config}")
 
-    # run video stream server 
-    video_config = config["video_config"] 
-    logger.info(f"{video_config=}") 
-    video_server = VideoServer(video_config) 
-    video_server.start() 
-
-    # run websocket server 
+    # run video stream servers, one for each camera of "cameras", whose 
+    # settings overwrite the config above, or one camera of the config 
+    camera_configs = [] 
+    for camera_num, camera in enumerate(config["cameras"] or [{}]): 
+        camera_config = dict(config, camera_num = camera_num) 
+        camera_config.update(camera) 
+        camera_configs.append(camera_config) 
+    # the files of a camera are its own 
+    for key, enabled in (("video_config", None), ("record_dir", "record"), ("timelapse_dir", "timelapse")): 
+        paths = [camera_config[key] for camera_config in camera_configs if enabled is None or camera_config[enabled]] 
+        if len(set(paths)) < len(paths): 
+            raise Exception(f"Cameras share {key}: {paths}") 
+    video_servers = VideoServers() 
+    for camera_id, camera_config in enumerate(camera_configs): 
+        video_servers.add(create_video_server(camera_id, camera_config)) 
+    for video_server in video_servers: 
+        video_server.start() 
+        if video_server.recorder is not None: 
+            video_server.recorder.start() 
+        if video_server.instant_replay is not None: 
+            video_server.instant_replay.start() 
+        if video_server.timelapse is not None: 
+            video_server.timelapse.start() 
+
+    # websocket server 
     ws_port = config["ws_port"] 
     logger.info(f"{ws_port=}")
-    ws_server = WebsocketServer(ws_port)
-    ws_server.start() 
+    max_heavy_commands = config["max_heavy_commands"] 
+    logger.info(f"{max_heavy_commands=}") 
+    command_timeout = config["command_timeout"] 
+    logger.info(f"{command_timeout=}") 
+    telemetry_interval = config["telemetry_interval"] 
+    logger.info(f"{telemetry_interval=}") 
+    ws_server = WebsocketServer(ws_port, max_heavy_commands, command_timeout, telemetry_interval)
+
+    # web server, "threading" mode uses a thread per connection, "asyncio" 
+    # mode runs in the event loop of websocket server, with "http_workers" 
+    # the web servers run in worker processes instead 
+    http_mode = config["http_mode"] 
+    logger.info(f"{http_mode=}") 
+    http_workers = config["http_workers"] 
+    logger.info(f"{http_workers=}") 
+    if http_workers > 0: 
+        frame_ring_slots = config["frame_ring_slots"] 
+        logger.info(f"{frame_ring_slots=}") 
+        frame_ring_slot_bytes = config["frame_ring_slot_bytes"] 
+        logger.info(f"{frame_ring_slot_bytes=}") 
+        log_level = logging.getLevelName(logging.getLogger().getEffectiveLevel()) 
+        web_server = WorkerProcesses(http_workers, frame_ring_slots, frame_ring_slot_bytes, 
+                                     (config, camera_configs, log_level)) 
+        web_server.start() 
+    elif http_mode == "asyncio": 
+        web_server = create_web_server(config) 
+        ws_server.attach(web_server) 
+    else: 
+        web_server = create_web_server(config) 
+        web_server.start() 
+
+    # telemetry of streams, frame rate and bitrate are rates of counters 
+    telemetry = ws_server.telemetry 
+    telemetry.add_topic("viewers", lambda: web_server.viewers) 
+    for video_server in video_servers: 
+        add_camera_topics(telemetry, video_server) 
 
-    # run web server 
-    http_port = config["http_port"]
-    logger.info(f"{http_port=}") 
-    web_server = WebServer(http_port)
-    web_server.start() 
+    # run websocket server 
+    ws_server.start() 
 
     try: 
         signal.signal(signal.SIGINT, handle_signal) 
@@ -826,9 +2558,20 @@ def main(config_file = None):
     except Exception as e:
         logger.error(f"Error: {e}")
     finally: 
-        web_server.stop() 
+        if http_workers > 0 or http_mode != "asyncio": 
+            web_server.stop() 
         ws_server.stop() 
-        video_server.stop() 
+        for video_server in video_servers: 
+            if video_server.recorder is not None: 
+                video_server.recorder.stop() 
+            if video_server.instant_replay is not None: 
+                video_server.instant_replay.stop() 
+            if video_server.timelapse is not None: 
+                video_server.timelapse.stop() 
+            video_server.stop() 
+            video_server.save_settings() 
+            video_server.variants.stop() 
+            video_server.snapshots.shutdown() 
 
 import argparse
 if __name__ == "__main__":
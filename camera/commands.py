@@ -0,0 +1,133 @@
+import os
+import time
+import signal
+import asyncio
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Commands of the admin page (e.g. "updates.sh", which downloads with curl,
+# and the WiFi setup scripts) run as subprocesses of the event loop of the
+# websocket server, so the loop keeps serving other connections while they
+# run. The lines of stdout and stderr are passed to a callback as they come,
+# e.g. to be sent to the client as notifications.
+# A command is killed (with its children, e.g. curl) when it times out or
+# its task is cancelled. "Heavy" commands (downloads and installation) are
+# limited to "max_heavy" at a time, others wait for a slot.
+
+# longest line of output, longer lines are split
+MAX_LINE = 64 * 1024
+# seconds to wait after SIGTERM before SIGKILL
+KILL_TIMEOUT = 5
+
+class CommandRunner(object):
+    def __init__(self, max_heavy = 1, timeout = 600):
+        self._max_heavy = max_heavy
+        self._timeout = timeout
+        self._heavy = None # semaphore, created in the loop
+        self._running = {} # pid -> (args, start time)
+        self._stats = {"commands": 0, "failed": 0, "timeouts": 0, "cancelled": 0}
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+    # run the command, return the exit code, "output" is an async function
+    # called with the name of the stream ("stdout" or "stderr") and a line,
+    # the output is discarded if None (e.g. "sudo -b", whose background child
+    # would hold the pipes), raise an exception on timeout (None for the default timeout, 0 for no
+    # timeout), and asyncio.CancelledError if cancelled
+    async def run(self, command_args, output = None, timeout = None, heavy = False):
+        timeout = self._timeout if timeout is None else timeout
+        if heavy:
+            if self._heavy is None:
+                self._heavy = asyncio.Semaphore(self._max_heavy)
+            if self._heavy.locked():
+                logger.info(f"Wait for heavy commands: {command_args}")
+            async with self._heavy:
+                return await self._run(command_args, output, timeout)
+        return await self._run(command_args, output, timeout)
+
+    async def _run(self, command_args, output, timeout):
+        logger.info(f"{command_args=}")
+        self._stats["commands"] += 1
+        pipe = asyncio.subprocess.PIPE if output is not None else asyncio.subprocess.DEVNULL
+        process = await asyncio.create_subprocess_exec(*command_args,
+                                                       stdin=asyncio.subprocess.DEVNULL,
+                                                       stdout=pipe,
+                                                       stderr=pipe,
+                                                       limit=MAX_LINE,
+                                                       start_new_session=True)
+        self._running[process.pid] = (command_args, time.time())
+        try:
+            if output is not None:
+                pumps = asyncio.gather(self._pump(process.stdout, "stdout", output),
+                                       self._pump(process.stderr, "stderr", output))
+            else:
+                pumps = asyncio.ensure_future(process.wait())
+            try:
+                await asyncio.wait_for(asyncio.shield(pumps), timeout or None)
+            except asyncio.TimeoutError:
+                self._stats["timeouts"] += 1
+                await self._kill(process)
+                pumps.cancel()
+                raise Exception(f"Command timed out after {timeout}s: {os.path.basename(command_args[0])}")
+            except asyncio.CancelledError:
+                self._stats["cancelled"] += 1
+                await self._kill(process)
+                pumps.cancel()
+                raise
+            code = await process.wait()
+        finally:
+            self._running.pop(process.pid, None)
+        logger.debug(f"returncode: {code}")
+        if code != 0:
+            self._stats["failed"] += 1
+        return code
+
+    async def _pump(self, reader, name, output):
+        while True:
+            try:
+                line = await reader.readline()
+            except ValueError: # longer than the limit
+                line = await reader.read(MAX_LINE)
+            if not line:
+                return
+            line = line.decode(errors="replace").rstrip()
+            logger.debug(f"{name}: {line}")
+            if output is not None:
+                try:
+                    await output(name, line)
+                except Exception as e:
+                    logger.warning(f"Error to send command output: {e}")
+
+    # terminate the process group of the command, kill it if it is not
+    # terminated in time
+    async def _kill(self, process):
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            if process.returncode is not None:
+                return
+            logger.warning(f"Send {sig.name} to command {process.pid}")
+            try:
+                os.killpg(process.pid, sig)
+            except ProcessLookupError:
+                return
+            except PermissionError: # e.g. a child run by sudo, signal the command only
+                try:
+                    process.send_signal(sig)
+                except ProcessLookupError:
+                    return
+            try:
+                await asyncio.wait_for(process.wait(), KILL_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+
+    # commands running now, and seconds they have been running (arguments
+    # are not listed, e.g. WiFi passwords)
+    def running(self):
+        now = time.time()
+        return [{"command": os.path.basename(args[0]), "pid": pid, "time": now - start_t}
+                for pid, (args, start_t) in list(self._running.items())]
+
+    def stats(self):
+        return dict(self._stats, running=len(self._running))
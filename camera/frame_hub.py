@@ -0,0 +1,210 @@
+import time
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+# A frame published to the hub, with a monotonically increasing sequence
+# number (starting from 1) and the capture timestamp (seconds since epoch).
+# The optional header is written before the data when the frame is served,
+# e.g. the multipart part header, built once and shared by all readers.
+# "encoded_t" is the time of the encoder output (None if unknown), and
+# "published_t" the time the frame was published to the hub.
+class Frame(object):
+    __slots__ = ("seq", "timestamp", "data", "header", "encoded_t", "published_t")
+
+    def __init__(self, seq, timestamp, data, header = None, encoded_t = None):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.data = data
+        self.header = header
+        self.encoded_t = encoded_t
+        self.published_t = time.time()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return f"Frame(seq={self.seq}, timestamp={self.timestamp:.3f}, size={len(self.data)})"
+
+# Broadcast hub of frames, one writer and any number of readers.
+# The recent frames are kept in a small ring indexed by sequence number.
+# Readers never take a lock shared with other readers, they check the
+# latest frame reference and only wait on the event of the next frame,
+# which is replaced (and set) by the writer for every frame.
+class FrameHub(object):
+    def __init__(self, ring_size = 8):
+        self._ring_size = ring_size
+        self._ring = [None] * ring_size
+        self._latest = None
+        self._next_event = threading.Event()
+        self._write_lock = threading.Lock()
+        self._listeners = []
+        self._cursors = []
+
+    @property
+    def ring_size(self):
+        return self._ring_size
+
+    @property
+    def latest(self):
+        return self._latest
+
+    @property
+    def seq(self):
+        latest = self._latest
+        return latest.seq if latest is not None else 0
+
+    # listeners are called in the writer thread with each new frame
+    def add_listener(self, listener):
+        with self._write_lock:
+            self._listeners = self._listeners + [listener]
+
+    # compared by equality, a bound method is a new object for each access
+    def remove_listener(self, listener):
+        with self._write_lock:
+            self._listeners = [l for l in self._listeners if l != listener]
+
+    def publish(self, data, timestamp = None, header = None, encoded_t = None):
+        with self._write_lock:
+            seq = self.seq + 1
+            frame = Frame(seq, timestamp if timestamp is not None else time.time(), data, header, encoded_t)
+            self._ring[seq % self._ring_size] = frame
+            # update latest before waking up readers of the next frame
+            self._latest = frame
+            next_event, self._next_event = self._next_event, threading.Event()
+            listeners = self._listeners
+        next_event.set()
+        for listener in listeners:
+            try:
+                listener(frame)
+            except Exception as e:
+                logger.warning(f"Error to notify frame listener: {e}")
+        return frame
+
+    # frame of the sequence number if it is still in the ring
+    def get(self, seq):
+        frame = self._ring[seq % self._ring_size]
+        return frame if frame is not None and frame.seq == seq else None
+
+    # oldest frame in the ring after the sequence number
+    def _oldest_after(self, seq):
+        latest = self._latest
+        first = max(seq + 1, latest.seq - self._ring_size + 1)
+        for s in range(first, latest.seq + 1):
+            frame = self.get(s)
+            if frame is not None:
+                return frame
+        return latest
+
+    def _wait_after(self, seq, timeout):
+        next_event = self._next_event
+        latest = self._latest
+        if latest is not None and latest.seq > seq:
+            return latest
+        if next_event.wait(timeout):
+            return self._latest
+        return None
+
+    # next frame after the sequence number, i.e. frame (seq + 1), or the
+    # oldest frame still in the ring if the reader is too far behind
+    # return None if no new frame within timeout
+    def next_after(self, seq, timeout = None):
+        if self._wait_after(seq, timeout) is None:
+            return None
+        return self._oldest_after(seq)
+
+    # newest frame after the sequence number, skipping any frames between
+    # return None if no new frame within timeout
+    def latest_after(self, seq, timeout = None):
+        return self._wait_after(seq, timeout)
+
+    def cursor(self, name = "reader", skip = True):
+        return FrameCursor(self, name, skip)
+
+    def _add_cursor(self, cursor):
+        with self._write_lock:
+            self._cursors = self._cursors + [cursor]
+
+    def _remove_cursor(self, cursor):
+        with self._write_lock:
+            self._cursors = [c for c in self._cursors if c is not cursor]
+
+    # number of open cursors
+    @property
+    def consumers(self):
+        return len(self._cursors)
+
+    # statistics of all open cursors
+    def stats(self):
+        return [cursor.stats() for cursor in self._cursors]
+
+# Each consumer of the hub keeps its own cursor, i.e. the sequence number
+# of the last frame it consumed, and counts the frames it dropped (never
+# consumed) and duplicated (consumed more than once).
+# A cursor with "skip" reads the newest frame, e.g. live streaming, otherwise
+# reads frames in order as long as they are in the ring, e.g. recording.
+class FrameCursor(object):
+    def __init__(self, hub, name = "reader", skip = True):
+        self._hub = hub
+        self._skip = skip
+        self.name = name
+        self.seq = hub.seq
+        self.received = 0
+        self.dropped = 0
+        self.duplicated = 0
+        self.opened_t = time.time()
+        hub._add_cursor(self)
+
+    @property
+    def hub(self):
+        return self._hub
+
+    # account a frame consumed by the reader
+    def advance(self, frame):
+        if frame.seq <= self.seq:
+            self.duplicated += 1
+        else:
+            self.dropped += frame.seq - self.seq - 1
+            self.received += 1
+            self.seq = frame.seq
+        return frame
+
+    # wait and consume the next frame, return None if timeout
+    def read(self, timeout = 1):
+        if self._skip:
+            frame = self._hub.latest_after(self.seq, timeout)
+        else:
+            frame = self._hub.next_after(self.seq, timeout)
+        return self.advance(frame) if frame is not None else None
+
+    # consume the latest frame without waiting, which may be a duplicate
+    def read_latest(self):
+        frame = self._hub.latest
+        return self.advance(frame) if frame is not None else None
+
+    # frames published but not consumed yet
+    @property
+    def lag(self):
+        return max(self._hub.seq - self.seq, 0)
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "seq": self.seq,
+            "lag": self.lag,
+            "received": self.received,
+            "dropped": self.dropped,
+            "duplicated": self.duplicated,
+            "duration": time.time() - self.opened_t,
+        }
+
+    def close(self):
+        self._hub._remove_cursor(self)
+        logger.info(f"Close frame cursor: {self.stats()}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,286 @@
+import math
+import time
+import threading
+from collections import deque
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Minimal MPEG-TS muxer for one H.264 video stream (Annex B), one PES packet
+# per access unit with PTS, PAT and PMT before each key frame, and PCR in the
+# first packet of each access unit.
+
+TS_PACKET_SIZE = 188
+PAT_PID = 0x0000
+PMT_PID = 0x1000
+VIDEO_PID = 0x0100
+# access unit delimiter, recommended before each access unit for HLS
+H264_AUD = b"\x00\x00\x00\x01\x09\xf0"
+PTS_MASK = (1 << 33) - 1
+
+def crc32_mpeg2(data):
+    crc = 0xFFFFFFFF
+    for byte in data:
+        crc ^= byte << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7 if crc & 0x80000000 else crc << 1) & 0xFFFFFFFF
+    return crc
+
+def psi_section(table_id, table_id_ext, body):
+    length = 5 + len(body) + 4
+    section = bytes([table_id, 0xB0 | (length >> 8), length & 0xFF,
+                     table_id_ext >> 8, table_id_ext & 0xFF, 0xC1, 0x00, 0x00]) + body
+    return section + crc32_mpeg2(section).to_bytes(4, "big")
+
+PAT_SECTION = psi_section(0x00, 0x0001, bytes([0x00, 0x01, 0xE0 | (PMT_PID >> 8), PMT_PID & 0xFF]))
+PMT_SECTION = psi_section(0x02, 0x0001, bytes([0xE0 | (VIDEO_PID >> 8), VIDEO_PID & 0xFF, 0xF0, 0x00,
+                                               0x1B, 0xE0 | (VIDEO_PID >> 8), VIDEO_PID & 0xFF, 0xF0, 0x00]))
+
+def encode_pts(pts):
+    return bytes([0x21 | (((pts >> 30) & 0x07) << 1), (pts >> 22) & 0xFF,
+                  (((pts >> 15) & 0x7F) << 1) | 1, (pts >> 7) & 0xFF, ((pts & 0x7F) << 1) | 1])
+
+def encode_pcr(pcr):
+    return ((pcr << 15) | (0x3F << 9)).to_bytes(6, "big")
+
+class TsMuxer(object):
+    def __init__(self):
+        self._cc = {}
+
+    def _header(self, pid, start, adaptation):
+        cc = self._cc.get(pid, 0)
+        self._cc[pid] = (cc + 1) & 0x0F
+        return bytes([0x47, (0x40 if start else 0x00) | (pid >> 8), pid & 0xFF,
+                      (0x30 if adaptation else 0x10) | cc])
+
+    def _psi(self, pid, section):
+        payload = b"\x00" + section
+        return self._header(pid, True, False) + payload + b"\xff" * (TS_PACKET_SIZE - 4 - len(payload))
+
+    # TS packets of one access unit, pts in 90 kHz
+    def mux(self, data, pts, keyframe):
+        packets = []
+        if keyframe:
+            packets.append(self._psi(PAT_PID, PAT_SECTION))
+            packets.append(self._psi(PMT_PID, PMT_SECTION))
+        pts &= PTS_MASK
+        pes = b"\x00\x00\x01\xe0\x00\x00\x80\x80\x05" + encode_pts(pts)
+        payload = memoryview(pes + H264_AUD + bytes(data))
+        pos = 0
+        first = True
+        while pos < len(payload):
+            # PCR (and random access on key frames) in the first packet
+            fields = bytes([0x50 if keyframe else 0x10]) + encode_pcr((pts - 9000) & PTS_MASK) if first else b""
+            room = 184 - (1 + len(fields) if fields else 0)
+            remaining = len(payload) - pos
+            if remaining < room:
+                stuffing = room - remaining
+                if not fields:
+                    # adaptation field only for stuffing, 1 byte of length at least
+                    fields = b"" if stuffing == 1 else b"\x00" + b"\xff" * (stuffing - 2)
+                else:
+                    fields += b"\xff" * stuffing
+                adaptation = bytes([len(fields)]) + fields
+            else:
+                adaptation = bytes([len(fields)]) + fields if fields else b""
+            size = 184 - len(adaptation)
+            packets.append(self._header(VIDEO_PID, first, bool(adaptation)) + adaptation + payload[pos:pos + size])
+            pos += size
+            first = False
+        return b"".join(packets)
+
+# A part of a segment (LL-HLS partial segment), TS packets of whole frames.
+class HlsPart(object):
+    __slots__ = ("data", "duration", "independent")
+
+    def __init__(self, data, duration, independent):
+        self.data = data
+        self.duration = duration
+        self.independent = independent
+
+# A segment starts with a key frame, and consists of parts.
+class HlsSegment(object):
+    def __init__(self, msn, discontinuity = False):
+        self.msn = msn
+        self.discontinuity = discontinuity
+        self.parts = []
+        self.duration = 0.0
+        self.complete = False
+        self.created_t = time.time()
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            data = b"".join(part.data for part in self.parts)
+            if not self.complete:
+                return data
+            self._data = data
+        return self._data
+
+    def __len__(self):
+        return sum(len(part.data) for part in self.parts)
+
+# HLS stream of H.264 frames, segments and parts are kept in memory, bounded
+# by the number of segments. A new segment starts at the first key frame
+# after "segment_duration", and a new part every "part_duration" (0 for no
+# parts, i.e. plain HLS). Frames are written in the encoder thread, and the
+# playlist, segments and parts are read by web servers.
+class HlsStream(object):
+    def __init__(self, segment_duration = 2, part_duration = 0.5, segments = 6):
+        self._segment_duration = segment_duration
+        self._part_duration = part_duration
+        self._max_segments = segments
+        self._muxer = TsMuxer()
+        self._segments = deque()
+        self._msn = 0
+        self._discontinuity_sequence = 0
+        self._discontinuity = False
+        self._segment = None
+        self._part_frames = []
+        self._part_independent = False
+        self._part_start_ts = None
+        self._segment_start_ts = None
+        self._condition = threading.Condition()
+        self._stats = {"frames": 0, "dropped": 0, "segments": 0, "parts": 0}
+
+    @property
+    def segment_duration(self):
+        return self._segment_duration
+
+    @property
+    def part_duration(self):
+        return self._part_duration
+
+    # seconds of the segments kept
+    @property
+    def window(self):
+        return self._segment_duration * self._max_segments
+
+    # the next segment starts after a discontinuity, e.g. camera restart
+    def discontinuity(self):
+        with self._condition:
+            self._close_part(None)
+            if self._segment is not None:
+                self._close_segment()
+            self._discontinuity = self._msn > 0
+            self._part_start_ts = None
+
+    # called in encoder thread, timestamp in microseconds
+    def write_frame(self, data, keyframe, timestamp = None):
+        ts = timestamp / 1e6 if timestamp is not None else time.monotonic()
+        with self._condition:
+            self._stats["frames"] += 1
+            if self._segment is None and not keyframe:
+                self._stats["dropped"] += 1 # wait for the first key frame
+                return
+            if keyframe and self._segment is not None and ts - self._segment_start_ts >= self._segment_duration * 0.99:
+                self._close_part(ts)
+                self._close_segment()
+            elif self._part_duration > 0 and self._part_start_ts is not None \
+                    and ts - self._part_start_ts >= self._part_duration * 0.99:
+                self._close_part(ts)
+            if self._segment is None:
+                self._open_segment(ts)
+            if self._part_start_ts is None:
+                self._part_start_ts = ts
+                self._part_independent = keyframe
+            self._part_frames.append(self._muxer.mux(data, int(ts * 90000), keyframe))
+
+    # called with lock
+    def _open_segment(self, ts):
+        self._msn += 1
+        self._segment = HlsSegment(self._msn, self._discontinuity)
+        self._discontinuity = False
+        self._segment_start_ts = ts
+        self._segments.append(self._segment)
+        while len(self._segments) > self._max_segments:
+            evicted = self._segments.popleft()
+            if evicted.discontinuity:
+                self._discontinuity_sequence += 1
+
+    # called with lock, "ts" is the time of the next frame, None if unknown
+    def _close_part(self, ts):
+        if not self._part_frames:
+            return
+        duration = ts - self._part_start_ts if ts is not None else self._part_duration
+        self._segment.parts.append(HlsPart(b"".join(self._part_frames), duration, self._part_independent))
+        self._segment.duration += duration
+        self._part_frames = []
+        self._part_start_ts = None
+        self._stats["parts"] += 1
+        self._condition.notify_all()
+
+    # called with lock
+    def _close_segment(self):
+        self._segment.complete = True
+        self._segment = None
+        self._stats["segments"] += 1
+        self._condition.notify_all()
+
+    def _find(self, msn):
+        for segment in self._segments:
+            if segment.msn == msn:
+                return segment
+        return None
+
+    # data of a complete segment, or None if not available
+    def segment(self, msn):
+        with self._condition:
+            segment = self._find(msn)
+            return segment.data if segment is not None and segment.complete else None
+
+    # data of a part, or None if not available
+    def part(self, msn, index):
+        with self._condition:
+            segment = self._find(msn)
+            if segment is None or index < 0 or index >= len(segment.parts):
+                return None
+            return segment.parts[index].data
+
+    # blocking playlist reload, wait until the part (or the segment if part is
+    # None) is available, return False if timeout
+    def wait(self, msn, part = None, timeout = None):
+        def ready():
+            if self._msn > msn:
+                return True
+            if self._msn < msn or self._segment is None:
+                return False
+            return part is not None and len(self._segment.parts) > part
+        with self._condition:
+            return self._condition.wait_for(ready, timeout)
+
+    def target_duration(self):
+        durations = [segment.duration for segment in self._segments if segment.complete]
+        return max([math.ceil(self._segment_duration)] + [round(d) for d in durations])
+
+    def playlist(self):
+        with self._condition:
+            segments = list(self._segments)
+            lines = [
+                "#EXTM3U",
+                f"#EXT-X-VERSION:{9 if self._part_duration > 0 else 3}",
+                f"#EXT-X-TARGETDURATION:{self.target_duration()}",
+                f"#EXT-X-MEDIA-SEQUENCE:{segments[0].msn if segments else 1}",
+                f"#EXT-X-DISCONTINUITY-SEQUENCE:{self._discontinuity_sequence}",
+            ]
+            if self._part_duration > 0:
+                lines.append(f"#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES,PART-HOLD-BACK={self._part_duration * 3:.3f}")
+                lines.append(f"#EXT-X-PART-INF:PART-TARGET={self._part_duration:.3f}")
+            # parts are listed for the last segments only
+            for segment in segments:
+                if segment.discontinuity:
+                    lines.append("#EXT-X-DISCONTINUITY")
+                if self._part_duration > 0 and segment.msn > self._msn - 3:
+                    for i, part in enumerate(segment.parts):
+                        independent = ",INDEPENDENT=YES" if part.independent else ""
+                        lines.append(f'#EXT-X-PART:DURATION={part.duration:.3f},URI="part{segment.msn}.{i}.ts"{independent}')
+                if segment.complete:
+                    lines.append(f"#EXTINF:{segment.duration:.3f},")
+                    lines.append(f"seg{segment.msn}.ts")
+            return "\n".join(lines) + "\n"
+
+    def stats(self):
+        with self._condition:
+            return dict(self._stats, msn=self._msn, segments_kept=len(self._segments),
+                        bytes=sum(len(segment) for segment in self._segments))
@@ -0,0 +1,195 @@
+import time
+import threading
+import urllib.parse
+from collections import deque
+from metrics import registry
+import avi
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Instant replay keeps the recent frames of the MJPEG stream in memory, so
+# "the last 30 seconds" can be exported at once without disk recording.
+# It is a listener of the stream buffer, called in the encoder thread with
+# each published frame, and keeps the frame itself (the JPEG data and the
+# shared part header), so nothing is copied. The oldest frames are evicted
+# when the frames are larger than "max_bytes" in total.
+# A clip of a time window is generated on the fly from the frames of the
+# window, as the multipart parts of the stream (like recording segments) or
+# as an AVI file (Motion JPEG), and written frame by frame with vectored
+# writes, it is never joined into one buffer.
+
+# the metrics are labeled by the stream, i.e. of the camera
+REPLAY_BYTES = registry.gauge("camera_replay_bytes", "Bytes of frames kept for instant replay", ("stream",))
+REPLAY_FRAMES = registry.gauge("camera_replay_frames", "Frames kept for instant replay", ("stream",))
+REPLAY_SECONDS = registry.gauge("camera_replay_seconds", "Seconds of frames kept for instant replay", ("stream",))
+REPLAY_EVICTED_FRAMES = registry.counter("camera_replay_evicted_frames_total", "Frames evicted from instant replay",
+    ("stream",))
+REPLAY_EVICTED_BYTES = registry.counter("camera_replay_evicted_bytes_total", "Bytes evicted from instant replay",
+    ("stream",))
+REPLAY_CLIPS = registry.counter("camera_replay_clips_total", "Clips exported from instant replay", ("stream", "format"))
+
+# bytes of the multipart part of a frame, the header, data and trailing CRLF
+def frame_size(frame):
+    return len(frame.header) + len(frame.data) + 2
+
+class InstantReplay(object):
+    def __init__(self, stream, max_bytes = 128 * 1024 * 1024):
+        self._stream = stream
+        self._max_bytes = max_bytes
+        self._frames = deque()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._running = False
+        self._stats = {"frames": 0, "evicted": 0, "evicted_bytes": 0, "clips": 0}
+        REPLAY_BYTES.labels(stream.name).set_function(lambda: self._bytes)
+        REPLAY_FRAMES.labels(stream.name).set_function(lambda: len(self._frames))
+        REPLAY_SECONDS.labels(stream.name).set_function(lambda: self.duration)
+        self._evicted_frames = REPLAY_EVICTED_FRAMES.labels(stream.name)
+        self._evicted_bytes = REPLAY_EVICTED_BYTES.labels(stream.name)
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    # seconds between the oldest and the newest frame
+    @property
+    def duration(self):
+        with self._lock:
+            if not self._frames:
+                return 0
+            return self._frames[-1].timestamp - self._frames[0].timestamp
+
+    def start(self):
+        if not self._running:
+            logger.info(f"Start instant replay of {self._max_bytes} bytes")
+            self._running = True
+            self._stream.add_listener(self._on_frame)
+
+    def stop(self):
+        if self._running:
+            self._stream.remove_listener(self._on_frame)
+            self._running = False
+            with self._lock:
+                self._frames.clear()
+                self._bytes = 0
+
+    # called in encoder thread with each frame of the stream
+    def _on_frame(self, frame):
+        size = frame_size(frame)
+        evicted, evicted_bytes = 0, 0
+        with self._lock:
+            self._frames.append(frame)
+            self._bytes += size
+            while self._bytes > self._max_bytes and len(self._frames) > 1:
+                old = self._frames.popleft()
+                old_size = frame_size(old)
+                self._bytes -= old_size
+                evicted += 1
+                evicted_bytes += old_size
+        self._stats["frames"] += 1
+        if evicted:
+            self._stats["evicted"] += evicted
+            self._stats["evicted_bytes"] += evicted_bytes
+            self._evicted_frames.inc(evicted)
+            self._evicted_bytes.inc(evicted_bytes)
+
+    # frames captured in the window (seconds since epoch), oldest first
+    def window(self, start, end):
+        with self._lock:
+            frames = list(self._frames)
+        return [frame for frame in frames if start <= frame.timestamp <= end]
+
+    # clip of the window in the format ("mjpg" or "avi"), None if no frame
+    def clip(self, format, start, end):
+        frames = self.window(start, end)
+        if not frames:
+            return None
+        self._stats["clips"] += 1
+        REPLAY_CLIPS.labels(self._stream.name, format).inc()
+        return MjpegClip(frames) if format == "mjpg" else AviClip(frames)
+
+    def stats(self):
+        with self._lock:
+            start = self._frames[0].timestamp if self._frames else None
+            end = self._frames[-1].timestamp if self._frames else None
+            return dict(self._stats, kept=len(self._frames), bytes=self._bytes, max_bytes=self._max_bytes,
+                        start=start, end=end)
+
+# A clip is written as lists of buffers (e.g. one list a frame), with the
+# length known before it is written, no buffer is empty (for sendmsg_all).
+class MjpegClip(object):
+    content_type = "video/x-motion-jpeg"
+    extension = "mjpg"
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.length = sum(frame_size(frame) for frame in frames)
+
+    def __len__(self):
+        return self.length
+
+    # the parts of the frames, like the recording segments
+    def buffers(self):
+        for frame in self.frames:
+            yield [frame.header, frame.data, b"\r\n"]
+
+# AVI file of the frames at their average frame rate (see avi.py)
+class AviClip(object):
+    content_type = avi.CONTENT_TYPE
+    extension = "avi"
+
+    def __init__(self, frames):
+        self.frames = frames
+        sizes = [len(frame.data) for frame in frames]
+        width, height = avi.jpeg_size(frames[0].data) or (0, 0)
+        duration = frames[-1].timestamp - frames[0].timestamp
+        frame_us = duration / (len(frames) - 1) * 1000000 if len(frames) > 1 and duration > 0 else 33333
+        movi_size = avi.movi_size(sizes)
+        self.header = avi.header(len(frames), movi_size, max(sizes), width, height, frame_us)
+        self.length = avi.length(self.header, movi_size, len(frames))
+
+    def __len__(self):
+        return self.length
+
+    def buffers(self):
+        yield [self.header]
+        for frame in self.frames:
+            yield avi.frame_buffers(frame.data)
+        for block in avi.index_blocks(len(self.frames), (len(frame.data) for frame in self.frames)):
+            yield [block]
+
+# Clips are exported by the web servers as "/clip.mjpg" or "/clip.avi", of
+# the last seconds with "?last=<seconds>" (30 by default), or of a window
+# with "?start=<time>&end=<time>" (seconds since epoch).
+CLIP_PATHS = {"/clip.mjpg": "mjpg", "/clip.avi": "avi"}
+DEFAULT_LAST = 30
+
+def is_clip_path(path):
+    return urllib.parse.urlsplit(path).path in CLIP_PATHS
+
+# return (code, headers, body), body is a clip, or bytes for errors
+def clip_response(replay, path):
+    if replay is None:
+        return 404, {}, b""
+    url = urllib.parse.urlsplit(path)
+    query = urllib.parse.parse_qs(url.query)
+    try:
+        if "start" in query:
+            start = float(query["start"][0])
+            end = float(query["end"][0]) if "end" in query else time.time()
+        else:
+            end = time.time()
+            start = end - float(query.get("last", [DEFAULT_LAST])[0])
+    except ValueError:
+        return 400, {}, b""
+    clip = replay.clip(CLIP_PATHS[url.path], start, end)
+    if clip is None:
+        return 404, {}, b""
+    headers = {
+        "Content-Type": clip.content_type,
+        "Content-Length": len(clip),
+        "Content-Disposition": f"attachment; filename=clip-{int(clip.frames[0].timestamp)}.{clip.extension}",
+        "Cache-Control": "no-cache",
+    }
+    return 200, headers, clip
@@ -0,0 +1,245 @@
+import bisect
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Metrics in the Prometheus text exposition format, served on "/metrics".
+# Counters, gauges and histograms are created once in a registry, and the
+# labeled children are looked up once by their owners (e.g. the stream
+# buffer of each stream), so updating a metric on the hot path is one lock
+# and a few additions. Gauges of counts kept elsewhere (e.g. viewers) are
+# read by a function at scrape time instead of being updated.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# seconds, from a frame interval of 60 fps to stalls of several seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.02, 0.033, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5, 1.0, 2.0, 5.0)
+DURATION_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def format_labels(names, values, extra = ()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = [(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for name, value in pairs]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+class CounterValue(object):
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount = 1):
+        with self._lock:
+            self.value += amount
+
+class GaugeValue(object):
+    __slots__ = ("value", "function")
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    # the value is read by the function at scrape time
+    def set_function(self, function):
+        self.function = function
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+class HistogramValue(object):
+    __slots__ = ("buckets", "counts", "sum", "_lock")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last for +Inf
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    # cumulative counts of the buckets, and the sum
+    def snapshot(self):
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        cumulative = []
+        count = 0
+        for c in counts:
+            count += c
+            cumulative.append(count)
+        return cumulative, total
+
+# A metric with a fixed set of label names, children are created on demand
+# for each set of label values.
+class Metric(object):
+    type = "untyped"
+
+    def __init__(self, name, help, labels = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        if len(values) != len(self.label_names):
+            raise Exception(f"Expected labels {self.label_names} for {self.name}: {values}")
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    # metric without labels
+    def _default(self):
+        return self.labels()
+
+    # lines of the samples of a child, with the extra labels
+    def _samples(self, values, child, extra = ()):
+        raise NotImplementedError
+
+    def expose(self, extra = ()):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for values, child in list(self._children.items()):
+            try:
+                lines += self._samples(values, child, extra)
+            except Exception as e:
+                logger.warning(f"Error to collect metric {self.name}: {e}")
+        return lines
+
+class Counter(Metric):
+    type = "counter"
+
+    def _new_child(self):
+        return CounterValue()
+
+    def inc(self, amount = 1):
+        self._default().inc(amount)
+
+    def _samples(self, values, child, extra = ()):
+        return [f"{self.name}{format_labels(self.label_names, values, extra)} {format_value(child.value)}"]
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def _new_child(self):
+        return GaugeValue()
+
+    def set(self, value):
+        self._default().set(value)
+
+    def set_function(self, function):
+        self._default().set_function(function)
+
+    def _samples(self, values, child, extra = ()):
+        return [f"{self.name}{format_labels(self.label_names, values, extra)} {format_value(child.get())}"]
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels = (), buckets = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+    def _samples(self, values, child, extra = ()):
+        cumulative, total = child.snapshot()
+        lines = []
+        for bound, count in zip(self.buckets + (float("inf"),), cumulative):
+            labels = format_labels(self.label_names, values, list(extra) + [("le", format_value(float(bound)))])
+            lines.append(f"{self.name}_bucket{labels} {count}")
+        labels = format_labels(self.label_names, values, extra)
+        lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {cumulative[-1]}")
+        return lines
+
+# The registry of a worker process (see supervisor.py) is exposed with the
+# metrics of the capture process, which has the camera, the encoders and
+# the workers, so one scrape of any worker sees both: each family once, the
+# samples of the capture process as they are, and the samples of the worker
+# with the extra labels of the worker (e.g. worker="1").
+class Registry(object):
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._remote = None # function returning the families of another process
+        self._extra = ()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.label_names != metric.label_names:
+                    raise Exception(f"Metric {metric.name} is already registered")
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help, labels = ()):
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels = ()):
+        return self._register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels = (), buckets = LATENCY_BUCKETS):
+        return self._register(Histogram(name, help, labels, buckets))
+
+    # merge the metrics of another process, e.g. of the capture process in a
+    # worker process, and label the samples of this one with "extra"
+    def set_remote(self, families, extra = ()):
+        self._remote = families
+        self._extra = tuple(extra)
+
+    # [(name, HELP and TYPE lines, sample lines)] of the metrics of this
+    # process, picklable to be sent to another process
+    def families(self, extra = ()):
+        families = []
+        for metric in list(self._metrics.values()):
+            lines = metric.expose(extra)
+            families.append((metric.name, lines[:2], lines[2:]))
+        return families
+
+    # all metrics in the text exposition format
+    def expose(self):
+        families = []
+        if self._remote is not None:
+            try:
+                families = self._remote()
+            except Exception as e:
+                logger.warning(f"Error to collect metrics of another process: {e}")
+        merged = {}
+        for name, header, samples in families + self.families(self._extra):
+            if name in merged:
+                merged[name][1].extend(samples)
+            else:
+                merged[name] = (header, list(samples))
+        lines = []
+        for header, samples in merged.values():
+            lines += header + samples
+        return "\n".join(lines) + "\n"
+
+# the registry of all metrics of the camera software
+registry = Registry()
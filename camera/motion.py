@@ -0,0 +1,255 @@
+import math
+import time
+import threading
+from collections import deque
+
+try:
+    import numpy
+except ImportError: # comes with picamera2
+    numpy = None
+
+from roi import clamp_rect
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Motion detection on the "lores" stream. The camera thread hands over the Y
+# (luminance) plane of a frame, the plane of YUV420 buffers of the camera or
+# the luminance of frames rendered by software backends, so no JPEG frame is
+# decoded. A worker thread downsamples it by block averages to about "width"
+# pixels wide, and compares it with a running average of previous frames
+# (the background). A pixel is changed if it differs from the background by
+# more than "threshold" (0-255), a zone is in motion while the changed part
+# of it is at least "area" (0-1), and until "hold" seconds after that.
+# Zones are {name: [x, y, width, height]} normalized to the frame, or
+# {name: {"rect": [...], "threshold": ..., "area": ...}} to override the
+# thresholds, the full frame if not set.
+# The detector runs on a fixed CPU budget, the share of one core it may use:
+# a frame is only taken if the worker is idle, not earlier than 1 / "fps"
+# after the previous one, and not earlier than the time the previous one
+# took divided by "budget". So the camera thread never waits, and frames are
+# skipped under load, when processing takes longer, instead of slowing down
+# the stream.
+# Listeners are called in the worker thread with each event (motion start or
+# end of a zone), e.g. to capture a snapshot or to trigger recording.
+
+# time constant (seconds) of the background to follow a changed scene, so it
+# does not depend on the frames skipped
+BACKGROUND_TIME = 2.0
+MAX_EVENTS = 64
+MAX_BLOCK = 16 # block sums of uint8 fit in uint16
+
+class MotionZone(object):
+    def __init__(self, name, rect, threshold, area):
+        self.name = name
+        self.rect = clamp_rect(rect, 0.01)
+        self.threshold = threshold
+        self.area = area
+        self.slices = None # rows and columns of the downsampled frame
+        self.level = 0.0
+        self.peak = 0.0
+        self.active = False
+        self.start_t = None
+        self.motion_t = None
+
+    # slices of the zone in a frame of the shape
+    def fit(self, shape):
+        height, width = shape
+        x, y, w, h = self.rect
+        x0, y0 = int(x * width), int(y * height)
+        x1, y1 = max(int(round((x + w) * width)), x0 + 1), max(int(round((y + h) * height)), y0 + 1)
+        self.slices = (slice(y0, y1), slice(x0, x1))
+
+def parse_zones(zones, threshold, area):
+    if not zones:
+        zones = {"frame": [0, 0, 1, 1]}
+    parsed = []
+    for name, zone in zones.items():
+        if not isinstance(zone, dict):
+            zone = {"rect": zone}
+        if "rect" not in zone or len(zone["rect"]) != 4:
+            raise Exception(f"Bad motion zone {name}: {zone}")
+        parsed.append(MotionZone(name, zone["rect"], zone.get("threshold", threshold), zone.get("area", area)))
+    return parsed
+
+class MotionDetector(object):
+    def __init__(self, width = 160, fps = 10, budget = 0.05, threshold = 25, area = 0.01, zones = {}, hold = 2):
+        if numpy is None:
+            raise Exception("numpy is required for motion detection")
+        self._width = width
+        self._interval = 1.0 / fps
+        self._budget = budget
+        self._hold = hold
+        self._zones = parse_zones(zones, threshold, area)
+        self._background = None
+        self._last_t = None
+        self._cost = 0.0 # seconds to process a frame, averaged
+        self._next_t = 0
+        self._pending = None
+        self._condition = threading.Condition()
+        self._listeners = []
+        self._events = deque(maxlen=MAX_EVENTS)
+        self._thread = None
+        self._running = False
+        self._stats = {"processed": 0, "skipped": 0, "events": 0}
+
+    @property
+    def zones(self):
+        return [zone.name for zone in self._zones]
+
+    # names of the zones in motion
+    @property
+    def active(self):
+        return [zone.name for zone in self._zones if zone.active]
+
+    # the listener is called in the worker thread with each event
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    # called in camera thread with a function returning a context of the Y
+    # plane of "lores" frame, which is only mapped if the frame is taken
+    def on_frame(self, lores):
+        now = time.monotonic()
+        if not self._running or now < self._next_t or self._pending is not None:
+            self._stats["skipped"] += 1
+            return
+        start_t = time.perf_counter()
+        with lores() as plane:
+            plane = numpy.array(plane, dtype=numpy.uint8)
+        copy_time = time.perf_counter() - start_t
+        with self._condition:
+            self._pending = (plane, time.time(), now, copy_time)
+            self._condition.notify()
+
+    def _run(self):
+        while self._running:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending is not None or not self._running, 1)
+                pending, self._pending = self._pending, None
+            if pending is None:
+                continue
+            plane, timestamp, taken_t, copy_time = pending
+            start_t = time.perf_counter()
+            try:
+                self.process(plane, timestamp)
+            except Exception as e:
+                logger.warning(f"Error to detect motion: {e}")
+            # wall time, it grows when the CPU is busy
+            cost = time.perf_counter() - start_t + copy_time
+            self._cost = cost if self._cost == 0 else self._cost * 0.9 + cost * 0.1
+            self._next_t = taken_t + max(self._interval, self._cost / self._budget)
+
+    # downsample the Y plane by block averages to about "width" pixels wide,
+    # rows and then columns of a block are added as strided views, which is
+    # much faster than a sum over the axes of the blocks
+    def downsample(self, plane):
+        block = min(max(plane.shape[1] // self._width, 1), MAX_BLOCK)
+        height, width = plane.shape[0] // block, plane.shape[1] // block
+        plane = plane[:height * block, :width * block]
+        rows = plane[0::block].astype(numpy.uint16)
+        for i in range(1, block):
+            rows += plane[i::block]
+        small = rows[:, 0::block].copy()
+        for i in range(1, block):
+            small += rows[:, i::block]
+        small = small.astype(numpy.float32)
+        small *= 1.0 / (block * block)
+        return small
+
+    # process a Y plane (2D uint8 array) captured at the time, return the events
+    def process(self, plane, timestamp):
+        small = self.downsample(plane)
+        self._stats["processed"] += 1
+        if self._background is None or self._background.shape != small.shape:
+            logger.info(f"Motion detection at {small.shape[1]}x{small.shape[0]}")
+            self._background = small
+            self._last_t = timestamp
+            for zone in self._zones:
+                zone.fit(small.shape)
+            return []
+        diff = numpy.abs(small - self._background)
+        alpha = 1.0 - math.exp(-max(timestamp - self._last_t, 0) / BACKGROUND_TIME)
+        self._background += alpha * (small - self._background)
+        self._last_t = timestamp
+        events = []
+        for zone in self._zones:
+            changed = diff[zone.slices] > zone.threshold
+            zone.level = float(changed.mean())
+            if zone.level >= zone.area:
+                zone.motion_t = timestamp
+                zone.peak = max(zone.peak, zone.level) if zone.active else zone.level
+                if not zone.active:
+                    zone.active = True
+                    zone.start_t = timestamp
+                    events.append(self._event(zone, "start", timestamp, self._box(zone, changed, small.shape)))
+            elif zone.active and timestamp - zone.motion_t >= self._hold:
+                zone.active = False
+                events.append(self._event(zone, "end", timestamp))
+        for event in events:
+            self._publish(event)
+        return events
+
+    # bounding box of the changed pixels of the zone, normalized to the frame
+    def _box(self, zone, changed, shape):
+        rows = numpy.flatnonzero(changed.any(axis=1))
+        cols = numpy.flatnonzero(changed.any(axis=0))
+        if rows.size == 0:
+            return None
+        height, width = shape
+        y0, x0 = zone.slices[0].start + int(rows[0]), zone.slices[1].start + int(cols[0])
+        y1, x1 = zone.slices[0].start + int(rows[-1]) + 1, zone.slices[1].start + int(cols[-1]) + 1
+        return [round(x0 / width, 3), round(y0 / height, 3), round((x1 - x0) / width, 3), round((y1 - y0) / height, 3)]
+
+    def _event(self, zone, state, timestamp, box = None):
+        event = {"zone": zone.name, "state": state, "time": timestamp, "level": round(zone.peak, 3)}
+        if box is not None:
+            event["box"] = box
+        if state == "end":
+            event["duration"] = round(timestamp - zone.start_t, 3)
+        return event
+
+    def _publish(self, event):
+        logger.info(f"Motion {event['state']} in {event['zone']}: {event}")
+        self._events.append(event)
+        self._stats["events"] += 1
+        for listener in list(self._listeners):
+            try:
+                listener(event)
+            except Exception as e:
+                logger.warning(f"Error of motion listener: {e}")
+
+    # recent events, oldest first
+    def events(self):
+        return list(self._events)
+
+    # state of the zones, e.g. a telemetry topic
+    def status(self):
+        last = self._events[-1] if self._events else None
+        return {"active": self.active, "levels": {zone.name: round(zone.level, 2) for zone in self._zones},
+                "events": self._stats["events"], "last": last}
+
+    def start(self):
+        if self._thread is None:
+            self._background = None # the scene may have changed while stopped
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="motion", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            with self._condition:
+                self._running = False
+                self._condition.notify()
+            self._thread.join()
+            self._thread = None
+            self._pending = None
+
+    def stats(self):
+        return dict(self._stats,
+                    cost_ms=round(self._cost * 1000, 3),
+                    interval=round(max(self._interval, self._cost / self._budget), 3),
+                    zones=self.zones,
+                    active=self.active)
@@ -0,0 +1,490 @@
+import os
+import re
+import json
+import bisect
+import threading
+import urllib.parse
+from array import array
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Continuous recording of the MJPEG stream into a ring of segment files, e.g.
+# the last hours for incident review. A segment is "<start>.mjpg" (start time
+# in milliseconds since epoch), the multipart parts of the stream as they are
+# streamed (with "X-Timestamp"), so a segment can be played by a browser or
+# replayed by the "replay" camera. Each segment has an index "<start>.idx" of
+# (milliseconds since the start, byte offset) of each frame, 8 bytes a frame,
+# so any moment is found by a binary search without reading the segment.
+# Frames are buffered and written in blocks of WRITE_BLOCK bytes (the rest is
+# written when the segment is closed), so the SD card sees few large aligned
+# writes, and the index is written once for each segment. The oldest segments
+# are removed when the ring is larger than "max_bytes".
+# A segment without index (e.g. power loss while recording) is indexed by
+# scanning it once when the recorder starts.
+# A "triggered" recorder only records while it is triggered, e.g. by motion
+# detection, each triggered period starts a new segment.
+
+WRITE_BLOCK = 256 * 1024
+# buffered bytes dropped if they can not be written (e.g. the disk is full)
+MAX_BUFFER = 32 * WRITE_BLOCK
+INDEX_CACHE = 8
+SEGMENT_NAME = re.compile(r"^(\d+)\.mjpg$")
+
+class Segment(object):
+    def __init__(self, directory, start_ms):
+        self.start_ms = start_ms
+        self.path = os.path.join(directory, f"{start_ms}.mjpg")
+        self.index_path = os.path.join(directory, f"{start_ms}.idx")
+        self.size = 0 # bytes on disk
+        self.frames = 0
+        self.end_ms = start_ms
+
+    @property
+    def name(self):
+        return os.path.basename(self.path)
+
+    @property
+    def start(self):
+        return self.start_ms / 1000
+
+    @property
+    def end(self):
+        return self.end_ms / 1000
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "url": f"recordings/{self.name}",
+            "start": self.start,
+            "end": self.end,
+            "frames": self.frames,
+            "size": self.size,
+        }
+
+# index of a segment, relative times (ms) and offsets of frames
+class SegmentIndex(object):
+    def __init__(self, times = None, offsets = None):
+        self.times = times if times is not None else array("I")
+        self.offsets = offsets if offsets is not None else array("I")
+
+    def append(self, time_ms, offset):
+        self.times.append(time_ms)
+        self.offsets.append(offset)
+
+    def __len__(self):
+        return len(self.times)
+
+    def to_bytes(self):
+        pairs = array("I", [0]) * (2 * len(self.times))
+        pairs[0::2] = self.times
+        pairs[1::2] = self.offsets
+        return pairs.tobytes()
+
+    @staticmethod
+    def from_bytes(data):
+        pairs = array("I")
+        pairs.frombytes(data[:len(data) - len(data) % 8])
+        return SegmentIndex(pairs[0::2], pairs[1::2])
+
+    # index of the segment file by scanning the part headers
+    @staticmethod
+    def scan(path, start_ms):
+        index = SegmentIndex()
+        with open(path, "rb") as f:
+            data = f.read()
+        offset = data.find(b"--")
+        while offset >= 0:
+            header_end = data.find(b"\r\n\r\n", offset)
+            if header_end < 0:
+                break
+            header = data[offset:header_end].decode("latin-1")
+            fields = dict(line.split(": ", 1) for line in header.split("\r\n")[1:] if ": " in line)
+            length = int(fields.get("Content-Length", -1))
+            end = header_end + 4 + length + 2
+            if length < 0 or end > len(data):
+                break
+            timestamp_ms = int(float(fields.get("X-Timestamp", start_ms / 1000)) * 1000)
+            index.append(max(timestamp_ms - start_ms, 0), offset)
+            offset = end if data.startswith(b"--", end) else data.find(b"--", end)
+        return index, offset if offset >= 0 else len(data)
+
+class Recorder(object):
+    def __init__(self, stream, directory = "recordings", max_bytes = 4 * 1024 * 1024 * 1024, segment_duration = 60,
+                 triggered = False):
+        self._stream = stream
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._segment_duration = segment_duration
+        self._triggered = triggered
+        self._recording = not triggered
+        self._segments = [] # closed segments, oldest first
+        self._current = None
+        self._current_index = None
+        self._file = None
+        self._buffer = bytearray()
+        self._index_cache = {} # start_ms -> SegmentIndex of closed segments
+        self._lock = threading.Lock()
+        self._cursor = None
+        self._thread = None
+        self._running = False
+        self._stats = {"frames": 0, "bytes": 0, "writes": 0, "segments": 0, "evicted": 0, "errors": 0, "triggers": 0}
+
+    @property
+    def directory(self):
+        return self._directory
+
+    @property
+    def triggered(self):
+        return self._triggered
+
+    # start or stop recording of a triggered recorder
+    def trigger(self, recording):
+        if not self._triggered or recording == self._recording:
+            return
+        logger.info(f"Recording {'triggered' if recording else 'stopped by trigger'}")
+        if recording:
+            self._stats["triggers"] += 1
+        self._recording = recording
+
+    # load the segments of the directory, index the segments without index
+    def load(self):
+        os.makedirs(self._directory, exist_ok=True)
+        segments = []
+        for name in os.listdir(self._directory):
+            match = SEGMENT_NAME.match(name)
+            if match is None:
+                continue
+            segment = Segment(self._directory, int(match.group(1)))
+            try:
+                segment.size = os.path.getsize(segment.path)
+                if os.path.exists(segment.index_path):
+                    index = self._read_index(segment)
+                else:
+                    logger.warning(f"Index recording segment {segment.name}")
+                    index, size = SegmentIndex.scan(segment.path, segment.start_ms)
+                    if size < segment.size: # the last part is incomplete
+                        os.truncate(segment.path, size)
+                        segment.size = size
+                    self._write_file(segment.index_path, index.to_bytes())
+                self._index_loaded(segment, index)
+                segments.append(segment)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Error to load recording segment {name}: {e}")
+        segments.sort(key=lambda segment: segment.start_ms)
+        with self._lock:
+            self._segments = segments
+        self._evict()
+        logger.info(f"Loaded {len(segments)} recording segments from {self._directory}")
+
+    def _read_index(self, segment):
+        with open(segment.index_path, "rb") as f:
+            index = SegmentIndex.from_bytes(f.read())
+        # drop the frames not on disk
+        while len(index) > 0 and index.offsets[-1] >= segment.size:
+            index.times.pop()
+            index.offsets.pop()
+        return index
+
+    def _index_loaded(self, segment, index):
+        segment.frames = len(index)
+        segment.end_ms = segment.start_ms + (index.times[-1] if len(index) > 0 else 0)
+
+    def _write_file(self, path, data):
+        with open(path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    # index of a closed segment, the recently used are cached
+    def _index_of(self, segment):
+        index = self._index_cache.get(segment.start_ms)
+        if index is None:
+            index = self._read_index(segment)
+            with self._lock:
+                if len(self._index_cache) >= INDEX_CACHE:
+                    self._index_cache.pop(next(iter(self._index_cache)))
+                self._index_cache[segment.start_ms] = index
+        return index
+
+    def _open_segment(self, timestamp):
+        segment = Segment(self._directory, int(timestamp * 1000))
+        logger.info(f"Open recording segment {segment.name}")
+        self._file = open(segment.path, "ab", buffering=0)
+        with self._lock:
+            self._current = segment
+            self._current_index = SegmentIndex()
+        self._stats["segments"] += 1
+
+    def _close_segment(self):
+        segment = self._current
+        if segment is None:
+            return
+        self._flush(all = True)
+        try:
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._write_file(segment.index_path, self._current_index.to_bytes())
+        except OSError as e:
+            self._stats["errors"] += 1
+            logger.warning(f"Error to close recording segment {segment.name}: {e}")
+        self._file = None
+        logger.info(f"Close recording segment {segment.name}: {segment.frames} frames, {segment.size} bytes")
+        with self._lock:
+            self._segments.append(segment)
+            self._current = None
+            self._current_index = None
+        self._evict()
+
+    # write the buffered blocks, or all buffered bytes
+    def _flush(self, all = False):
+        size = len(self._buffer) if all else len(self._buffer) - len(self._buffer) % WRITE_BLOCK
+        if size == 0:
+            return
+        written = 0
+        try:
+            with memoryview(self._buffer) as view:
+                while written < size:
+                    written += self._file.write(view[written:size])
+            self._stats["writes"] += 1
+        except OSError as e:
+            self._stats["errors"] += 1
+            logger.warning(f"Error to write recording: {e}")
+            self._evict(force = True)
+        del self._buffer[:written]
+        self._current.size += written
+        if len(self._buffer) > MAX_BUFFER or (all and self._buffer):
+            self._drop_buffer()
+
+    # drop the frames not written, so offsets of next frames are on disk
+    def _drop_buffer(self):
+        segment = self._current
+        logger.warning(f"Drop {len(self._buffer)} bytes of recording")
+        with self._lock:
+            index = self._current_index
+            while len(index) > 0 and index.offsets[-1] >= segment.size:
+                index.times.pop()
+                index.offsets.pop()
+                segment.frames -= 1
+            segment.end_ms = segment.start_ms + (index.times[-1] if len(index) > 0 else 0)
+        self._buffer.clear()
+
+    # remove the oldest segments until the ring fits in max_bytes, at least
+    # one segment is removed if forced (e.g. the disk is full)
+    def _evict(self, force = False):
+        while True:
+            with self._lock:
+                total = sum(segment.size for segment in self._segments)
+                total += self._current.size + len(self._buffer) if self._current is not None else 0
+                if not self._segments or (total <= self._max_bytes and not force):
+                    return
+                segment = self._segments.pop(0)
+                self._index_cache.pop(segment.start_ms, None)
+            force = False
+            logger.info(f"Remove recording segment {segment.name}")
+            self._stats["evicted"] += 1
+            for path in (segment.path, segment.index_path):
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    logger.warning(f"Error to remove {path}: {e}")
+
+    def _write_frame(self, frame):
+        if self._current is not None and frame.timestamp - self._current.start >= self._segment_duration:
+            self._close_segment()
+        if self._current is None:
+            self._open_segment(frame.timestamp)
+        segment = self._current
+        offset = segment.size + len(self._buffer)
+        self._buffer += frame.header
+        self._buffer += frame.data
+        self._buffer += b"\r\n"
+        time_ms = max(int(frame.timestamp * 1000) - segment.start_ms, 0)
+        with self._lock:
+            self._current_index.append(time_ms, offset)
+            segment.frames += 1
+            segment.end_ms = segment.start_ms + time_ms
+        self._stats["frames"] += 1
+        self._stats["bytes"] += len(frame.header) + len(frame.data) + 2
+        self._flush()
+
+    def _run(self):
+        while self._running:
+            frame = self._cursor.read(1)
+            if not self._recording:
+                self._close_segment()
+            elif frame is not None:
+                self._write_frame(frame)
+        self._close_segment()
+
+    def start(self):
+        if self._thread is None:
+            logger.info(f"Start recording to {self._directory}")
+            self.load()
+            self._cursor = self._stream.cursor("recorder", skip = False)
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="recorder", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._running = False
+            self._thread.join()
+            self._thread = None
+            self._cursor.close()
+            self._cursor = None
+            logger.info("Recording stopped")
+
+    # all segments, the current (being recorded) is the last
+    def segments(self):
+        with self._lock:
+            segments = list(self._segments)
+            if self._current is not None:
+                segments.append(self._current)
+        return segments
+
+    # the segment name, byte offset, length and timestamp of the frame at the
+    # time (the last frame not later than the time), None if not recorded
+    def find(self, timestamp):
+        time_ms = int(timestamp * 1000)
+        with self._lock:
+            segments = list(self._segments)
+            current, current_index = self._current, self._current_index
+            if current is not None:
+                # only the frames written to disk
+                count = bisect.bisect_right(current_index.offsets, current.size) - 1
+                current_index = SegmentIndex(current_index.times[:count], current_index.offsets[:count + 1])
+                segments.append(current)
+        i = bisect.bisect_right([segment.start_ms for segment in segments], time_ms) - 1
+        if i < 0:
+            return None
+        segment = segments[i]
+        try:
+            index = current_index if segment is current else self._index_of(segment)
+        except OSError as e:
+            logger.warning(f"Error to read index of {segment.name}: {e}")
+            return None
+        j = bisect.bisect_right(index.times, time_ms - segment.start_ms) - 1
+        if j < 0:
+            return None
+        offset = index.offsets[j]
+        end = index.offsets[j + 1] if j + 1 < len(index.offsets) else segment.size
+        return segment.name, offset, end - offset, (segment.start_ms + index.times[j]) / 1000
+
+    # JPEG image of the frame at the time, None if not recorded
+    def read_frame(self, timestamp):
+        found = self.find(timestamp)
+        if found is None:
+            return None
+        name, offset, length, _ = found
+        with open(os.path.join(self._directory, name), "rb") as f:
+            f.seek(offset)
+            part = f.read(length)
+        header_end = part.find(b"\r\n\r\n")
+        return part[header_end + 4:-2] if header_end >= 0 else None
+
+    # path and size (bytes on disk) of the segment, None if not found
+    def segment_file(self, name):
+        for segment in self.segments():
+            if segment.name == name:
+                return segment.path, segment.size
+        return None
+
+    def stats(self):
+        segments = self.segments()
+        return dict(self._stats,
+                    recording=self._recording,
+                    recorded=len(segments),
+                    size=sum(segment.size for segment in segments),
+                    start=segments[0].start if segments else None,
+                    end=segments[-1].end if segments else None,
+                    dropped=self._cursor.dropped if self._cursor is not None else 0)
+
+# Recordings are served by the web servers:
+# - "/recordings": segments (JSON), with "?t=<time>" the segment, byte offset
+#   and timestamp of the frame at the time (seconds since epoch), to seek in
+#   the segment with a Range request.
+# - "/recordings/<start>.mjpg": the segment, with Range requests.
+# - "/recording.jpg?t=<time>": the frame at the time.
+LIST_PATH = "/recordings"
+SEGMENT_PREFIX = "/recordings/"
+FRAME_PATH = "/recording.jpg"
+
+def is_recording_path(path):
+    url_path = urllib.parse.urlsplit(path).path
+    return url_path in (LIST_PATH, FRAME_PATH) or url_path.startswith(SEGMENT_PREFIX)
+
+# part of a file sent as the body of a response, e.g. with sendfile
+class FileRange(object):
+    def __init__(self, path, offset, length):
+        self.path = path
+        self.offset = offset
+        self.length = length
+
+# (start, end) of the byte range, None for the whole file (no or several
+# ranges), raise ValueError if not satisfiable
+def parse_range(value, size):
+    if not value or not value.startswith("bytes=") or "," in value:
+        return None
+    first, _, last = value[len("bytes="):].strip().partition("-")
+    try:
+        if first == "":
+            start, end = max(size - int(last), 0), size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise ValueError(f"Range not satisfiable: {value}")
+    return start, end
+
+# return (code, headers, body) of the request for request headers (lower
+# case names), body is bytes or a FileRange
+def recording_response(recorder, path, headers = {}):
+    if recorder is None:
+        return 404, {}, b""
+    url = urllib.parse.urlsplit(path)
+    query = urllib.parse.parse_qs(url.query)
+    no_cache = {"Cache-Control": "no-cache"}
+    try:
+        timestamp = float(query["t"][0]) if "t" in query else None
+    except ValueError:
+        return 400, {}, b""
+    if url.path == LIST_PATH:
+        if timestamp is None:
+            body = {"segments": [segment.to_dict() for segment in recorder.segments()]}
+        else:
+            found = recorder.find(timestamp)
+            if found is None:
+                return 404, {}, b""
+            name, offset, length, frame_time = found
+            body = {"url": f"recordings/{name}", "offset": offset, "length": length, "timestamp": frame_time}
+        return 200, dict(no_cache, **{"Content-Type": "application/json"}), json.dumps(body).encode()
+    if url.path == FRAME_PATH:
+        if timestamp is None:
+            return 400, {}, b""
+        try:
+            image = recorder.read_frame(timestamp)
+        except OSError as e:
+            logger.warning(f"Error to read recording: {e}")
+            return 404, {}, b""
+        if image is None:
+            return 404, {}, b""
+        return 200, {"Content-Type": "image/jpeg", "Cache-Control": "public, max-age=3600"}, image
+    found = recorder.segment_file(url.path[len(SEGMENT_PREFIX):])
+    if found is None:
+        return 404, {}, b""
+    file_path, size = found
+    response_headers = dict(no_cache, **{"Content-Type": "video/x-motion-jpeg", "Accept-Ranges": "bytes"})
+    try:
+        byte_range = parse_range(headers.get("range"), size)
+    except ValueError:
+        return 416, {"Content-Range": f"bytes */{size}"}, b""
+    if byte_range is None:
+        response_headers["Content-Length"] = size
+        return 200, response_headers, FileRange(file_path, 0, size)
+    start, end = byte_range
+    response_headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    response_headers["Content-Length"] = end - start + 1
+    return 206, response_headers, FileRange(file_path, start, end - start + 1)
@@ -0,0 +1,189 @@
+import io
+import time
+import threading
+from PIL import Image
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Region of interest (ROI) is a rectangle [x, y, width, height] normalized
+# to the full frame, i.e. [0, 0, 1, 1] is the full frame.
+
+def clamp_rect(rect, min_size = 0.05):
+    x, y, w, h = [float(v) for v in rect]
+    w = min(max(w, min_size), 1.0)
+    h = min(max(h, min_size), 1.0)
+    x = min(max(x, 0.0), 1.0 - w)
+    y = min(max(y, 0.0), 1.0 - h)
+    return [x, y, w, h]
+
+# expand the rect around its center to the aspect ratio (width / height in
+# normalized units), so it is not distorted when scaled to the stream size
+def fit_rect(rect, aspect):
+    x, y, w, h = rect
+    cx, cy = x + w / 2, y + h / 2
+    if w / h < aspect:
+        w = h * aspect
+    else:
+        h = w / aspect
+    if w > 1.0:
+        w, h = 1.0, 1.0 / aspect
+    if h > 1.0:
+        w, h = aspect, 1.0
+    return [round(v, 4) for v in clamp_rect([cx - w / 2, cy - h / 2, w, h], 0)]
+
+# Arbitrate ROI requests of several viewers, each request is held for a
+# lease (seconds) and must be renewed by the viewer.
+# "latest": the most recent request wins, the previous one takes over when
+#   the latest is released or expired. A renewal of the same rect keeps the
+#   time of the request, so renewals do not switch the active ROI.
+# "owner": the first viewer holds the ROI until released or expired, the
+#   requests of other viewers are denied.
+# "union": the bounding box of all requests.
+class RoiArbiter(object):
+    POLICIES = ("latest", "owner", "union")
+
+    def __init__(self, policy = "latest", lease = 10):
+        if policy not in self.POLICIES:
+            raise Exception(f"Unsupported ROI policy: {policy}")
+        self._policy = policy
+        self._lease = lease
+        self._requests = {} # owner -> (rect, time of request, time of renewal)
+        self._lock = threading.Lock()
+
+    @property
+    def policy(self):
+        return self._policy
+
+    # called with lock
+    def _expire(self):
+        now = time.time()
+        for owner in [o for o, (_, _, t) in self._requests.items() if now - t > self._lease]:
+            logger.info(f"ROI lease expired: {owner}")
+            del self._requests[owner]
+
+    # return True if the request is granted
+    def request(self, owner, rect):
+        with self._lock:
+            self._expire()
+            if rect is None:
+                self._requests.pop(owner, None)
+                return True
+            if self._policy == "owner" and any(o is not owner for o in self._requests):
+                return False
+            rect = clamp_rect(rect)
+            now = time.time()
+            previous = self._requests.get(owner)
+            requested_t = previous[1] if previous is not None and previous[0] == rect else now
+            self._requests[owner] = (rect, requested_t, now)
+            return True
+
+    def release(self, owner):
+        with self._lock:
+            self._requests.pop(owner, None)
+
+    # the active ROI, or None
+    def active(self):
+        with self._lock:
+            self._expire()
+            if not self._requests:
+                return None
+            if self._policy == "union":
+                rects = [rect for rect, _, _ in self._requests.values()]
+                x0 = min(r[0] for r in rects)
+                y0 = min(r[1] for r in rects)
+                x1 = max(r[0] + r[2] for r in rects)
+                y1 = max(r[1] + r[3] for r in rects)
+                return [x0, y0, x1 - x0, y1 - y0]
+            rect, _, _ = max(self._requests.values(), key=lambda request: request[1])
+            return rect
+
+    def owners(self):
+        with self._lock:
+            return len(self._requests)
+
+# ROI stream crops the ROI from the frames of "main" stream, and encodes it
+# at the stream size, so the zoomed view has the detail of "main" stream at
+# the bandwidth of the normal stream.
+# Frames are handed over from the camera thread with only the ROI copied,
+# and encoded in a worker thread, frames are skipped when the worker is busy
+# or faster than "fps". Nothing is done if there is no ROI or no viewer.
+class RoiStream(object):
+    def __init__(self, stream, size = (640, 480), fps = 15, quality = 80):
+        self._stream = stream
+        self._size = tuple(size)
+        self._interval = 1.0 / fps
+        self._quality = quality
+        self._rect = None
+        self._pending = None
+        self._last_t = 0
+        self._condition = threading.Condition()
+        self._thread = None
+        self._running = False
+
+    @property
+    def stream(self):
+        return self._stream
+
+    @property
+    def rect(self):
+        return self._rect
+
+    @property
+    def active(self):
+        return self._rect is not None and self._stream.consumers > 0
+
+    def set_size(self, size):
+        self._size = tuple(size)
+
+    def set_rect(self, rect):
+        self._rect = rect
+
+    # called in camera thread with a function returning a context of the
+    # array of "main" frame (BGR), which is only mapped if the frame is used
+    def on_frame(self, main):
+        rect = self._rect
+        now = time.time()
+        if rect is None or now - self._last_t < self._interval or self._pending is not None:
+            return
+        self._last_t = now
+        with main() as array:
+            height, width = array.shape[:2]
+            x0, y0 = int(rect[0] * width), int(rect[1] * height)
+            x1, y1 = int((rect[0] + rect[2]) * width), int((rect[1] + rect[3]) * height)
+            crop = array[y0:y1, x0:x1].copy()
+        with self._condition:
+            self._pending = (crop, now)
+            self._condition.notify()
+
+    def _run(self):
+        while self._running:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending is not None or not self._running, 1)
+                pending, self._pending = self._pending, None
+            if pending is None:
+                continue
+            crop, timestamp = pending
+            try:
+                height, width = crop.shape[:2]
+                image = Image.frombuffer("RGB", (width, height), crop, "raw", "BGR", 0, 1)
+                image = image.resize(self._size, resample=Image.BILINEAR)
+                buf = io.BytesIO()
+                image.save(buf, format="JPEG", quality=self._quality)
+                self._stream.write_frame(buf.getvalue(), timestamp, time.time())
+            except Exception as e:
+                logger.warning(f"Error to encode ROI frame: {e}")
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="roi", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            with self._condition:
+                self._running = False
+                self._condition.notify()
+            self._thread.join()
+            self._thread = None
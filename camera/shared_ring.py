@@ -0,0 +1,349 @@
+import os
+import time
+import struct
+import itertools
+import threading
+import multiprocessing.connection
+from multiprocessing import shared_memory
+from PIL import Image
+from metrics import registry
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Frames shared by the capture process and the worker processes (see
+# supervisor.py) in a ring of slots in shared memory, so a frame is written
+# once by the capture process and read by the workers without any pipe,
+# pickling or socket between them.
+# The header holds the sequence number of the latest frame, each slot a
+# frame: its sequence number, capture and encoder timestamps, size, width
+# and height (of raw images, 0 for JPEG frames), then the data.
+# There is one writer and no lock: the writer clears the sequence number of
+# a slot before the data is overwritten and sets it after, and a reader
+# checks the sequence number before and after it copies the data, so a frame
+# overwritten while it is read is detected and dropped.
+
+MAGIC = b"LCFR"
+HEADER = struct.Struct("<4sIIQ") # magic, slots, slot bytes, latest sequence number
+SLOT = struct.Struct("<QddIII4x") # sequence number, timestamp, encoded_t, size, width, height
+HEADER_BYTES = 64 # header padded to a cache line
+LATEST_OFFSET = 12
+
+RING_FRAMES = registry.counter("camera_ring_frames_total", "Frames of a stream written to shared memory", ("stream",))
+RING_OVERSIZE = registry.counter("camera_ring_oversize_total", "Frames of a stream too large for shared memory",
+    ("stream",))
+
+# a frame read from the ring, the data is a copy of the slot
+class RingFrame(object):
+    __slots__ = ("seq", "timestamp", "encoded_t", "data", "width", "height")
+
+    def __init__(self, seq, timestamp, encoded_t, data, width = 0, height = 0):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.encoded_t = encoded_t
+        self.data = data
+        self.width = width
+        self.height = height
+
+class SharedFrameRing(object):
+    # create the ring (in the capture process) if "slots" is set, otherwise
+    # attach to the ring of the name (in a worker process)
+    def __init__(self, name, slots = 0, slot_bytes = 0):
+        if slots:
+            slot_stride = (SLOT.size + slot_bytes + 63) // 64 * 64
+            self._shm = shared_memory.SharedMemory(name=name, create=True, size=HEADER_BYTES + slots * slot_stride)
+            HEADER.pack_into(self._shm.buf, 0, MAGIC, slots, slot_bytes, 0)
+            self._owner = True
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+            magic, slots, slot_bytes, _ = HEADER.unpack_from(self._shm.buf, 0)
+            if magic != MAGIC:
+                self._shm.close()
+                raise Exception(f"Not a frame ring: {name}")
+            self._owner = False
+        self._name = name
+        self._slots = slots
+        self._slot_bytes = slot_bytes
+        self._slot_stride = (SLOT.size + slot_bytes + 63) // 64 * 64
+        self._seq = self.latest_seq
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def slots(self):
+        return self._slots
+
+    @property
+    def slot_bytes(self):
+        return self._slot_bytes
+
+    @property
+    def latest_seq(self):
+        return struct.unpack_from("<Q", self._shm.buf, LATEST_OFFSET)[0]
+
+    def _offset(self, seq):
+        return HEADER_BYTES + seq % self._slots * self._slot_stride
+
+    # write a frame (bytes-like), return its sequence number, None if it is
+    # larger than a slot, only called by the writer
+    def write(self, data, timestamp, encoded_t = None, width = 0, height = 0):
+        size = len(data)
+        if size > self._slot_bytes:
+            return None
+        seq = self._seq + 1
+        offset = self._offset(seq)
+        buf = self._shm.buf
+        SLOT.pack_into(buf, offset, 0, 0, 0, 0, 0, 0)
+        buf[offset + SLOT.size:offset + SLOT.size + size] = data
+        SLOT.pack_into(buf, offset, seq, timestamp, encoded_t or 0, size, width, height)
+        struct.pack_into("<Q", buf, LATEST_OFFSET, seq)
+        self._seq = seq
+        return seq
+
+    # the frame of the sequence number, None if it is no longer in the ring
+    # or was overwritten while it was read
+    def read(self, seq):
+        offset = self._offset(seq)
+        buf = self._shm.buf
+        slot_seq, timestamp, encoded_t, size, width, height = SLOT.unpack_from(buf, offset)
+        if slot_seq != seq or size > self._slot_bytes:
+            return None
+        data = bytes(buf[offset + SLOT.size:offset + SLOT.size + size])
+        if SLOT.unpack_from(buf, offset)[0] != seq:
+            return None
+        return RingFrame(seq, timestamp, encoded_t or None, data, width, height)
+
+    def close(self):
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+# Exporter writes the frames of a stream buffer to a ring, as a listener of
+# the stream (in the encoder thread), and rings the doorbells of the workers,
+# a byte written to a non-blocking pipe of each worker, so the workers wait
+# for frames without polling. A full pipe (the worker is busy) or a closed
+# one (the worker exited) is ignored.
+# The exporter is a consumer of the stream, e.g. the ROI is encoded while it
+# is requested, as the viewers are in the workers.
+class RingExporter(object):
+    def __init__(self, stream, ring, doorbells):
+        self._stream = stream
+        self._ring = ring
+        self._doorbells = doorbells # function returning the file descriptors
+        self._cursor = None
+        self._frames = RING_FRAMES.labels(stream.name)
+        self._oversize = RING_OVERSIZE.labels(stream.name)
+
+    @property
+    def ring(self):
+        return self._ring
+
+    def start(self):
+        if self._cursor is None:
+            self._cursor = self._stream.cursor("shared memory")
+            self._stream.add_listener(self._on_frame)
+
+    def stop(self):
+        if self._cursor is not None:
+            self._stream.remove_listener(self._on_frame)
+            self._cursor.close()
+            self._cursor = None
+
+    # called in encoder thread with each frame of the stream
+    def _on_frame(self, frame):
+        cursor = self._cursor
+        if cursor is None: # stopped
+            return
+        if self._ring.write(frame.data, frame.timestamp, frame.encoded_t) is None:
+            if self._oversize.value == 0:
+                logger.warning(f"Frame of {len(frame)} bytes is larger than the slots of {self._ring.name}")
+            self._oversize.inc()
+            return
+        self._frames.inc()
+        cursor.advance(frame)
+        for fd in self._doorbells():
+            try:
+                os.write(fd, b"\0")
+            except OSError:
+                pass
+
+# Feeder publishes the frames of rings to the stream buffers of a worker, in
+# one thread woken up by the doorbell of the worker. Frames are published in
+# order as long as they are in the ring, so a worker behind by a few frames
+# catches up without dropping them. The end of the doorbell (the capture
+# process exited) calls "on_close".
+class RingFeeder(object):
+    def __init__(self, doorbell, on_close = None):
+        self._doorbell = doorbell
+        self._on_close = on_close
+        self._feeds = [] # [ring, stream, last sequence number]
+        self._lock = threading.Lock()
+        self._running = False
+        self._thread = None
+
+    def add(self, ring, stream):
+        with self._lock:
+            self._feeds = self._feeds + [[ring, stream, ring.latest_seq]]
+
+    def remove(self, stream):
+        with self._lock:
+            self._feeds = [feed for feed in self._feeds if feed[1] is not stream]
+
+    def _feed(self, feed):
+        ring, stream, seq = feed
+        latest = ring.latest_seq
+        for s in range(max(seq + 1, latest - ring.slots + 1), latest + 1):
+            frame = ring.read(s)
+            if frame is not None:
+                stream.write_frame(frame.data, frame.timestamp, frame.encoded_t)
+        feed[2] = latest
+
+    def _run(self):
+        fd = self._doorbell.fileno()
+        while self._running:
+            if self._doorbell.poll(1):
+                if not os.read(fd, 4096):
+                    logger.warning("Doorbell of frame rings is closed")
+                    if self._on_close is not None:
+                        self._on_close()
+                    break
+            for feed in self._feeds:
+                try:
+                    self._feed(feed)
+                except Exception as e:
+                    logger.warning(f"Error to feed frames of {feed[0].name}: {e}")
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="ring feeder", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._running = False
+            self._thread.join()
+            self._thread = None
+
+# Requests of the workers to the capture process, on the request pipe of
+# each worker, as (request id, method, argument), handled one at a time:
+# - "snapshot": snapshots of the workers are captured by the capture process,
+#   which owns the camera, and encoded by the workers. The capture process
+#   captures an image of "main" stream of the camera with its snapshot engine
+#   (so the requests of all workers share a capture within its max age),
+#   writes the RGB pixels to the snapshot ring of the camera, and replies the
+#   sequence number in the ring, and the worker reads the image from the ring.
+# - "metrics": the metrics of the capture process (see metrics.py), merged
+#   into "/metrics" of the worker.
+class RequestService(object):
+    def __init__(self, rings, video_server_of, connections, timeout = 10):
+        self._rings = rings # camera id -> snapshot ring
+        self._video_server_of = video_server_of
+        self._connections = connections # function returning the request pipes of the workers
+        self._timeout = timeout
+        self._written = {} # camera id -> (capture, sequence number in ring)
+        self._running = False
+        self._thread = None
+        self._stats = {"requests": 0, "writes": 0, "errors": 0}
+        self._methods = {"snapshot": self._capture, "metrics": lambda _: registry.families()}
+
+    def stats(self):
+        return dict(self._stats)
+
+    def _capture(self, camera_id):
+        capture = self._video_server_of(camera_id).snapshots.request_capture().result(self._timeout)
+        written = self._written.get(camera_id)
+        if written is not None and written[0] is capture:
+            return written[1], capture.seq
+        image = capture.image.convert("RGB")
+        seq = self._rings[camera_id].write(image.tobytes(), capture.timestamp, None, *image.size)
+        if seq is None:
+            raise Exception(f"Snapshot of {image.size} is larger than shared memory")
+        self._written[camera_id] = (capture, seq)
+        self._stats["writes"] += 1
+        return seq, capture.seq
+
+    def _handle(self, connection):
+        try:
+            request_id, method, argument = connection.recv()
+        except (EOFError, OSError):
+            return False
+        self._stats["requests"] += 1
+        try:
+            reply = (request_id, self._methods[method](argument))
+        except Exception as e:
+            self._stats["errors"] += 1
+            logger.warning(f"Error of {method} request of worker: {e}")
+            reply = (request_id, str(e))
+        try:
+            connection.send(reply)
+        except OSError:
+            return False
+        return True
+
+    def _run(self):
+        closed = set()
+        while self._running:
+            connections = [c for c in self._connections() if c not in closed]
+            if not connections:
+                time.sleep(0.5)
+                continue
+            try:
+                ready = multiprocessing.connection.wait(connections, 0.5)
+            except OSError: # closed by the supervisor
+                continue
+            for connection in ready:
+                if not self._handle(connection):
+                    closed.add(connection)
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="request service", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._running = False
+            self._thread.join()
+            self._thread = None
+
+# the worker side of the request service, one request at a time
+class RequestClient(object):
+    def __init__(self, connection, rings, timeout = 10):
+        self._connection = connection
+        self._rings = rings # camera id -> snapshot ring
+        self._timeout = timeout
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    # reply of the method, errors are replied as strings
+    def _request(self, method, argument = None):
+        with self._lock:
+            request_id = next(self._ids)
+            self._connection.send((request_id, method, argument))
+            deadline = time.time() + self._timeout
+            while True:
+                if not self._connection.poll(max(deadline - time.time(), 0)):
+                    raise Exception(f"Timeout of {method} request")
+                reply_id, reply = self._connection.recv()
+                if reply_id == request_id:
+                    break
+                # a late reply of a request which timed out
+        if isinstance(reply, str):
+            raise Exception(reply)
+        return reply
+
+    # families of the metrics of the capture process
+    def metrics(self):
+        return self._request("metrics")
+
+    # sequence number of the video stream and PIL image of "main" stream
+    def capture(self, camera_id):
+        ring_seq, seq = self._request("snapshot", camera_id)
+        frame = self._rings[camera_id].read(ring_seq)
+        if frame is None:
+            raise Exception("Snapshot is overwritten in shared memory")
+        return seq, Image.frombytes("RGB", (frame.width, frame.height), frame.data)
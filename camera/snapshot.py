@@ -0,0 +1,177 @@
+import io
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from metrics import registry, DURATION_BUCKETS
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Supported snapshot formats, the file extension is the format name in URL.
+SNAPSHOT_FORMATS = {
+    "png": {"format": "PNG", "content_type": "image/png"},
+    "jpg": {"format": "JPEG", "content_type": "image/jpeg"},
+    "jpeg": {"format": "JPEG", "content_type": "image/jpeg"},
+    "webp": {"format": "WEBP", "content_type": "image/webp"},
+}
+
+SNAPSHOT_CAPTURE = registry.histogram("camera_snapshot_capture_seconds",
+    "Time to capture a snapshot image", buckets=DURATION_BUCKETS)
+SNAPSHOT_ENCODE = registry.histogram("camera_snapshot_encode_seconds",
+    "Time to encode a snapshot image", ("format",), buckets=DURATION_BUCKETS)
+
+# An encoded snapshot image, identified by the sequence number of the video
+# stream frame at capture time, the format and the quality.
+class Snapshot(object):
+    def __init__(self, seq, timestamp, format, quality, data):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.format = format
+        self.quality = quality
+        self.data = data
+        self.ready_t = time.time()
+
+    @property
+    def content_type(self):
+        return SNAPSHOT_FORMATS[self.format]["content_type"]
+
+    @property
+    def etag(self):
+        return f'"{self.seq}-{int(self.timestamp * 1000)}-{self.format}-{self.quality}"'
+
+    def __len__(self):
+        return len(self.data)
+
+# A captured (not encoded) image, shared by all formats.
+class Capture(object):
+    def __init__(self, seq, image):
+        self.seq = seq
+        self.image = image
+        self.timestamp = time.time()
+        self.ready_t = self.timestamp
+
+    @property
+    def id(self):
+        return f"{self.seq}-{int(self.timestamp * 1000)}"
+
+# Snapshot engine captures and encodes snapshot images in a worker pool, so
+# the web server never blocks on capturing or encoding.
+# Concurrent requests share one capture (single-flight), and requests of the
+# same format and quality also share one encoding. A capture or snapshot is
+# served from cache for "max_age" seconds after it is ready.
+# The capture function returns the sequence number of the video stream and
+# a PIL image of the "main" stream.
+class SnapshotEngine(object):
+    def __init__(self, capture, workers = 2, max_age = 1.0, quality = 90, png_compress_level = 1):
+        self._capture = capture
+        self._max_age = max_age
+        self._quality = quality
+        self._png_compress_level = png_compress_level
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="snapshot")
+        self._lock = threading.Lock()
+        self._capture_future = None
+        self._snapshot_futures = {}
+        self._stats = {"requests": 0, "captures": 0, "encodes": 0, "cache_hits": 0, "coalesced": 0, "errors": 0}
+
+    @property
+    def max_age(self):
+        return self._max_age
+
+    def stats(self):
+        return dict(self._stats)
+
+    # a future is fresh if it is pending, or done successfully within max age
+    def _fresh(self, future):
+        if not future.done():
+            return True
+        if future.cancelled() or future.exception() is not None:
+            return False
+        return time.time() - future.result().ready_t <= self._max_age
+
+    # quality is clamped to [1, 100] in steps of 5 to bound the cache size
+    def _quality_of(self, format, quality):
+        if SNAPSHOT_FORMATS[format]["format"] == "PNG":
+            return None
+        quality = self._quality if quality is None else int(quality)
+        return min(max(quality // 5 * 5, 1), 100)
+
+    # future of the snapshot with format and quality
+    def request(self, format = "png", quality = None):
+        if format not in SNAPSHOT_FORMATS:
+            raise Exception(f"Unsupported snapshot format: {format}")
+        quality = self._quality_of(format, quality)
+        key = (format, quality)
+        with self._lock:
+            self._stats["requests"] += 1
+            future = self._snapshot_futures.get(key)
+            if future is not None and self._fresh(future):
+                self._stats["cache_hits" if future.done() else "coalesced"] += 1
+                return future
+            # drop stale snapshots
+            self._snapshot_futures = {k: f for k, f in self._snapshot_futures.items() if self._fresh(f)}
+            capture_future = self._request_capture()
+            future = Future()
+            self._snapshot_futures[key] = future
+        capture_future.add_done_callback(lambda f: self._encode_after(f, future, format, quality))
+        return future
+
+    # future of a fresh capture, called with lock
+    def _request_capture(self):
+        capture_future = self._capture_future
+        if capture_future is None or not self._fresh(capture_future):
+            capture_future = self._capture_future = self._executor.submit(self._do_capture)
+        return capture_future
+
+    # future of a fresh (not encoded) capture, e.g. for tiles
+    def request_capture(self):
+        with self._lock:
+            return self._request_capture()
+
+    # blocking request, return None on error or timeout
+    def get(self, format = "png", quality = None, timeout = 10):
+        try:
+            return self.request(format, quality).result(timeout)
+        except Exception as e:
+            logger.warning(f"Failed snapshot: {e}")
+            return None
+
+    def _do_capture(self):
+        start_t = time.time()
+        try:
+            seq, image = self._capture()
+        except Exception:
+            self._stats["errors"] += 1
+            raise
+        self._stats["captures"] += 1
+        SNAPSHOT_CAPTURE.observe(time.time() - start_t)
+        logger.info(f"Snapshot captured: {seq=}, size={image.size}, {time.time() - start_t:.3f}s")
+        return Capture(seq, image)
+
+    def _encode_after(self, capture_future, future, format, quality):
+        if capture_future.exception() is not None:
+            future.set_exception(capture_future.exception())
+            return
+        try:
+            self._executor.submit(self._do_encode, capture_future.result(), future, format, quality)
+        except RuntimeError as e: # executor shutdown
+            future.set_exception(e)
+
+    def _do_encode(self, capture, future, format, quality):
+        start_t = time.time()
+        try:
+            options = SNAPSHOT_FORMATS[format]
+            params = {"compress_level": self._png_compress_level} if options["format"] == "PNG" else {"quality": quality}
+            buf = io.BytesIO()
+            capture.image.save(buf, format=options["format"], **params)
+            snapshot = Snapshot(capture.seq, capture.timestamp, format, quality, buf.getvalue())
+            self._stats["encodes"] += 1
+            SNAPSHOT_ENCODE.labels(options["format"].lower()).observe(time.time() - start_t)
+            logger.info(f"Snapshot encoded: {format=}, {quality=}, size={len(snapshot)}, {time.time() - start_t:.3f}s")
+            future.set_result(snapshot)
+        except Exception as e:
+            self._stats["errors"] += 1
+            logger.warning(f"Error to encode snapshot: {e}")
+            future.set_exception(e)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import threading
+import urllib.parse
+from collections import deque
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Server side of the speed test page (speed.html with speedtest.js), the
+# URLs are relative to the page:
+# - "speedtest.dat?ckSize=<n>": download of n chunks of 1 MiB (default 4),
+#   all chunks are views of one random buffer generated at startup, so a
+#   download allocates nothing and is not compressed by the link.
+# - "empty": upload sink (POST, the body is read and discarded) and ping.
+# - "ip": IP address of the client.
+# - "speedtest/result": result of a test posted by the page (JSON).
+# The results are kept per client, e.g. to choose a stream variant which
+# fits the link of a viewer.
+
+CHUNK_SIZE = 1024 * 1024
+DEFAULT_CHUNKS = 4
+MAX_CHUNKS = 1024
+MAX_RESULT_SIZE = 1024
+
+DOWNLOAD_PATH = "/speedtest.dat"
+EMPTY_PATH = "/empty"
+IP_PATH = "/ip"
+RESULT_PATH = "/speedtest/result"
+SPEEDTEST_PATHS = (DOWNLOAD_PATH, EMPTY_PATH, IP_PATH, RESULT_PATH)
+
+NO_STORE_HEADERS = {
+    "Cache-Control": "no-store, no-cache, must-revalidate, max-age=0",
+    "Pragma": "no-cache",
+}
+
+def is_speedtest_path(path):
+    return urllib.parse.urlsplit(path).path in SPEEDTEST_PATHS
+
+# number of chunks of a download, None if the path is not a download
+def download_chunks(path):
+    url = urllib.parse.urlsplit(path)
+    if url.path != DOWNLOAD_PATH:
+        return None
+    value = urllib.parse.parse_qs(url.query).get("ckSize", [""])[0]
+    chunks = int(value) if value.isdigit() else DEFAULT_CHUNKS
+    return min(max(chunks, 1), MAX_CHUNKS)
+
+def download_headers(chunks):
+    return dict(NO_STORE_HEADERS, **{
+        "Content-Type": "application/octet-stream",
+        "Content-Length": chunks * CHUNK_SIZE,
+        "Content-Disposition": "attachment; filename=random.dat",
+    })
+
+# result of a speed test, speeds in Mbps and times in milliseconds, None if
+# not measured
+class SpeedTestResult(object):
+    def __init__(self, client, download = None, upload = None, ping = None, jitter = None):
+        self.client = client
+        self.download = download
+        self.upload = upload
+        self.ping = ping
+        self.jitter = jitter
+        self.timestamp = time.time()
+
+    def to_dict(self):
+        return {
+            "client": self.client,
+            "download": self.download,
+            "upload": self.upload,
+            "ping": self.ping,
+            "jitter": self.jitter,
+            "timestamp": self.timestamp,
+        }
+
+class SpeedTests(object):
+    def __init__(self, max_results = 32):
+        self._chunk = memoryview(os.urandom(CHUNK_SIZE))
+        # uploads are read into one buffer and discarded
+        self._sink = memoryview(bytearray(64 * 1024))
+        self._results = deque(maxlen=max_results)
+        self._lock = threading.Lock()
+        self._stats = {"downloads": 0, "bytes_sent": 0, "uploads": 0, "bytes_received": 0, "pings": 0}
+
+    # the random buffer of each chunk of a download
+    @property
+    def chunk(self):
+        return self._chunk
+
+    @property
+    def sink(self):
+        return self._sink
+
+    def count(self, name, size = 0):
+        self._stats[name + "s"] += 1
+        if name == "download":
+            self._stats["bytes_sent"] += size
+        elif name == "upload":
+            self._stats["bytes_received"] += size
+
+    # response (code, headers, body) of ping, IP and results (GET)
+    def response(self, path, client):
+        url_path = urllib.parse.urlsplit(path).path
+        if url_path == EMPTY_PATH:
+            self.count("ping")
+            return 200, dict(NO_STORE_HEADERS), b""
+        if url_path == IP_PATH:
+            return 200, dict(NO_STORE_HEADERS, **{"Content-Type": "text/plain"}), client.encode()
+        if url_path == RESULT_PATH:
+            return 200, dict(NO_STORE_HEADERS, **{"Content-Type": "application/json"}), json.dumps(self.results()).encode()
+        return 404, {}, b""
+
+    # record the result posted by the page, return the result
+    def record(self, client, body):
+        try:
+            params = json.loads(body)
+        except ValueError as e:
+            raise ValueError(f"Bad speed test result: {e}")
+        if not isinstance(params, dict):
+            raise ValueError("Bad speed test result")
+        def number(key):
+            try:
+                value = float(params.get(key))
+                return value if value >= 0 else None
+            except (TypeError, ValueError):
+                return None
+        result = SpeedTestResult(client, number("dl"), number("ul"), number("ping"), number("jitter"))
+        logger.info(f"Speed test result: {result.to_dict()}")
+        with self._lock:
+            self._results.append(result)
+        return result
+
+    # the latest result of the client, or of any client if None
+    def latest(self, client = None):
+        with self._lock:
+            for result in reversed(self._results):
+                if client is None or result.client == client:
+                    return result
+        return None
+
+    def results(self):
+        with self._lock:
+            return [result.to_dict() for result in self._results]
+
+    def stats(self):
+        return dict(self._stats, results=len(self._results))
@@ -0,0 +1,165 @@
+import os
+import time
+import threading
+import multiprocessing
+import multiprocessing.connection
+from metrics import registry
+
+import logging
+logger = logging.getLogger(__name__)
+
+WORKERS = registry.gauge("camera_workers", "Worker processes running")
+WORKER_RESTARTS = registry.counter("camera_worker_restarts_total", "Worker processes restarted after they exited")
+
+# Supervisor runs the worker processes of the multi-process mode, and starts
+# a worker again when it exits (e.g. crashes), after a delay which doubles
+# for a worker exiting soon after its start, up to "max_restart_delay".
+# Workers are started with "spawn", i.e. a fresh interpreter, so nothing of
+# the capture process (the camera, threads, locks) is inherited.
+# Each worker gets its own pipes from the capture process, created for each
+# start: the doorbell (the capture process writes a byte for each frame, see
+# shared_ring.py) and the request pipe of snapshots, and a slot of the shared
+# array of viewer counts, which it updates.
+# The target is called as target(index, doorbell, requests, viewers, *args).
+class Supervisor(object):
+    def __init__(self, workers, target, args = (), restart_delay = 1.0, max_restart_delay = 30.0):
+        self._context = multiprocessing.get_context("spawn")
+        self._workers = [None] * workers # index -> Worker
+        self._target = target
+        self._args = args
+        self._restart_delay = restart_delay
+        self._max_restart_delay = max_restart_delay
+        self._viewers = self._context.RawArray("i", workers)
+        self._doorbells = []
+        self._connections = []
+        self._closing = [] # (time removed, worker)
+        self._running = False
+        self._thread = None
+        self._stats = {"starts": 0, "restarts": 0}
+        WORKERS.set_function(lambda: sum(1 for w in self._workers if w is not None and w.process.is_alive()))
+
+    # file descriptors of the doorbells of the running workers
+    def doorbells(self):
+        return self._doorbells
+
+    # request pipes of the running workers
+    def connections(self):
+        return self._connections
+
+    # viewers of all workers
+    @property
+    def viewers(self):
+        return sum(self._viewers)
+
+    def stats(self):
+        workers = [{"index": w.index, "pid": w.process.pid, "restarts": w.restarts, "viewers": self._viewers[w.index],
+                    "uptime": time.time() - w.started_t} for w in self._workers if w is not None]
+        return dict(self._stats, workers=workers)
+
+    def _start_worker(self, index, restarts = 0):
+        doorbell, doorbell_writer = self._context.Pipe(duplex=False)
+        requests, worker_requests = self._context.Pipe()
+        self._viewers[index] = 0
+        process = self._context.Process(target=self._target, name=f"worker-{index}", daemon=True,
+                                        args=(index, doorbell, worker_requests, self._viewers) + tuple(self._args))
+        process.start()
+        # the ends of the worker are closed in this process
+        doorbell.close()
+        worker_requests.close()
+        os.set_blocking(doorbell_writer.fileno(), False)
+        worker = Worker(index, process, doorbell_writer, requests, restarts)
+        self._workers[index] = worker
+        self._update_channels()
+        self._stats["starts"] += 1
+        logger.info(f"Worker {index} started: pid {process.pid}")
+        return worker
+
+    def _update_channels(self):
+        workers = [w for w in self._workers if w is not None]
+        self._doorbells = [w.doorbell.fileno() for w in workers]
+        self._connections = [w.requests for w in workers]
+
+    # the pipes of a removed worker are closed a while later, when no thread
+    # (the exporters of frames and the request service) still uses them, so
+    # a doorbell is never written after its descriptor is reused
+    def _remove_worker(self, worker):
+        self._workers[worker.index] = None
+        self._update_channels()
+        self._closing.append((time.time(), worker))
+
+    def _close_removed(self, before):
+        closing = [(t, w) for t, w in self._closing if t < before]
+        self._closing = [(t, w) for t, w in self._closing if t >= before]
+        for _, worker in closing:
+            worker.close()
+
+    def _run(self):
+        pending = {} # index -> (time to start, restarts)
+        while self._running:
+            self._close_removed(time.time() - 1)
+            sentinels = {w.process.sentinel: w for w in self._workers if w is not None}
+            for sentinel in multiprocessing.connection.wait(list(sentinels), 0.5):
+                worker = sentinels[sentinel]
+                worker.process.join()
+                self._remove_worker(worker)
+                if not self._running:
+                    break
+                # a worker which ran for a while is restarted at once
+                uptime = time.time() - worker.started_t
+                delay = 0 if uptime > self._max_restart_delay else min(
+                    self._restart_delay * 2 ** min(worker.restarts, 16), self._max_restart_delay)
+                logger.warning(f"Worker {worker.index} exited with code {worker.process.exitcode} after "
+                               f"{uptime:.1f}s, restart in {delay:.1f}s")
+                pending[worker.index] = (time.time() + delay, worker.restarts + 1 if delay else 0)
+            for index, (start_t, restarts) in list(pending.items()):
+                if self._running and time.time() >= start_t:
+                    del pending[index]
+                    try:
+                        self._start_worker(index, restarts)
+                        self._stats["restarts"] += 1
+                        WORKER_RESTARTS.inc()
+                    except Exception as e:
+                        logger.warning(f"Failed restart worker {index}: {e}")
+                        pending[index] = (time.time() + self._max_restart_delay, restarts + 1)
+
+    def start(self):
+        if self._thread is None:
+            logger.info(f"Start {len(self._workers)} worker processes")
+            for index in range(len(self._workers)):
+                self._start_worker(index)
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="supervisor", daemon=True)
+            self._thread.start()
+
+    # terminate the workers (SIGTERM), and kill the ones which do not exit in time
+    def stop(self, timeout = 5):
+        if self._thread is not None:
+            self._running = False
+            self._thread.join()
+            self._thread = None
+            workers = [w for w in self._workers if w is not None]
+            for worker in workers:
+                worker.process.terminate()
+            deadline = time.time() + timeout
+            for worker in workers:
+                worker.process.join(max(deadline - time.time(), 0))
+                if worker.process.is_alive():
+                    logger.warning(f"Kill worker {worker.index}")
+                    worker.process.kill()
+                    worker.process.join()
+                self._remove_worker(worker)
+            self._close_removed(time.time() + 1)
+            logger.info("Worker processes stopped")
+
+class Worker(object):
+    def __init__(self, index, process, doorbell, requests, restarts = 0):
+        self.index = index
+        self.process = process
+        self.doorbell = doorbell
+        self.requests = requests
+        self.restarts = restarts
+        self.started_t = time.time()
+
+    def close(self):
+        self.doorbell.close()
+        self.requests.close()
@@ -0,0 +1,222 @@
+import os
+import time
+import asyncio
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Telemetry of the system and streams pushed to subscribers (e.g. the admin
+# page) instead of being polled. One sampler task in the event loop of the
+# websocket server samples the topics with at least one subscriber every
+# "interval" seconds, no matter how many clients are subscribed, and nothing
+# is sampled without subscribers. A client is only notified of the topics
+# whose value changed since its last notification, values are rounded so
+# an idle system sends almost nothing.
+# A topic is a function returning its value, or a counter (a number or a
+# dict of numbers) which is sampled as a rate per second.
+# A topic may also be published when it changes (e.g. on motion events),
+# from any thread, so its subscribers do not wait for the next sample.
+
+NETWORK_INTERFACES = ("wlan0", "uap0")
+
+def read_file(path):
+    with open(path) as f:
+        return f.read()
+
+# load averages of 1, 5 and 15 minutes, and CPU count
+def cpu_load():
+    load = read_file("/proc/loadavg").split()
+    return {"load": [float(v) for v in load[:3]], "cpus": os.cpu_count()}
+
+# degree Celsius of the SoC, None if not available
+def cpu_temperature():
+    try:
+        return round(int(read_file("/sys/class/thermal/thermal_zone0/temp")) / 1000, 1)
+    except (OSError, ValueError):
+        return None
+
+# MiB of total and available memory
+def memory():
+    info = {}
+    for line in read_file("/proc/meminfo").splitlines():
+        key, _, value = line.partition(":")
+        info[key] = int(value.split()[0]) # kB
+    return {"total": info["MemTotal"] // 1024, "available": info["MemAvailable"] // 1024}
+
+# bits received and sent by the interfaces (counters)
+def network_bytes(interfaces = NETWORK_INTERFACES):
+    counters = {}
+    for line in read_file("/proc/net/dev").splitlines()[2:]:
+        name, _, values = line.partition(":")
+        name = name.strip()
+        if name in interfaces:
+            values = values.split()
+            counters[name] = {"rx": int(values[0]) * 8, "tx": int(values[8]) * 8}
+    return counters
+
+# rate per second of a counter, the counter is a number or a dict of numbers
+def rate(value, last, duration):
+    if isinstance(value, dict):
+        return {key: rate(v, last.get(key) if isinstance(last, dict) else None, duration) for key, v in value.items()}
+    if last is None or duration <= 0:
+        return None
+    # 3 significant digits
+    return float(f"{max(value - last, 0) / duration:.3g}")
+
+# round floats, so small changes are coalesced
+def rounded(value, digits = 2):
+    if isinstance(value, float):
+        return round(value, digits)
+    if isinstance(value, dict):
+        return {key: rounded(v, digits) for key, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [rounded(v, digits) for v in value]
+    return value
+
+class Topic(object):
+    def __init__(self, name, function, counter = False):
+        self.name = name
+        self.function = function
+        self.counter = counter
+        self._last_count = None
+        self._last_t = None
+
+    def sample(self):
+        value = self.function()
+        if not self.counter:
+            return rounded(value)
+        now = time.monotonic()
+        count, last_count = value, self._last_count
+        duration = now - self._last_t if self._last_t is not None else 0
+        self._last_count, self._last_t = count, now
+        return rate(count, last_count, duration)
+
+    # restart rates of counters, e.g. after sampling was paused
+    def reset(self):
+        self._last_count = None
+        self._last_t = None
+
+class Telemetry(object):
+    def __init__(self, interval = 1.0):
+        self._interval = interval
+        self._topics = {}
+        self._subscribers = {} # subscriber -> (topics, notify function, last values sent)
+        self._values = {} # topic -> value of the last sample
+        self._task = None
+        self._loop = None
+        self._samples = 0
+        self.add_topic("cpu", cpu_load)
+        self.add_topic("temperature", cpu_temperature)
+        self.add_topic("memory", memory)
+        self.add_topic("network", network_bytes, counter = True)
+
+    @property
+    def interval(self):
+        return self._interval
+
+    @property
+    def topics(self):
+        return list(self._topics.keys())
+
+    # the function returns the value of the topic, or a counter (a number or
+    # a dict of numbers) whose rate per second is the value
+    def add_topic(self, name, function, counter = False):
+        self._topics[name] = Topic(name, function, counter)
+
+    # sample topics now, all if None, the value is None if failed
+    def sample(self, names = None):
+        values = {}
+        for name in names if names is not None else self._topics:
+            try:
+                values[name] = self._topics[name].sample()
+            except Exception as e:
+                logger.warning(f"Error to sample {name}: {e}")
+                values[name] = None
+        return values
+
+    # subscribe (or update the subscription) to topics, the async function
+    # "notify" is called with {topic: value} of changed values, starting with
+    # the latest values, return the subscribed topics
+    # must be called in the event loop
+    async def subscribe(self, subscriber, topics, notify):
+        unknown = [name for name in topics if name not in self._topics]
+        if unknown:
+            raise Exception(f"Unknown telemetry topics: {unknown}")
+        _, _, sent = self._subscribers.get(subscriber, (None, None, {}))
+        self._subscribers[subscriber] = (set(topics), notify, sent)
+        self._loop = asyncio.get_running_loop()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        latest = {name: self._values[name] for name in topics if name in self._values}
+        if latest:
+            await self._notify(subscriber, latest)
+        return sorted(topics)
+
+    # unsubscribe from topics, all if None, return the topics still subscribed
+    def unsubscribe(self, subscriber, topics = None):
+        if subscriber not in self._subscribers:
+            return []
+        subscribed, notify, sent = self._subscribers[subscriber]
+        subscribed = subscribed - set(topics) if topics is not None else set()
+        if subscribed:
+            self._subscribers[subscriber] = (subscribed, notify, sent)
+        else:
+            del self._subscribers[subscriber]
+        return sorted(subscribed)
+
+    # sample the topic now and notify its subscribers, may be called from any
+    # thread, nothing is done without subscribers
+    def publish(self, name):
+        loop = self._loop
+        if loop is None or name not in self._subscribed_topics():
+            return
+        loop.call_soon_threadsafe(lambda: loop.create_task(self._publish(name)))
+
+    async def _publish(self, name):
+        values = self.sample([name])
+        if self._task is not None:
+            self._values.update(values)
+        for subscriber in list(self._subscribers):
+            await self._notify(subscriber, values)
+
+    def _subscribed_topics(self):
+        topics = set()
+        for subscribed, _, _ in list(self._subscribers.values()):
+            topics |= subscribed
+        return topics
+
+    async def _notify(self, subscriber, values):
+        subscribed, notify, sent = self._subscribers.get(subscriber, (set(), None, {}))
+        changed = {name: value for name, value in values.items()
+                   if name in subscribed and (name not in sent or sent[name] != value)}
+        if not changed:
+            return
+        sent.update(changed)
+        try:
+            await notify(changed)
+        except Exception as e:
+            logger.warning(f"Error to notify telemetry: {e}")
+
+    # sample subscribed topics until no subscriber is left
+    async def _run(self):
+        logger.info("Start telemetry sampler")
+        try:
+            while True:
+                topics = self._subscribed_topics()
+                if not topics:
+                    break
+                values = self.sample(topics)
+                self._samples += 1
+                self._values = values
+                for subscriber in list(self._subscribers):
+                    await self._notify(subscriber, values)
+                await asyncio.sleep(self._interval)
+        finally:
+            self._task = None
+            self._values.clear()
+            for topic in self._topics.values():
+                topic.reset()
+            logger.info("Telemetry sampler stopped")
+
+    def stats(self):
+        return {"subscribers": len(self._subscribers), "topics": sorted(self._subscribed_topics()), "samples": self._samples}
@@ -0,0 +1,94 @@
+import io
+import time
+import threading
+import urllib.parse
+from PIL import Image
+from metrics import registry, DURATION_BUCKETS
+from snapshot import Snapshot
+
+import logging
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_ENCODE = registry.histogram("camera_thumbnail_encode_seconds",
+    "Time to downscale a thumbnail image", buckets=DURATION_BUCKETS)
+
+# Thumbnails are small JPEG images of the latest frame of the MJPEG stream,
+# e.g. previews on the dashboards of many cameras. The frame is decoded in
+# JPEG draft mode, at 1/2, 1/4 or 1/8 scale by the DCT, so it is never fully
+# decoded, and the camera (the "main" stream) is never touched.
+# One thumbnail is cached for the frame it was made of, and it is served for
+# "max_age" seconds even if newer frames arrive, so any number of clients
+# costs one downscale each "max_age" seconds. Concurrent requests of a new
+# thumbnail wait for the one made by the first of them.
+class Thumbnails(object):
+    def __init__(self, stream, width = 320, quality = 75, max_age = 1.0):
+        self._stream = stream
+        self._width = width
+        self._quality = quality
+        self._max_age = max_age
+        self._thumbnail = None
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "encodes": 0, "cache_hits": 0, "errors": 0}
+
+    # thumbnail of the latest frame, None if no frame
+    def get(self):
+        self._stats["requests"] += 1
+        with self._lock:
+            frame = self._stream.latest
+            thumbnail = self._thumbnail
+            if thumbnail is not None and (frame is None or thumbnail.seq == frame.seq
+                                          or time.time() - thumbnail.ready_t <= self._max_age):
+                self._stats["cache_hits"] += 1
+                return thumbnail
+            if frame is None:
+                return None
+            start_t = time.time()
+            try:
+                data = self.downscale(frame.data)
+            except Exception as e:
+                self._stats["errors"] += 1
+                logger.warning(f"Error to make thumbnail: {e}")
+                return None
+            THUMBNAIL_ENCODE.observe(time.time() - start_t)
+            self._stats["encodes"] += 1
+            self._thumbnail = Snapshot(frame.seq, frame.timestamp, "jpg", self._quality, data)
+            return self._thumbnail
+
+    def downscale(self, data):
+        image = Image.open(io.BytesIO(data))
+        width, height = image.size
+        size = (min(self._width, width), max(round(height * min(self._width, width) / width), 1))
+        # JPEG draft mode decodes at 1/2, 1/4 or 1/8 scale, no smaller than the size
+        image.draft("RGB", size)
+        if image.size != size:
+            image = image.resize(size, resample=Image.BILINEAR)
+        buf = io.BytesIO()
+        image.save(buf, format="JPEG", quality=self._quality)
+        return buf.getvalue()
+
+    def stats(self):
+        thumbnail = self._thumbnail
+        return dict(self._stats, width=self._width, seq=thumbnail.seq if thumbnail is not None else None)
+
+# Thumbnail is served by the web servers as "/thumbnail.jpg", validated with
+# ETag like snapshots.
+THUMBNAIL_PATH = "/thumbnail.jpg"
+
+def is_thumbnail_path(path):
+    return urllib.parse.urlsplit(path).path == THUMBNAIL_PATH
+
+# return (code, headers, body), "headers" are the request headers with lower
+# case names
+def thumbnail_response(thumbnails, path, headers = {}):
+    thumbnail = thumbnails.get()
+    if thumbnail is None:
+        return 503, {}, b""
+    if headers.get("if-none-match") == thumbnail.etag:
+        return 304, {"ETag": thumbnail.etag}, b""
+    response_headers = {
+        "Content-Type": thumbnail.content_type,
+        "ETag": thumbnail.etag,
+        "Cache-Control": "no-cache",
+        "X-Timestamp": f"{thumbnail.timestamp:.6f}",
+    }
+    return 200, response_headers, thumbnail.data
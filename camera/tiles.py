@@ -0,0 +1,177 @@
+import io
+import math
+import threading
+from collections import OrderedDict
+from PIL import Image
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Tile pyramid of one captured image, in the layout of Deep Zoom (DZI).
+# Level "max_level" is the full resolution image, and each lower level is
+# half of the size of the level above, down to level 0 of 1x1 pixel.
+# Level images are generated lazily from the level above, and tiles are
+# cropped from level images on request.
+class TilePyramid(object):
+    def __init__(self, id, image, tile_size = 256, quality = 85):
+        self.id = id
+        self.tile_size = tile_size
+        self.quality = quality
+        self.width, self.height = image.size
+        self.max_level = math.ceil(math.log2(max(self.width, self.height, 1)))
+        self._levels = {self.max_level: image}
+        self._lock = threading.Lock()
+
+    # bytes of the level images in memory, the full resolution image too
+    @property
+    def bytes(self):
+        with self._lock:
+            return sum(image.width * image.height * len(image.getbands()) for image in self._levels.values())
+
+    def level_size(self, level):
+        scale = 2 ** (self.max_level - level)
+        return math.ceil(self.width / scale), math.ceil(self.height / scale)
+
+    def level_tiles(self, level):
+        width, height = self.level_size(level)
+        return math.ceil(width / self.tile_size), math.ceil(height / self.tile_size)
+
+    def _level_image(self, level):
+        with self._lock:
+            return self._build_level_image(level)
+
+    # called with lock
+    def _build_level_image(self, level):
+        image = self._levels.get(level)
+        if image is None:
+            upper = self._build_level_image(level + 1)
+            image = upper.resize(self.level_size(level), resample=Image.BILINEAR)
+            self._levels[level] = image
+        return image
+
+    # JPEG data of a tile, or None if out of range
+    def tile(self, level, col, row):
+        if level < 0 or level > self.max_level:
+            return None
+        cols, rows = self.level_tiles(level)
+        if col < 0 or col >= cols or row < 0 or row >= rows:
+            return None
+        image = self._level_image(level)
+        left, top = col * self.tile_size, row * self.tile_size
+        box = (left, top, min(left + self.tile_size, image.width), min(top + self.tile_size, image.height))
+        buf = io.BytesIO()
+        image.crop(box).save(buf, format="JPEG", quality=self.quality)
+        return buf.getvalue()
+
+    def dzi(self):
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+                f'Format="jpg" Overlap="0" TileSize="{self.tile_size}">'
+                f'<Size Width="{self.width}" Height="{self.height}"/></Image>')
+
+    def info(self):
+        return {
+            "id": self.id,
+            "width": self.width,
+            "height": self.height,
+            "tile_size": self.tile_size,
+            "max_level": self.max_level,
+            "format": "jpg",
+            "dzi": f"tiles/{self.id}.dzi",
+            "url": f"tiles/{self.id}_files/",
+        }
+
+# Tile cache keeps the pyramids of the most recent captures, and the most
+# recently used tiles, up to "max_bytes" for the tiles and the level images
+# of the pyramids together. Beyond it the least recently used tiles are
+# evicted, then the older pyramids. The pyramid of the latest capture is
+# always kept, its level images are the least memory to serve its tiles.
+# Each pyramid is built from one capture of the snapshot engine, so all
+# tiles of a pyramid come from the same image.
+class TileCache(object):
+    def __init__(self, snapshot_engine, max_pyramids = 2, max_bytes = 32 * 1024 * 1024, tile_size = 256):
+        self._snapshot_engine = snapshot_engine
+        self._max_pyramids = max_pyramids
+        self._max_bytes = max_bytes
+        self._tile_size = tile_size
+        self._pyramids = OrderedDict()
+        self._tiles = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def stats(self):
+        with self._lock:
+            level_bytes = self._level_bytes()
+            return dict(self._stats, tiles=len(self._tiles), bytes=self._bytes, level_bytes=level_bytes,
+                        pyramids=list(self._pyramids))
+
+    # called with lock
+    def _level_bytes(self):
+        return sum(pyramid.bytes for pyramid in self._pyramids.values())
+
+    # evict tiles, then older pyramids, until the tiles and level images are
+    # within "max_bytes", called with lock
+    def _evict(self):
+        level_bytes = self._level_bytes()
+        while self._bytes + level_bytes > self._max_bytes:
+            if self._tiles:
+                _, evicted = self._tiles.popitem(last=False)
+                self._bytes -= len(evicted)
+                self._stats["evictions"] += 1
+            elif len(self._pyramids) > 1:
+                id, pyramid = self._pyramids.popitem(last=False)
+                level_bytes -= pyramid.bytes
+                self._evict_pyramid(id)
+            else:
+                break
+
+    # pyramid of a fresh capture, blocking until captured
+    def current(self, timeout = 10):
+        capture = self._snapshot_engine.request_capture().result(timeout)
+        with self._lock:
+            pyramid = self._pyramids.get(capture.id)
+            if pyramid is None:
+                pyramid = TilePyramid(capture.id, capture.image, self._tile_size)
+                self._pyramids[capture.id] = pyramid
+                logger.info(f"Create tile pyramid {capture.id}: {pyramid.width}x{pyramid.height}, {pyramid.max_level + 1} levels")
+                while len(self._pyramids) > self._max_pyramids:
+                    id, _ = self._pyramids.popitem(last=False)
+                    self._evict_pyramid(id)
+            self._pyramids.move_to_end(capture.id)
+            self._evict()
+            return pyramid
+
+    def pyramid(self, id):
+        with self._lock:
+            return self._pyramids.get(id)
+
+    # called with lock
+    def _evict_pyramid(self, id):
+        for key in [key for key in self._tiles if key[0] == id]:
+            self._bytes -= len(self._tiles.pop(key))
+        logger.info(f"Evict tile pyramid {id}")
+
+    # JPEG data of a tile, or None if the pyramid is evicted or out of range
+    def tile(self, id, level, col, row):
+        key = (id, level, col, row)
+        with self._lock:
+            data = self._tiles.get(key)
+            if data is not None:
+                self._tiles.move_to_end(key)
+                self._stats["hits"] += 1
+                return data
+            pyramid = self._pyramids.get(id)
+        if pyramid is None:
+            return None
+        data = pyramid.tile(level, col, row)
+        if data is None:
+            return None
+        with self._lock:
+            self._stats["misses"] += 1
+            if key not in self._tiles and id in self._pyramids:
+                self._tiles[key] = data
+                self._bytes += len(data)
+            # the tile may have generated a level image
+            self._evict()
+        return data
@@ -0,0 +1,323 @@
+import io
+import os
+import json
+import bisect
+import math
+import time
+import struct
+import threading
+import urllib.parse
+from PIL import Image
+import avi
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Timelapse takes a downscaled capture of "main" stream every "interval"
+# seconds (at multiples of the interval since epoch), and appends it to one
+# container instead of a file per capture, so the SD card is not filled with
+# thousands of small files:
+# - "timelapse.dat": the JPEG images back to back, append-only.
+# - "timelapse.idx": a fixed-size record for each image, its capture time
+#   (milliseconds since epoch), offset and size.
+# An image is written and synced before its record, so after a power loss
+# the records beyond the images and the images without record are cut when
+# the container is loaded.
+# Records are read from file when needed (a range is found by a binary
+# search on the index file, records are read in blocks), and a movie of a
+# range is assembled frame by frame while it is sent, so memory use does not
+# depend on the length of the timelapse or of the range.
+
+RECORD = struct.Struct("<QQI4x")
+INDEX_BLOCK = 4096 # records read at once
+DATA_FILE = "timelapse.dat"
+INDEX_FILE = "timelapse.idx"
+
+# multipart part header of a frame, the same as multipart_header() in camera.py
+def part_header(size, timestamp):
+    return (f"--FRAME\r\n"
+            f"Content-Type: image/jpeg\r\n"
+            f"Content-Length: {size}\r\n"
+            f"X-Timestamp: {timestamp:.6f}\r\n"
+            "\r\n").encode()
+
+# capture times of the records (milliseconds), read from the index file, for
+# a binary search with bisect
+class RecordTimes(object):
+    def __init__(self, timelapse, count):
+        self._timelapse = timelapse
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        return self._timelapse.record(i)[0]
+
+class Timelapse(object):
+    def __init__(self, capture, directory = "timelapse", interval = 60, resolution = (640, 360), quality = 85):
+        self._capture = capture
+        self._directory = directory
+        self._interval = interval
+        self._resolution = tuple(resolution)
+        self._quality = quality
+        self._data_path = os.path.join(directory, DATA_FILE)
+        self._index_path = os.path.join(directory, INDEX_FILE)
+        self._data_fd = None
+        self._index_fd = None
+        self._count = 0
+        self._data_size = 0
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._stats = {"captures": 0, "errors": 0, "movies": 0}
+
+    @property
+    def interval(self):
+        return self._interval
+
+    @property
+    def count(self):
+        return self._count
+
+    # open the container, cut what was not completely written
+    def load(self):
+        os.makedirs(self._directory, exist_ok=True)
+        self._data_fd = os.open(self._data_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self._index_fd = os.open(self._index_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        data_size = os.fstat(self._data_fd).st_size
+        count = os.fstat(self._index_fd).st_size // RECORD.size
+        while count > 0:
+            _, offset, size = self._read_record(self._index_fd, count - 1)
+            if offset + size <= data_size:
+                break
+            count -= 1
+        end = 0
+        if count > 0:
+            _, offset, size = self._read_record(self._index_fd, count - 1)
+            end = offset + size
+        if os.fstat(self._index_fd).st_size != count * RECORD.size or data_size != end:
+            logger.warning(f"Cut incomplete timelapse: {count} images, {data_size - end} bytes of images cut")
+            os.ftruncate(self._index_fd, count * RECORD.size)
+            os.ftruncate(self._data_fd, end)
+        with self._lock:
+            self._count = count
+            self._data_size = end
+        logger.info(f"Loaded timelapse of {count} images from {self._directory}")
+
+    def _read_record(self, fd, i):
+        return RECORD.unpack(os.pread(fd, RECORD.size, i * RECORD.size))
+
+    # (capture time in milliseconds, offset, size) of the record
+    def record(self, i):
+        return self._read_record(self._index_fd, i)
+
+    # records from "start" to "end" (exclusive) with the step, read in blocks
+    def records(self, start, end, step = 1):
+        block = max(INDEX_BLOCK - INDEX_BLOCK % step, step)
+        for i in range(start, end, block):
+            count = min(block, end - i)
+            data = os.pread(self._index_fd, count * RECORD.size, i * RECORD.size)
+            for j in range(0, count, step):
+                yield RECORD.unpack_from(data, j * RECORD.size)
+
+    # indices of the first and after the last image captured in the window
+    # (seconds since epoch)
+    def find(self, start, end):
+        times = RecordTimes(self, self._count)
+        return bisect.bisect_left(times, int(start * 1000)), bisect.bisect_right(times, int(end * 1000))
+
+    def capture(self):
+        image = self._capture()
+        timestamp = time.time()
+        if image.size != self._resolution:
+            image = image.resize(self._resolution, resample=Image.BILINEAR, reducing_gap=2.0)
+        buf = io.BytesIO()
+        image.convert("RGB").save(buf, format="JPEG", quality=self._quality)
+        self._append(timestamp, buf.getvalue())
+
+    def _append(self, timestamp, data):
+        offset = self._data_size
+        written = 0
+        try:
+            while written < len(data):
+                written += os.write(self._data_fd, data[written:])
+            os.fsync(self._data_fd)
+            os.write(self._index_fd, RECORD.pack(int(timestamp * 1000), offset, len(data)))
+            os.fsync(self._index_fd)
+        except OSError:
+            # the image is cut when the container is loaded again
+            os.ftruncate(self._data_fd, offset)
+            raise
+        with self._lock:
+            self._count += 1
+            self._data_size = offset + len(data)
+        self._stats["captures"] += 1
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            next_t = (math.floor(time.time() / self._interval) + 1) * self._interval
+            if self._stop_event.wait(next_t - time.time()):
+                break
+            try:
+                self.capture()
+            except Exception as e:
+                self._stats["errors"] += 1
+                logger.warning(f"Error to capture timelapse: {e}")
+
+    def start(self):
+        if self._thread is None:
+            logger.info(f"Start timelapse every {self._interval}s to {self._directory}")
+            if self._data_fd is None:
+                self.load()
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, name="timelapse", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+            logger.info("Timelapse stopped")
+
+    # movie of the images in the window in the format ("mjpg" or "avi") at
+    # "fps", every image, or decimated to about "duration" seconds, None if
+    # no image
+    def movie(self, format, start, end, fps = 30, duration = None):
+        first, last = self.find(start, end)
+        if last <= first:
+            return None
+        step = 1
+        if duration:
+            step = max(1, math.ceil((last - first) / max(duration * fps, 1)))
+        self._stats["movies"] += 1
+        movie_class = MjpegMovie if format == "mjpg" else AviMovie
+        return movie_class(self, first, last, step, fps)
+
+    def info(self):
+        with self._lock:
+            count = self._count
+        return {
+            "images": count,
+            "start": self.record(0)[0] / 1000 if count > 0 else None,
+            "end": self.record(count - 1)[0] / 1000 if count > 0 else None,
+            "interval": self._interval,
+            "resolution": list(self._resolution),
+            "bytes": self._data_size,
+        }
+
+    def stats(self):
+        return dict(self._stats, images=self._count, bytes=self._data_size)
+
+# A movie is written as lists of buffers (see instant_replay.py), one frame
+# at a time read from the container with its own file descriptor.
+class TimelapseMovie(object):
+    def __init__(self, timelapse, first, last, step, fps):
+        self.timelapse = timelapse
+        self.first = first
+        self.last = last
+        self.step = step
+        self.fps = fps
+        self.frames = len(range(first, last, step))
+        self.start_t = timelapse.record(first)[0] / 1000
+
+    def __len__(self):
+        return self.length
+
+    def records(self):
+        return self.timelapse.records(self.first, self.last, self.step)
+
+    def images(self):
+        fd = os.open(self.timelapse._data_path, os.O_RDONLY)
+        try:
+            for _, offset, size in self.records():
+                yield os.pread(fd, size, offset)
+        finally:
+            os.close(fd)
+
+# multipart parts like the recordings, the timestamps are the times of the
+# frames in the movie, e.g. for the "replay" camera
+class MjpegMovie(TimelapseMovie):
+    content_type = "video/x-motion-jpeg"
+    extension = "mjpg"
+
+    def __init__(self, timelapse, first, last, step, fps):
+        super().__init__(timelapse, first, last, step, fps)
+        self.length = sum(len(part_header(size, self.frame_time(i))) + size + 2
+                          for i, (_, _, size) in enumerate(self.records()))
+
+    def frame_time(self, i):
+        return self.start_t + i / self.fps
+
+    def buffers(self):
+        for i, image in enumerate(self.images()):
+            yield [part_header(len(image), self.frame_time(i)), image, b"\r\n"]
+
+class AviMovie(TimelapseMovie):
+    content_type = avi.CONTENT_TYPE
+    extension = "avi"
+
+    def __init__(self, timelapse, first, last, step, fps):
+        super().__init__(timelapse, first, last, step, fps)
+        max_size, movi_size = 0, 4
+        for _, _, size in self.records():
+            max_size = max(max_size, size)
+            movi_size += avi.chunk_size(size)
+        _, offset, size = timelapse.record(first)
+        fd = os.open(timelapse._data_path, os.O_RDONLY)
+        try:
+            width, height = avi.jpeg_size(os.pread(fd, size, offset)) or (0, 0)
+        finally:
+            os.close(fd)
+        self.header = avi.header(self.frames, movi_size, max_size, width, height, 1000000 / fps)
+        self.length = avi.length(self.header, movi_size, self.frames)
+
+    def buffers(self):
+        yield [self.header]
+        for image in self.images():
+            yield avi.frame_buffers(image)
+        for block in avi.index_blocks(self.frames, (size for _, _, size in self.records())):
+            yield [block]
+
+# Timelapse is served by the web servers:
+# - "/timelapse.json": number of images, time of the first and last image.
+# - "/timelapse.mjpg" and "/timelapse.avi": movie of the images from "start"
+#   to "end" (seconds since epoch, all by default) at "fps" frames per second
+#   (30 by default), decimated to about "duration" seconds if set.
+INFO_PATH = "/timelapse.json"
+MOVIE_PATHS = {"/timelapse.mjpg": "mjpg", "/timelapse.avi": "avi"}
+DEFAULT_FPS = 30
+
+def is_timelapse_path(path):
+    url_path = urllib.parse.urlsplit(path).path
+    return url_path == INFO_PATH or url_path in MOVIE_PATHS
+
+# return (code, headers, body), body is bytes or a movie
+def timelapse_response(timelapse, path):
+    if timelapse is None:
+        return 404, {}, b""
+    url = urllib.parse.urlsplit(path)
+    if url.path == INFO_PATH:
+        body = json.dumps(timelapse.info()).encode()
+        return 200, {"Content-Type": "application/json", "Cache-Control": "no-cache"}, body
+    query = urllib.parse.parse_qs(url.query)
+    try:
+        start = float(query["start"][0]) if "start" in query else 0
+        end = float(query["end"][0]) if "end" in query else time.time()
+        fps = float(query["fps"][0]) if "fps" in query else DEFAULT_FPS
+        duration = float(query["duration"][0]) if "duration" in query else None
+    except ValueError:
+        return 400, {}, b""
+    if fps <= 0 or fps > 120:
+        return 400, {}, b""
+    movie = timelapse.movie(MOVIE_PATHS[url.path], start, end, fps, duration)
+    if movie is None:
+        return 404, {}, b""
+    headers = {
+        "Content-Type": movie.content_type,
+        "Content-Length": len(movie),
+        "Content-Disposition": f"attachment; filename=timelapse-{int(movie.start_t)}.{movie.extension}",
+        "Cache-Control": "no-cache",
+    }
+    return 200, headers, movie
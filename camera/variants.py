@@ -0,0 +1,209 @@
+import io
+import time
+import threading
+from PIL import Image
+
+import logging
+logger = logging.getLogger(__name__)
+
+# A derived variant of the primary video stream, with a smaller width, a
+# lower frame rate and/or another JPEG quality.
+# Frames are read from the primary stream, decimated to the frame rate by
+# capture timestamp, and only re-encoded if the size or quality differs, so
+# a variant never triggers another capture.
+# The viewers (cursors) of the variant stream are its references, the
+# variant stops itself when it has no viewer for "idle_timeout" seconds.
+# It decides to stop under "lock", the lock of its owner which looks it up
+# and touches it, so a variant returned to a new viewer keeps running.
+class StreamVariant(object):
+    def __init__(self, primary, stream, size, fps, quality, primary_size, primary_fps, idle_timeout = 10,
+                 lock = None):
+        self._primary = primary
+        self._stream = stream
+        self.size = size
+        self.fps = fps
+        self.quality = quality
+        self._interval = 1.0 / fps
+        # tolerance for the jitter of capture timestamps
+        self._tolerance = 0.5 / primary_fps
+        self._transcode = size != tuple(primary_size) or quality is not None
+        self._idle_timeout = idle_timeout
+        self._lock = lock or threading.Lock()
+        self._next_t = 0
+        self._used_t = time.time()
+        self.frames = 0
+        self.encodes = 0
+        self.encode_time = 0.0
+        self.started_t = time.time()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name=f"variant {self.name}", daemon=True)
+        self._thread.start()
+
+    @property
+    def key(self):
+        return (self.size, self.fps, self.quality)
+
+    @property
+    def name(self):
+        return f"{self.size[0]}x{self.size[1]}@{self.fps}q{self.quality or '-'}"
+
+    # "stream" label of the metrics of the variant stream
+    @staticmethod
+    def label(size, fps, quality):
+        return f"variant_w{size[0]}_f{fps}" + (f"_q{quality}" if quality is not None else "")
+
+    @property
+    def stream(self):
+        return self._stream
+
+    @property
+    def running(self):
+        return self._running
+
+    # keep the variant running for a new viewer, called under the lock
+    def touch(self):
+        self._used_t = time.time()
+
+    def _encode(self, data):
+        start_t = time.time()
+        image = Image.open(io.BytesIO(data))
+        # JPEG draft mode decodes at 1/2, 1/4 or 1/8 scale, no smaller than the size
+        image.draft("RGB", self.size)
+        if image.size != self.size:
+            image = image.resize(self.size, resample=Image.BILINEAR)
+        buf = io.BytesIO()
+        image.save(buf, format="JPEG", quality=self.quality or 85)
+        self.encodes += 1
+        self.encode_time += time.time() - start_t
+        return buf.getvalue()
+
+    def _run(self):
+        logger.info(f"Start stream variant {self.name}")
+        cursor = self._primary.cursor(f"variant {self.name}")
+        try:
+            while self._running:
+                frame = cursor.read(1)
+                if self._stream.consumers > 0:
+                    self._used_t = time.time()
+                else:
+                    if time.time() - self._used_t > self._idle_timeout:
+                        # check again under the lock, the variant may be touched
+                        with self._lock:
+                            if self._stream.consumers == 0 and time.time() - self._used_t > self._idle_timeout:
+                                self._running = False
+                                break
+                    continue
+                if frame is None or frame.timestamp + self._tolerance < self._next_t:
+                    continue
+                self._next_t = max(self._next_t + self._interval, frame.timestamp - self._interval)
+                try:
+                    if self._transcode:
+                        self._stream.write_frame(self._encode(frame.data), frame.timestamp, time.time())
+                    else:
+                        self._stream.write_frame(frame.data, frame.timestamp, frame.encoded_t)
+                    self.frames += 1
+                except Exception as e:
+                    logger.warning(f"Error to encode stream variant {self.name}: {e}")
+        finally:
+            self._running = False
+            cursor.close()
+            logger.info(f"Stop stream variant {self.name}: {self.stats()}")
+
+    # stop the variant, and wait for its thread (up to the read timeout of
+    # the primary stream) unless "wait" is False
+    def stop(self, wait = True):
+        self._running = False
+        if wait and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "viewers": self._stream.consumers,
+            "frames": self.frames,
+            "encodes": self.encodes,
+            "encode_time": self.encode_time / self.encodes if self.encodes else 0.0,
+            "duration": time.time() - self.started_t,
+        }
+
+# Stream variants are created on demand by the query of the stream URL, e.g.
+# "/stream.mjpg?w=640&fps=10&q=60", and shared by all viewers of the same
+# variant. Width is rounded down to a multiple of 16 (height keeps the aspect
+# ratio), frame rate to an integer and quality to a step of 5, so similar
+# requests share a variant. At most "max_variants" variants run at once.
+# The stream factory creates the stream buffer of a variant by its label.
+# Variants are stopped under the lock and waited for after it, so a viewer
+# never waits for the thread of another variant to end. An idle variant
+# stops itself under the same lock, so it is either found running and
+# touched, or replaced by a new variant.
+class StreamVariants(object):
+    def __init__(self, primary, stream_factory, max_variants = 4, idle_timeout = 10):
+        self._primary = primary
+        self._stream_factory = stream_factory
+        self._max_variants = max_variants
+        self._idle_timeout = idle_timeout
+        self._primary_size = (640, 480)
+        self._primary_fps = 30
+        self._variants = {}
+        self._lock = threading.Lock()
+
+    # size and frame rate of the primary stream, set when the camera is opened
+    def set_primary(self, size, fps):
+        self._primary_size = tuple(size)
+        self._primary_fps = fps
+
+    # normalized key (size, fps, quality) of a variant, None for the primary
+    def key(self, width = None, fps = None, quality = None):
+        primary_width, primary_height = self._primary_size
+        width = primary_width if width is None else min(max(int(width) // 16 * 16, 160), primary_width)
+        height = round(width * primary_height / primary_width / 2) * 2
+        primary_fps = round(self._primary_fps)
+        fps = primary_fps if fps is None else min(max(int(fps), 1), primary_fps)
+        quality = None if quality is None else min(max(int(quality) // 5 * 5, 5), 100)
+        if width == primary_width and fps >= primary_fps and quality is None:
+            return None
+        return ((width, height), fps, quality)
+
+    # stream of the variant, created if not running yet
+    def get(self, width = None, fps = None, quality = None):
+        key = self.key(width, fps, quality)
+        if key is None:
+            return self._primary
+        stopped = []
+        try:
+            with self._lock:
+                self._variants = {k: v for k, v in self._variants.items() if v.running}
+                variant = self._variants.get(key)
+                if variant is not None:
+                    variant.touch()
+                    return variant.stream
+                if self._max_variants > 0 and len(self._variants) >= self._max_variants:
+                    # make room by stopping variants without viewers
+                    for k, v in list(self._variants.items()):
+                        if v.stream.consumers == 0:
+                            v.stop(wait = False)
+                            stopped.append(v)
+                            del self._variants[k]
+                    if len(self._variants) >= self._max_variants:
+                        raise Exception(f"Too many stream variants: {len(self._variants)}")
+                size, fps, quality = key
+                variant = StreamVariant(self._primary, self._stream_factory(StreamVariant.label(*key)), size, fps,
+                                        quality, self._primary_size, self._primary_fps, self._idle_timeout,
+                                        self._lock)
+                self._variants[key] = variant
+                return variant.stream
+        finally:
+            for v in stopped:
+                v.stop()
+
+    def stats(self):
+        return [variant.stats() for variant in list(self._variants.values()) if variant.running]
+
+    def stop(self):
+        with self._lock:
+            variants = list(self._variants.values())
+            self._variants.clear()
+            for variant in variants:
+                variant.stop(wait = False)
+        for variant in variants:
+            variant.stop()
@@ -1,4 +1,7 @@
+import os 
+import copy 
 import json 
+import threading 
 import logging
 logger = logging.getLogger(__name__)
 
@@ -90,10 +93,23 @@ DEFAULT_SETTINGS = {
     }    
 }
 
+# settings of options (index of the selected option) and ranges (value) 
+OPTION_SETTINGS = ("transform", "frame_rate", "resolution", "snapshot_resolution", "af_mode", "awb_mode") 
+RANGE_SETTINGS = ("brightness", ) 
+
+# Video settings are saved to the config file atomically (a temp file is 
+# written and synced, then renamed over the config file), so the file is 
+# never corrupted by a power loss, and a burst of updates (e.g. dragging the 
+# brightness slider) is saved once, "save_delay" seconds after the first. 
+# Saves of the timer and of flush (at exit) write the temp file one at a time. 
 class VideoConfig(object): 
-    def __init__(self, config_file = "video_config.json"): 
+    def __init__(self, config_file = "video_config.json", save_delay = 1.0): 
         self._config_file = config_file 
-        self._settings = DEFAULT_SETTINGS 
+        self._save_delay = save_delay 
+        self._save_timer = None 
+        self._lock = threading.RLock() 
+        self._save_lock = threading.Lock() 
+        self._settings = copy.deepcopy(DEFAULT_SETTINGS) 
         logger.debug("Default settings:")
         logger.debug(self._settings)
         if self._config_file is not None: 
@@ -108,13 +124,84 @@ class VideoConfig(object):
 
     def save(self): 
         logger.info(f"Save settings to {self._config_file}") 
-        try: 
-            with open(self._config_file, "w") as f: 
-                json.dump(self._settings, f) 
+        with self._save_lock: 
+            # the settings are taken under the save lock, so the last write 
+            # has the newest settings 
+            with self._lock: 
+                if self._save_timer is not None: 
+                    self._save_timer.cancel() 
+                    self._save_timer = None 
+                data = json.dumps(self._settings) 
+            temp_file = f"{self._config_file}.tmp" 
+            try: 
+                with open(temp_file, "w") as f: 
+                    f.write(data) 
+                    f.flush() 
+                    os.fsync(f.fileno()) 
+                os.replace(temp_file, self._config_file) 
+                # the rename is durable when the directory is synced 
+                dir_fd = os.open(os.path.dirname(os.path.abspath(self._config_file)), os.O_RDONLY) 
+                try: 
+                    os.fsync(dir_fd) 
+                finally: 
+                    os.close(dir_fd) 
                 return True 
-        except Exception as e: 
-            logger.warning(f"Error to save config: {e}") 
-            return False 
+            except Exception as e: 
+                logger.warning(f"Error to save config: {e}") 
+                return False 
+
+    # save the settings later, updates until then are saved by the same write 
+    def save_later(self): 
+        with self._lock: 
+            if self._save_timer is None: 
+                self._save_timer = threading.Timer(self._save_delay, self.save) 
+                self._save_timer.daemon = True 
+                self._save_timer.start() 
+
+    # save the pending updates now, e.g. at exit 
+    def flush(self): 
+        with self._lock: 
+            pending = self._save_timer is not None 
+        if pending: 
+            self.save() 
+
+    # Update several settings at once, {name: selected option or value}. 
+    # All values are validated before any setting is changed, so either all 
+    # are updated or none. Return the new values of changed settings. 
+    def update(self, params): 
+        with self._lock: 
+            for name, value in params.items(): 
+                self._validate(name, value) 
+            changes = {} 
+            for name, value in params.items(): 
+                if name in OPTION_SETTINGS: 
+                    new_value = self._update_option_value(name, value) 
+                else: 
+                    new_value = self._update_range_value(name, value) 
+                if new_value is not None: 
+                    changes[name] = new_value 
+            return changes 
+
+    # copy of the named settings, to restore them if they are not applied 
+    def backup(self, names): 
+        with self._lock: 
+            return {name: copy.deepcopy(self._settings[name]) for name in names if name in self._settings} 
+
+    def restore(self, settings): 
+        with self._lock: 
+            self._settings.update(settings) 
+
+    def _validate(self, name, value): 
+        if name not in self._settings or name not in OPTION_SETTINGS + RANGE_SETTINGS: 
+            raise Exception(f"{name} is not in configuration") 
+        settings = self._settings[name] 
+        if name in OPTION_SETTINGS: 
+            if isinstance(value, bool) or not isinstance(value, int) or not 0 <= value < len(settings["options"]): 
+                raise Exception(f"Option index of {name} is out of range: {value}") 
+        else: 
+            range = settings["range"] 
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or not range[0] <= value <= range[1]: 
+                raise Exception(f"Value of {name} is out of range: {value}") 
 
     def settings(self, full = False): 
         if full: 
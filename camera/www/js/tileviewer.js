@@ -0,0 +1,164 @@
+// Tile viewer for the snapshot tile pyramid (Deep Zoom layout), only the
+// tiles covering the current viewport at the current zoom are loaded.
+//
+// var viewer = new TileViewer(element, { maxZoom: 6 });
+// viewer.open("tiles/snapshot.json");
+
+function TileViewer(element, options) {
+  options = options || {};
+  this.element = element;
+  this.maxZoom = options.maxZoom || 6; // relative to the full resolution
+  this.info = null;
+  this.scale = 1; // screen pixels per image pixel
+  this.x = 0; // screen position of the image origin
+  this.y = 0;
+  this.tiles = {};
+  this.pointers = {};
+
+  this.layer = document.createElement("div");
+  this.layer.style.cssText = "position:absolute;left:0;top:0;width:100%;height:100%;overflow:hidden;touch-action:none;";
+  this.backdrop = document.createElement("img");
+  this.backdrop.style.cssText = "position:absolute;transform-origin:0 0;";
+  this.backdrop.draggable = false;
+  this.layer.appendChild(this.backdrop);
+  element.appendChild(this.layer);
+
+  var self = this;
+  this.layer.addEventListener("wheel", function (e) {
+    e.preventDefault();
+    self.zoomAt(e.deltaY < 0 ? 1.25 : 0.8, e.offsetX, e.offsetY);
+  }, { passive: false });
+  this.layer.addEventListener("dblclick", function (e) {
+    self.zoomAt(2, e.offsetX, e.offsetY);
+  });
+  this.layer.addEventListener("pointerdown", function (e) {
+    self.layer.setPointerCapture(e.pointerId);
+    self.pointers[e.pointerId] = { x: e.clientX, y: e.clientY };
+  });
+  this.layer.addEventListener("pointermove", function (e) {
+    var last = self.pointers[e.pointerId];
+    if (!last) return;
+    var ids = Object.keys(self.pointers);
+    if (ids.length == 1) {
+      self.panBy(e.clientX - last.x, e.clientY - last.y);
+    } else if (ids.length == 2) {
+      var other = self.pointers[ids[0] == e.pointerId ? ids[1] : ids[0]];
+      var before = Math.hypot(last.x - other.x, last.y - other.y);
+      var after = Math.hypot(e.clientX - other.x, e.clientY - other.y);
+      var rect = self.layer.getBoundingClientRect();
+      if (before > 0) {
+        self.zoomAt(after / before, (e.clientX + other.x) / 2 - rect.left, (e.clientY + other.y) / 2 - rect.top);
+      }
+    }
+    self.pointers[e.pointerId] = { x: e.clientX, y: e.clientY };
+  });
+  var release = function (e) { delete self.pointers[e.pointerId]; };
+  this.layer.addEventListener("pointerup", release);
+  this.layer.addEventListener("pointercancel", release);
+  window.addEventListener("resize", function () { self.fit(); });
+}
+
+TileViewer.prototype.open = function (url) {
+  var self = this;
+  return fetch(url, { cache: "no-store" })
+    .then(function (response) { return response.json(); })
+    .then(function (info) {
+      self.info = info;
+      for (var key in self.tiles) self.layer.removeChild(self.tiles[key]);
+      self.tiles = {};
+      // backdrop is the highest level which fits in one tile
+      var level = Math.min(info.max_level, Math.floor(Math.log2(info.tile_size)));
+      self.backdrop.src = info.url + level + "/0_0.jpg";
+      self.backdropLevel = level;
+      self.fit();
+      return info;
+    });
+};
+
+TileViewer.prototype.minScale = function () {
+  return Math.min(this.layer.clientWidth / this.info.width, this.layer.clientHeight / this.info.height);
+};
+
+TileViewer.prototype.fit = function () {
+  if (!this.info) return;
+  this.scale = this.minScale();
+  this.x = (this.layer.clientWidth - this.info.width * this.scale) / 2;
+  this.y = (this.layer.clientHeight - this.info.height * this.scale) / 2;
+  this.update();
+};
+
+TileViewer.prototype.zoomAt = function (factor, cx, cy) {
+  if (!this.info) return;
+  var minScale = this.minScale();
+  var maxScale = Math.max(minScale * this.maxZoom, this.maxZoom / (window.devicePixelRatio || 1));
+  var scale = Math.min(Math.max(this.scale * factor, minScale), maxScale);
+  this.x = cx - (cx - this.x) * scale / this.scale;
+  this.y = cy - (cy - this.y) * scale / this.scale;
+  this.scale = scale;
+  this.update();
+};
+
+TileViewer.prototype.zoomIn = function () {
+  this.zoomAt(2, this.layer.clientWidth / 2, this.layer.clientHeight / 2);
+};
+
+TileViewer.prototype.zoomOut = function () {
+  this.zoomAt(0.5, this.layer.clientWidth / 2, this.layer.clientHeight / 2);
+};
+
+TileViewer.prototype.panBy = function (dx, dy) {
+  this.x += dx;
+  this.y += dy;
+  this.update();
+};
+
+// keep the image in view, centered if smaller than the view
+TileViewer.prototype.clamp = function () {
+  var w = this.info.width * this.scale, h = this.info.height * this.scale;
+  var vw = this.layer.clientWidth, vh = this.layer.clientHeight;
+  this.x = w <= vw ? (vw - w) / 2 : Math.min(0, Math.max(vw - w, this.x));
+  this.y = h <= vh ? (vh - h) / 2 : Math.min(0, Math.max(vh - h, this.y));
+};
+
+TileViewer.prototype.update = function () {
+  var info = this.info;
+  this.clamp();
+  var backdropScale = this.scale * Math.pow(2, info.max_level - this.backdropLevel);
+  this.backdrop.style.transform = "translate(" + this.x + "px," + this.y + "px) scale(" + backdropScale + ")";
+
+  // level with enough pixels for the screen
+  var ratio = this.scale * (window.devicePixelRatio || 1);
+  var level = Math.min(info.max_level, Math.max(0, info.max_level + Math.ceil(Math.log2(ratio))));
+  var levelScale = Math.pow(2, info.max_level - level); // image pixels per level pixel
+  var levelWidth = Math.ceil(info.width / levelScale), levelHeight = Math.ceil(info.height / levelScale);
+  var tileSize = info.tile_size * levelScale * this.scale; // screen pixels per tile
+
+  var vw = this.layer.clientWidth, vh = this.layer.clientHeight;
+  var col0 = Math.max(0, Math.floor(-this.x / tileSize)), row0 = Math.max(0, Math.floor(-this.y / tileSize));
+  var col1 = Math.min(Math.ceil(levelWidth / info.tile_size) - 1, Math.floor((vw - this.x) / tileSize));
+  var row1 = Math.min(Math.ceil(levelHeight / info.tile_size) - 1, Math.floor((vh - this.y) / tileSize));
+
+  var visible = {};
+  for (var row = row0; row <= row1; row++) {
+    for (var col = col0; col <= col1; col++) {
+      var key = level + "/" + col + "_" + row;
+      visible[key] = true;
+      var tile = this.tiles[key];
+      if (!tile) {
+        tile = document.createElement("img");
+        tile.style.cssText = "position:absolute;transform-origin:0 0;";
+        tile.draggable = false;
+        tile.src = info.url + key + ".jpg";
+        this.tiles[key] = tile;
+        this.layer.appendChild(tile);
+      }
+      tile.style.transform = "translate(" + (this.x + col * tileSize) + "px," + (this.y + row * tileSize) + "px) scale(" + (levelScale * this.scale) + ")";
+    }
+  }
+  for (var key in this.tiles) {
+    if (!visible[key]) {
+      this.layer.removeChild(this.tiles[key]);
+      delete this.tiles[key];
+    }
+  }
+};
@@ -0,0 +1,173 @@
+import os
+import gzip
+import time
+import hashlib
+import mimetypes
+import posixpath
+import threading
+import urllib.parse
+from email.utils import formatdate, parsedate_to_datetime
+
+try:
+    import brotli
+except ImportError: # optional, "python3-brotli" on Raspberry Pi OS
+    brotli = None
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Static files of the web pages (the "www" tree) are kept in memory, with
+# gzip (and brotli, if available) variants compressed once when a file is
+# loaded, so pages are never read from the SD card or compressed per request.
+# Responses have ETag and Last-Modified, and conditional requests get "304
+# Not Modified". Each encoding of a file has its own strong ETag (with a
+# suffix for a compressed variant), a conditional request matches any of
+# them. Files of "assets", "js" and "css" are cached by browsers for
+# "max_age" seconds, pages (HTML) are always revalidated.
+
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "application/xml", "image/svg+xml")
+# smaller files gain nothing from compression
+MIN_COMPRESS_SIZE = 256
+LONG_LIVED_DIRS = ("assets", "js", "css")
+# suffix of the ETag of a compressed variant
+ETAG_SUFFIXES = {"gzip": "gz", "br": "br"}
+
+# A file in memory, with its compressed variants (encoding -> data).
+class WwwFile(object):
+    def __init__(self, path, data, mtime, max_age = 0):
+        self.path = path
+        self.data = data
+        self.content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self._hash = hashlib.sha1(data).hexdigest()[:16]
+        self.etag = f'"{self._hash}"'
+        self.mtime = int(mtime)
+        self.last_modified = formatdate(self.mtime, usegmt=True)
+        self.cache_control = f"public, max-age={max_age}" if max_age > 0 else "no-cache"
+        self.variants = {}
+        if len(data) >= MIN_COMPRESS_SIZE and self.content_type.startswith(COMPRESSIBLE_TYPES):
+            if brotli is not None:
+                self._add_variant("br", brotli.compress(data, quality=11))
+            self._add_variant("gzip", gzip.compress(data, compresslevel=9, mtime=0))
+
+    def _add_variant(self, encoding, data):
+        if len(data) < len(self.data):
+            self.variants[encoding] = data
+
+    # ETag of the encoding, None for identity
+    def etag_of(self, encoding):
+        if encoding is None:
+            return self.etag
+        return f'"{self._hash}-{ETAG_SUFFIXES[encoding]}"'
+
+    # True if the client has the same version of the file
+    def not_modified(self, headers):
+        if_none_match = headers.get("if-none-match")
+        if if_none_match is not None:
+            etags = [etag.strip() for etag in if_none_match.split(",")]
+            if "*" in etags:
+                return True
+            for etag in [self.etag] + [self.etag_of(encoding) for encoding in self.variants]:
+                if etag in etags or f"W/{etag}" in etags:
+                    return True
+            return False
+        if_modified_since = headers.get("if-modified-since")
+        if if_modified_since is not None:
+            try:
+                return self.mtime <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    # preferred encoding of the client which has a variant, None for identity
+    def encoding_for(self, headers):
+        accepted = {}
+        for item in headers.get("accept-encoding", "").split(","):
+            encoding, _, params = item.strip().partition(";")
+            q = 1.0
+            for param in params.split(";"):
+                key, _, value = param.strip().partition("=")
+                if key == "q":
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        q = 0.0
+            accepted[encoding.strip().lower()] = q
+        for encoding in ("br", "gzip"):
+            if encoding in self.variants and accepted.get(encoding, 0) > 0:
+                return encoding
+        return None
+
+class WwwCache(object):
+    def __init__(self, directory = "www", max_age = 604800):
+        self._directory = directory
+        self._max_age = max_age
+        self._files = {}
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "not_modified": 0, "compressed": 0, "bytes": 0, "bytes_sent": 0}
+
+    # load all files of the directory, return the number of files
+    def load(self):
+        start_t = time.time()
+        files = {}
+        for root, _, names in os.walk(self._directory):
+            for name in names:
+                file_path = os.path.join(root, name)
+                path = "/" + os.path.relpath(file_path, self._directory).replace(os.sep, "/")
+                try:
+                    with open(file_path, "rb") as f:
+                        data = f.read()
+                    files[path] = WwwFile(path, data, os.path.getmtime(file_path), self._max_age_of(path))
+                except OSError as e:
+                    logger.warning(f"Error to load {file_path}: {e}")
+        with self._lock:
+            self._files = files
+        size = sum(len(file.data) + sum(len(v) for v in file.variants.values()) for file in files.values())
+        self._stats["bytes"] = size
+        logger.info(f"Loaded {len(files)} files of {self._directory} ({size} bytes) in {time.time() - start_t:.3f}s")
+        return len(files)
+
+    def _max_age_of(self, path):
+        return self._max_age if path.split("/")[1] in LONG_LIVED_DIRS else 0
+
+    # "/" is the live video page, and "/name" is "/name.html" if the page exists
+    def resolve(self, path):
+        path = urllib.parse.unquote(urllib.parse.urlsplit(path).path)
+        path = "/" + "/".join(part for part in posixpath.normpath(path).split("/") if part not in ("", ".", ".."))
+        if path == "/":
+            path = "/video.html"
+        files = self._files
+        for candidate in (path, path + ".html", path + "/index.html"):
+            if candidate in files:
+                return files[candidate]
+        return None
+
+    # return (code, headers, body) of the path for request headers (lower
+    # case names), body is empty for "304 Not Modified"
+    def response(self, path, headers = {}):
+        self._stats["requests"] += 1
+        file = self.resolve(path)
+        if file is None:
+            return 404, {}, b""
+        encoding = file.encoding_for(headers)
+        response_headers = {
+            "ETag": file.etag_of(encoding),
+            "Last-Modified": file.last_modified,
+            "Cache-Control": file.cache_control,
+        }
+        if file.variants:
+            response_headers["Vary"] = "Accept-Encoding"
+        if file.not_modified(headers):
+            self._stats["not_modified"] += 1
+            return 304, response_headers, b""
+        body = file.data
+        if encoding is not None:
+            self._stats["compressed"] += 1
+            response_headers["Content-Encoding"] = encoding
+            body = file.variants[encoding]
+        response_headers["Content-Type"] = file.content_type
+        response_headers["Content-Length"] = len(body)
+        self._stats["bytes_sent"] += len(body)
+        return 200, response_headers, body
+
+    def stats(self):
+        return dict(self._stats, files=len(self._files))